@@ -95,7 +95,7 @@ def collect_expr(
     pixel_unit_x: str,
     pixel_unit_y: str,
     ome_tiff: Path,
-):
+) -> str:
     new_filename = mask_filename.replace("_mask", "_expr")
     output_file = out_dir / new_filename
 
@@ -109,6 +109,13 @@ def collect_expr(
         pixel_unit_x=pixel_unit_x,
         pixel_unit_y=pixel_unit_y,
     )
+    return new_filename
+
+
+def collect_channel_stats(channel_stats: Path, out_dir: Path, expr_name: str):
+    output_file = out_dir / (expr_name.split(".", 1)[0] + "_channel_stats.json")
+    print("Copying", channel_stats, "to", output_file)
+    shutil.copy(channel_stats, output_file)
 
 
 def collect_ome_tiff(ome_tiff: Path, out_dir: Path):
@@ -121,6 +128,7 @@ def main(
     pipeline_config_path: Path,
     ome_tiff: Path,
     dataset_dir: Path,
+    channel_stats: Optional[Path] = None,
 ):
     pipeline_config = read_pipeline_config(pipeline_config_path)
     out_dir = Path("/output/pipeline_output")
@@ -132,7 +140,7 @@ def main(
     print("\nCollecting segmentation masks")
     mask_filename = collect_segm_mask(mask_dir, mask_out_dir, pipeline_config["image_name"])
     print("\nCollecting expressions")
-    collect_expr(
+    expr_filename = collect_expr(
         mask_filename=mask_filename,
         out_dir=expr_out_dir,
         segmentation_channel_ids=pipeline_config["segmentation_channel_ids"],
@@ -143,6 +151,8 @@ def main(
         pixel_unit_y=pipeline_config["pixel_unit_y"],
         ome_tiff=ome_tiff,
     )
+    if channel_stats is not None:
+        collect_channel_stats(channel_stats, expr_out_dir, expr_filename)
     channels_csv = find_channels_csv(dataset_dir)
     (channels_csv_output_dir := Path("channels_csv")).mkdir(exist_ok=True, parents=True)
     print("Copying", channels_csv, "to", channels_csv_output_dir)
@@ -155,6 +165,11 @@ if __name__ == "__main__":
     parser.add_argument("--pipeline_config", type=Path, help="path to region map file YAML")
     parser.add_argument("--ome_tiff", type=Path, help="path to the converted ome.tiff file")
     parser.add_argument("--dataset_dir", type=Path, help="path to the source dataset")
+    parser.add_argument(
+        "--channel_stats",
+        type=Path,
+        help="path to per-channel statistics JSON written by threshold_image.py",
+    )
 
     args = parser.parse_args()
 
@@ -163,4 +178,5 @@ if __name__ == "__main__":
         pipeline_config_path=args.pipeline_config,
         ome_tiff=args.ome_tiff,
         dataset_dir=args.dataset_dir,
+        channel_stats=args.channel_stats,
     )
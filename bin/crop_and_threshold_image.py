@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+import os
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Optional
+
+import tifffile as tif
+
+import crop_input_image
+import threshold_image
+from crop_input_image import (
+    crop_image,
+    find_geojson,
+    get_crop_window,
+    get_cropped_image_path,
+    padding_default,
+    read_crop_geometry,
+)
+from slicing.tiff_pages import open_page_reader
+from threshold_image import (
+    CHANNEL_STATS_NAME,
+    get_channel_names,
+    get_page_channels,
+    parse_channel_thresholds,
+    save_channel_stats,
+    threshold_planes,
+)
+from utils import find_channels_csv
+from utils_ome import strip_namespace
+
+physical_size_attributes = [
+    "PhysicalSizeX",
+    "PhysicalSizeXUnit",
+    "PhysicalSizeY",
+    "PhysicalSizeYUnit",
+    "PhysicalSizeZ",
+    "PhysicalSizeZUnit",
+]
+
+
+def get_ome_metadata(ome_xml_str: str, axes: str) -> dict:
+    """tifffile OME metadata with the channel names and physical sizes of the input"""
+    pixels = strip_namespace(ome_xml_str).find("Image").find("Pixels")
+    metadata = {"axes": axes, "Channel": {"Name": get_channel_names(ome_xml_str)}}
+    for attribute in physical_size_attributes:
+        if (value := pixels.get(attribute)) is not None:
+            metadata[attribute] = float(value) if not attribute.endswith("Unit") else value
+    return metadata
+
+
+def crop_and_threshold_geojson(
+    image_path: Path,
+    geojson_path: Path,
+    channels_csv: Path,
+    padding: int,
+    exclude_mask_content: bool,
+    out_path: Path,
+    num_workers: Optional[int] = None,
+):
+    """Same output as crop_input_image.crop_geojson followed by threshold_image.main,
+    in one pass: every plane is read only inside the crop window, thresholded
+    and masked band by band, and written into one memory-mapped OME-TIFF
+    """
+    clip_data = parse_channel_thresholds(channels_csv)
+    print("Loading GeoJSON from", geojson_path)
+    _, closed_geometry = read_crop_geometry(geojson_path)
+
+    with tif.TiffFile(image_path) as TF:
+        ome_xml = TF.ome_metadata
+        series = TF.series[0]
+        page_indices = [page.index for page in series.pages]
+        page_channels = get_page_channels(series)
+        image_shape = series.shape
+        axes = series.axes
+        dtype = series.dtype
+    print("Shape:", image_shape)
+
+    print("Computing mask")
+    pixel_slices, mask = get_crop_window(
+        closed_geometry, image_shape[-2:], padding, exclude_mask_content
+    )
+    print("Crop region (y, x):", pixel_slices)
+    outside = ~mask
+    del mask
+
+    out_path.parent.mkdir(exist_ok=True, parents=True)
+    print("Saving to", out_path)
+    out = tif.memmap(
+        out_path,
+        shape=image_shape[:-2] + outside.shape,
+        dtype=dtype,
+        photometric="minisblack",
+        ome=True,
+        metadata=get_ome_metadata(ome_xml, axes),
+    )
+    out_planes = out.reshape((-1,) + outside.shape)
+
+    tasks = []
+    for i, channel_id in enumerate(get_channel_names(ome_xml)):
+        min_value = clip_data.low.get(channel_id)
+        max_value = clip_data.high.get(channel_id)
+        print("Thresholding channel", channel_id, "with min", min_value, "and max", max_value)
+        for out_index, page_index in enumerate(page_indices):
+            if page_channels[out_index] == i:
+                reader = open_page_reader(image_path, page_index)
+                tasks.append((channel_id, (reader, out_planes[out_index], min_value, max_value)))
+
+    stats = threshold_planes(tasks, num_workers, window=pixel_slices, outside=outside)
+    out.flush()
+    del out
+    save_channel_stats(stats, out_path.parent / CHANNEL_STATS_NAME)
+
+
+def main(
+    image_path: Path,
+    dataset_dir: Path,
+    invert_geojson_mask: bool,
+    num_workers: Optional[int] = None,
+):
+    maybe_geojson_file = find_geojson(dataset_dir)
+    if maybe_geojson_file is None:
+        # SectionAligner writes the cropped image itself, threshold it afterwards
+        crop_image(image_path, dataset_dir, invert_geojson_mask, debug=False)
+        out_path = get_cropped_image_path(image_path)
+        tmp_path = out_path.with_name(out_path.name + ".tmp")
+        threshold_image.main(out_path, dataset_dir, num_workers, out_path=tmp_path)
+        os.replace(tmp_path, out_path)
+    else:
+        print("Found GeoJSON file at", maybe_geojson_file)
+        # same file name as crop_input_image.crop_geojson output
+        out_path = get_cropped_image_path(
+            crop_input_image.output_path_base / crop_input_image.output_filename_default
+        )
+        crop_and_threshold_geojson(
+            image_path,
+            maybe_geojson_file,
+            find_channels_csv(dataset_dir),
+            padding_default,
+            invert_geojson_mask,
+            out_path,
+            num_workers,
+        )
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+    p.add_argument("image_path", type=Path)
+    p.add_argument("dataset_dir", type=Path)
+    p.add_argument("--invert-geojson-mask", action="store_true")
+    p.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of channel planes cropped and thresholded in parallel",
+    )
+    args = p.parse_args()
+
+    main(
+        image_path=args.image_path,
+        dataset_dir=args.dataset_dir,
+        invert_geojson_mask=args.invert_geojson_mask,
+        num_workers=args.num_workers,
+    )
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import math
 import shlex
 from argparse import ArgumentParser
 from os import rename
@@ -14,13 +15,19 @@ import numpy as np
 import rasterio
 import rasterio.features
 import shapely
-from skimage.measure import regionprops
+import shapely.affinity
+import tifffile as tif
+from skimage.measure import block_reduce
 
+from slicing.tiff_pages import open_page_reader
 from utils import new_plot
 
 padding_default = 128
 output_path_base = Path("/output/results")
 output_filename_default = "aligned_tissue_0.ome.tif"
+debug_overview_max_dim_default = 2048
+# rows of a channel read at once when building debug overviews
+overview_band_rows = 1024
 
 
 def find_geojson(directory: Path) -> Optional[Path]:
@@ -33,21 +40,8 @@ def find_geojson(directory: Path) -> Optional[Path]:
         return None
 
 
-def crop_geojson(
-    image_path: Path,
-    geojson_path: Path,
-    padding: int,
-    exclude_mask_content: bool,
-    debug: bool,
-):
-    debug_out_dir = Path("crop-debug")
-
-    print("Reading image from", image_path)
-    image = bioio.BioImage(image_path)
-    image_data = image.data
-    print("Shape:", image_data.shape)
-
-    print("Loading GeoJSON from", geojson_path)
+def read_crop_geometry(geojson_path: Path) -> tuple:
+    """Geometry from a GeoJSON file, and the same polygons without holes"""
     with open(geojson_path) as f:
         crop_geometry = shapely.from_geojson(f.read())
         if not isinstance(crop_geometry, shapely.GeometryCollection):
@@ -64,76 +58,226 @@ def crop_geojson(
         closed_geometry = shapely.GeometryCollection(
             [shapely.Polygon(poly.exterior.coords) for poly in geoms_to_fill]
         )
+    return crop_geometry, closed_geometry
 
-    if debug:
-        debug_out_dir.mkdir(exist_ok=True, parents=True)
-        pixel_channel_sum_log1p = np.log1p(image_data.squeeze().sum(axis=0))
-
-        crop_geom_gs = gpd.GeoSeries(crop_geometry)
-        with new_plot():
-            axi = plt.imshow(pixel_channel_sum_log1p, cmap="gray")
-            crop_geom_gs.plot(ax=axi.axes, color="#FF000080")
-            axi.figure.savefig(debug_out_dir / "1-orig.pdf", bbox_inches="tight")
-
-        closed_geom_gs = gpd.GeoSeries(closed_geometry)
-        with new_plot():
-            axi = plt.imshow(pixel_channel_sum_log1p, cmap="gray")
-            closed_geom_gs.plot(ax=axi.axes, color="#FF000080")
-            axi.figure.savefig(debug_out_dir / "2-closed-geom.pdf", bbox_inches="tight")
-
-    identity_transform = rasterio.transform.Affine(1, 0, 0, 0, 1, 0)
 
-    print("Computing mask")
-    mask = rasterio.features.geometry_mask(
+def get_crop_mask(
+    closed_geometry,
+    image_shape: tuple,
+    exclude_mask_content: bool,
+    window: Optional[tuple[slice, slice]] = None,
+) -> np.ndarray:
+    """Rasterized selection over the whole image, or only over its (y, x) window"""
+    if window is None:
+        window = (slice(0, image_shape[0]), slice(0, image_shape[1]))
+    # pixel (0, 0) of the mask is pixel (window y start, window x start) of the image
+    window_transform = rasterio.transform.Affine.translation(window[1].start, window[0].start)
+    return rasterio.features.geometry_mask(
         [closed_geometry],
-        image_data.shape[-2:],
-        identity_transform,
+        (window[0].stop - window[0].start, window[1].stop - window[1].start),
+        window_transform,
         # default behavior for this script is to only include the area
         # contained in the mask, which corresponds to invert=True
         # TODO: reconsider logic and semantics of arguments
         invert=not exclude_mask_content,
     )
-    print("Proportion of image selected:", mask.mean())
 
-    if debug:
-        with new_plot():
-            axi = plt.imshow(mask, cmap="gray")
-            axi.figure.savefig(debug_out_dir / "3-mask.pdf", bbox_inches="tight")
 
-    print("Calculating bounding box of selected region")
-    rps = list(regionprops(mask.astype(np.uint8)))
-    assert len(rps) == 1
+def get_geometry_window(geometry, image_shape: tuple, margin: int) -> tuple[slice, slice]:
+    """Window of every pixel that the geometry bounds touch, grown by margin
+    and clipped to the image. Rasterization only selects pixels whose center
+    is inside the geometry, so they are all in the window.
+    """
+    if geometry.is_empty:
+        raise ValueError("GeoJSON crop geometry is empty")
+    min_x, min_y, max_x, max_y = geometry.bounds
+    image_max_y, image_max_x = image_shape
+    return (
+        slice(
+            min(image_max_y, max(0, math.floor(min_y) - margin)),
+            max(0, min(image_max_y, math.ceil(max_y) + margin)),
+        ),
+        slice(
+            min(image_max_x, max(0, math.floor(min_x) - margin)),
+            max(0, min(image_max_x, math.ceil(max_x) + margin)),
+        ),
+    )
 
-    min_y, min_x, max_y, max_x = rps[0].bbox
-    image_max_y, image_max_x = image_data.shape[-2:]
+
+def get_crop_window(
+    closed_geometry, image_shape: tuple, padding: int, exclude_mask_content: bool
+) -> tuple[tuple[slice, slice], np.ndarray]:
+    """Bounding box of the selected region with padding, clipped to the image,
+    and the crop mask inside it. The mask is rasterized only around the geometry,
+    or over the whole image if the selection is everything outside of it.
+    """
+    if exclude_mask_content:
+        window = (slice(0, image_shape[0]), slice(0, image_shape[1]))
+    else:
+        window = get_geometry_window(closed_geometry, image_shape, padding + 1)
+    mask = get_crop_mask(closed_geometry, image_shape, exclude_mask_content, window)
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    assert rows.size > 0, "GeoJSON crop geometry selects no pixels"
+
+    image_max_y, image_max_x = image_shape
+    min_y, max_y = window[0].start + int(rows[0]), window[0].start + int(rows[-1]) + 1
+    min_x, max_x = window[1].start + int(cols[0]), window[1].start + int(cols[-1]) + 1
     pixel_slices = (
         slice(max(0, min_y - padding), min(max_y + padding, image_max_y)),
         slice(max(0, min_x - padding), min(max_x + padding, image_max_x)),
     )
-    print("Crop region (y, x):", pixel_slices)
+    mask_slices = tuple(
+        slice(s.start - w.start, s.stop - w.start) for s, w in zip(pixel_slices, window)
+    )
+    return pixel_slices, mask[mask_slices]
+
+
+def open_plane_readers(image_path: Path) -> np.ndarray:
+    """Windowed readers of every plane of the first series of a TIFF file,
+    in an object array of shape (T, C, Z), the leading dimensions of a BioImage
+    """
+    with tif.TiffFile(image_path) as TF:
+        series = TF.series[0]
+        page_axes = series.axes[:-2]
+        page_shape = series.shape[:-2]
+        page_indices = [page.index for page in series.pages]
+    if not set(page_axes) <= set("TCZ"):
+        raise ValueError(f"Unsupported image axes {series.axes}")
+    sizes = dict(zip(page_axes, page_shape))
+    readers = np.empty(tuple(sizes.get(axis, 1) for axis in "TCZ"), dtype=object)
+    for i, page_index in enumerate(page_indices):
+        position = dict(zip(page_axes, np.unravel_index(i, page_shape)))
+        plane_index = tuple(int(position.get(axis, 0)) for axis in "TCZ")
+        readers[plane_index] = open_page_reader(image_path, page_index)
+    return readers
+
+
+def read_cropped_channels(
+    readers: np.ndarray, pixel_slices: tuple[slice, slice], outside: np.ndarray
+) -> np.ndarray:
+    """Reads only the (y, x) window of every plane, one plane at a time,
+    and zeroes pixels where outside is True in place
+    """
+    dtype = readers.flat[0].dtype
+    image_data_cropped = np.empty(readers.shape + outside.shape, dtype=dtype)
+    for plane_index, reader in np.ndenumerate(readers):
+        plane = image_data_cropped[plane_index]
+        plane[...] = reader[pixel_slices]
+        np.copyto(plane, 0, where=outside)
+    return image_data_cropped
+
+
+def get_overview_factor(shape: tuple, max_dim: int) -> int:
+    return max(1, math.ceil(max(shape) / max_dim))
+
+
+def get_overview(
+    channels: list, max_dim: int, window: Optional[tuple[slice, slice]] = None
+) -> tuple[np.ndarray, int]:
+    """log1p of the channel sum, averaged over factor x factor pixel blocks
+    so that no side is longer than max_dim. Channels can be any 2D arrays
+    that support slicing, e.g. page readers; they are read band by band,
+    only inside the (y, x) window if one is given.
+    """
+    if window is None:
+        window = (slice(0, channels[0].shape[0]), slice(0, channels[0].shape[1]))
+    row_start, col_slice = window[0].start, window[1]
+    height, width = window[0].stop - row_start, col_slice.stop - col_slice.start
+    factor = get_overview_factor((height, width), max_dim)
+    band_rows = factor * max(1, overview_band_rows // factor)
+    overview = np.zeros((math.ceil(height / factor), math.ceil(width / factor)))
+    for channel in channels:
+        for row_f in range(0, height, band_rows):
+            band_start = row_start + row_f
+            band_stop = min(band_start + band_rows, window[0].stop)
+            band = np.asarray(channel[band_start:band_stop, col_slice])
+            block_sums = block_reduce(band, (factor, factor), np.sum)
+            overview[row_f // factor :][: block_sums.shape[0]] += block_sums
+    overview /= factor * factor
+    return np.log1p(overview, out=overview), factor
+
+
+def save_overview_plot(overview: np.ndarray, path: Path, geometry=None):
+    with new_plot():
+        # pixel (i, j) covers [j, j + 1) x [i, i + 1), same as geometries scaled to the overview
+        extent = (0, overview.shape[1], overview.shape[0], 0)
+        axi = plt.imshow(overview, cmap="gray", extent=extent)
+        if geometry is not None:
+            gpd.GeoSeries(geometry).plot(ax=axi.axes, color="#FF000080")
+        axi.figure.savefig(path, bbox_inches="tight")
+
+
+def scale_geometry(geometry, factor: int):
+    return shapely.affinity.scale(geometry, 1 / factor, 1 / factor, origin=(0, 0))
 
-    print("Cropping image with", padding, "pixel(s) of padding")
-    image_data_cropped = image.data[:, :, :, *pixel_slices]
-    print("Cropping mask with", padding, "pixel(s) of padding")
-    mask_data_cropped = mask[*pixel_slices]
 
+def crop_geojson(
+    image_path: Path,
+    geojson_path: Path,
+    padding: int,
+    exclude_mask_content: bool,
+    debug: bool,
+    debug_overview_max_dim: int = debug_overview_max_dim_default,
+):
+    """Crops the image to the padded bounding box of the GeoJSON selection.
+    With debug, plots go to crop-debug, built from block-averaged overviews
+    that are at most debug_overview_max_dim pixels on their longest side.
+    """
+    debug_out_dir = Path("crop-debug")
+
+    print("Reading image from", image_path)
+    image = bioio.BioImage(image_path)
+    print("Shape:", image.shape)
+
+    print("Loading GeoJSON from", geojson_path)
+    crop_geometry, closed_geometry = read_crop_geometry(geojson_path)
+
+    readers = open_plane_readers(image_path)
+    # first time point and z plane, as in the default BioImage YX view of a channel
+    channels = list(readers[0, :, 0])
     if debug:
-        image_data_cropped_sum_log1p = np.log1p(image_data_cropped.squeeze().sum(axis=0))
-        with new_plot():
-            axi = plt.imshow(image_data_cropped_sum_log1p, cmap="gray")
-            axi.figure.savefig(debug_out_dir / "4-image-data-cropped.pdf", bbox_inches="tight")
-        with new_plot():
-            axi = plt.imshow(mask_data_cropped, cmap="gray")
-            axi.figure.savefig(debug_out_dir / "5-mask-cropped.pdf", bbox_inches="tight")
+        debug_out_dir.mkdir(exist_ok=True, parents=True)
+        print("Computing debug overview")
+        overview, factor = get_overview(channels, debug_overview_max_dim)
+        print("Overview downsampling factor:", factor)
+        save_overview_plot(
+            overview, debug_out_dir / "1-orig.pdf", scale_geometry(crop_geometry, factor)
+        )
+        closed_geometry_overview = scale_geometry(closed_geometry, factor)
+        save_overview_plot(overview, debug_out_dir / "2-closed-geom.pdf", closed_geometry_overview)
+        mask_overview = get_crop_mask(
+            closed_geometry_overview, overview.shape, exclude_mask_content
+        )
+        save_overview_plot(mask_overview, debug_out_dir / "3-mask.pdf")
+        del overview, mask_overview
 
-    print("Zeroing pixels outside of selection")
-    image_data_cropped[:, :, :, ~mask_data_cropped] = 0
+    print(
+        "Computing mask and bounding box of selected region with", padding, "pixel(s) of padding"
+    )
+    pixel_slices, mask_data_cropped = get_crop_window(
+        closed_geometry, image.shape[-2:], padding, exclude_mask_content
+    )
+    print("Proportion of image selected:", mask_data_cropped.sum() / math.prod(image.shape[-2:]))
+    print("Crop region (y, x):", pixel_slices)
 
     if debug:
-        image_data_cropped_sum_log1p = np.log1p(image_data_cropped.squeeze().sum(axis=0))
-        with new_plot():
-            axi = plt.imshow(image_data_cropped_sum_log1p, cmap="gray")
-            axi.figure.savefig(debug_out_dir / "6-masked.pdf", bbox_inches="tight")
+        overview, factor = get_overview(channels, debug_overview_max_dim, pixel_slices)
+        save_overview_plot(overview, debug_out_dir / "4-image-data-cropped.pdf")
+        mask_overview = block_reduce(mask_data_cropped, (factor, factor), np.mean)
+        save_overview_plot(mask_overview, debug_out_dir / "5-mask-cropped.pdf")
+        del overview, mask_overview
+
+    print(
+        "Cropping image with", padding, "pixel(s) of padding, zeroing pixels outside of selection"
+    )
+    image_data_cropped = read_cropped_channels(readers, pixel_slices, ~mask_data_cropped)
+
+    if debug:
+        masked_channels = [image_data_cropped[0, c, 0] for c in range(image.dims.C)]
+        overview, _ = get_overview(masked_channels, debug_overview_max_dim)
+        save_overview_plot(overview, debug_out_dir / "6-masked.pdf")
+        del overview
 
     print(f"Instantiating new {bioio.BioImage}")
     image_cropped = bioio.BioImage(
@@ -152,11 +296,15 @@ def crop_geojson(
     rename_image(output_path)
 
 
-def rename_image(input_image: Path):
+def get_cropped_image_path(input_image: Path) -> Path:
     source_filename: str = input_image.name
     if source_filename.endswith(".tif"):
         source_filename += "f"
-    output_path = output_path_base / source_filename
+    return output_path_base / source_filename
+
+
+def rename_image(input_image: Path):
+    output_path = get_cropped_image_path(input_image)
     print("Renaming output to", output_path.name)
     rename(output_path_base / output_filename_default, output_path)
 
@@ -166,6 +314,7 @@ def crop_image(
     dataset_directory: Path,
     invert_geojson_mask: bool,
     debug: bool,
+    debug_overview_max_dim: int = debug_overview_max_dim_default,
 ):
     maybe_geojson_file = find_geojson(dataset_directory)
     if maybe_geojson_file is None:
@@ -192,6 +341,7 @@ def crop_image(
             padding=padding_default,
             exclude_mask_content=invert_geojson_mask,
             debug=debug,
+            debug_overview_max_dim=debug_overview_max_dim,
         )
 
 
@@ -201,6 +351,12 @@ if __name__ == "__main__":
     p.add_argument("dataset_dir", type=Path)
     p.add_argument("--invert-geojson-mask", action="store_true")
     p.add_argument("--debug", action="store_true")
+    p.add_argument(
+        "--debug_overview_max_dim",
+        type=int,
+        default=debug_overview_max_dim_default,
+        help="longest side in pixels of the image overviews in debug plots",
+    )
     args = p.parse_args()
 
     crop_image(
@@ -208,4 +364,5 @@ if __name__ == "__main__":
         dataset_directory=args.dataset_dir,
         invert_geojson_mask=args.invert_geojson_mask,
         debug=args.debug,
+        debug_overview_max_dim=args.debug_overview_max_dim,
     )
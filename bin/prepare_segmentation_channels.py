@@ -1,12 +1,33 @@
 import argparse
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from pprint import pprint
+from typing import Optional, Tuple
 
-import dask
+import numpy as np
 import tifffile as tif
 
+from slicing.tiff_pages import (
+    ACCUMULATION_DTYPES,
+    get_channel_page_indices,
+    get_dtype_limits,
+    get_wide_dtype,
+    open_page_reader,
+)
 from utils import read_pipeline_config
 
+CHUNK_ROWS = 2048
+NORMALIZATION_DTYPES = ("none", "uint8", "uint16")
+NORMALIZATION_PERCENTILES = (1.0, 99.9)
+# integer sums are counted in at most this many histogram bins of equal width
+MAX_HISTOGRAM_BINS = 2**16
+# read by slicing/run_slicing.py, which records it in pipelineConfig.json
+NORMALIZATION_FILE_NAME = "segmentation_channel_normalization.json"
+# read by slicing/run_slicing.py, the stitcher upsamples masks back with these factors
+DOWNSAMPLING_FILE_NAME = "segmentation_downsampling.json"
+
 
 def create_dirs_per_region(listing: dict[int, dict[str, str]], out_dir: Path) -> dict[int, Path]:
     dirs_per_region = {}
@@ -25,14 +46,200 @@ def change_vals_to_keys(input_dict: dict) -> dict:
     return vals_to_keys
 
 
-def extract_segm_channels(path: Path, segm_ch_ids: dict[str, list[int]]):
-    stack = tif.imread(path)
-    if len(stack.shape) < 3:
-        raise ValueError("Input image is not multichannel")
-    segm_channels = {}
-    for ch_name, ids in segm_ch_ids.items():
-        segm_channels[ch_name] = stack[ids, ...].sum(axis=0)
-    return segm_channels
+def sum_pages(readers: list, row_f: int, row_t: int) -> np.ndarray:
+    acc = np.array(readers[0][row_f:row_t], dtype=get_wide_dtype(readers[0].dtype))
+    for reader in readers[1:]:
+        acc += np.asarray(reader[row_f:row_t])
+    return acc
+
+
+def downsample(acc: np.ndarray, factor: Tuple[int, int]) -> np.ndarray:
+    """Mean of factor[0] x factor[1] pixel blocks, blocks cut by the bottom
+    and right edges are averaged over the pixels they have
+    """
+    factor_y, factor_x = factor
+    if factor_y == factor_x == 1:
+        return acc
+    sums = np.add.reduceat(acc, np.arange(0, acc.shape[0], factor_y), axis=0)
+    sums = np.add.reduceat(sums, np.arange(0, acc.shape[1], factor_x), axis=1)
+    counts_y = np.diff(np.append(np.arange(0, acc.shape[0], factor_y), acc.shape[0]))
+    counts_x = np.diff(np.append(np.arange(0, acc.shape[1], factor_x), acc.shape[1]))
+    return np.rint(sums / np.outer(counts_y, counts_x)).astype(acc.dtype)
+
+
+def read_rows(readers: list, row_f: int, row_t: int, factor: Tuple[int, int]) -> np.ndarray:
+    """Sum of rows [row_f, row_t) of all channel pages, downsampled by factor"""
+    return downsample(sum_pages(readers, row_f, row_t), factor)
+
+
+def get_out_rows(row_f: int, row_t: int, factor: Tuple[int, int]) -> slice:
+    return slice(row_f // factor[0], math.ceil(row_t / factor[0]))
+
+
+def sum_rows(
+    readers: list, out: np.ndarray, row_f: int, row_t: int, factor: Tuple[int, int] = (1, 1)
+):
+    """Sums rows [row_f, row_t) of all channel pages into out, saturating at out dtype limits"""
+    acc = read_rows(readers, row_f, row_t, factor)
+    out[get_out_rows(row_f, row_t, factor)] = np.clip(acc, *get_dtype_limits(out.dtype))
+
+
+def get_histogram_bin_width(in_dtype: np.dtype, num_channels: int) -> int:
+    max_sum = int(np.iinfo(in_dtype).max) * num_channels
+    return max(1, math.ceil((max_sum + 1) / MAX_HISTOGRAM_BINS))
+
+
+def histogram_rows(
+    readers: list, row_f: int, row_t: int, bin_width: int, factor: Tuple[int, int] = (1, 1)
+) -> np.ndarray:
+    """Histogram of nonzero channel sums in rows [row_f, row_t)"""
+    acc = read_rows(readers, row_f, row_t, factor)
+    values = acc[acc > 0]
+    return np.bincount((values // bin_width).astype(np.intp), minlength=MAX_HISTOGRAM_BINS)
+
+
+def get_percentile_bounds(
+    hist: np.ndarray, bin_width: int, percentiles: Tuple[float, float]
+) -> Tuple[int, int]:
+    """Low and high values of the percentiles from a histogram, within one bin width"""
+    cumulative = np.cumsum(hist)
+    total = cumulative[-1]
+    if total == 0:
+        return 0, 1
+    low_bin, high_bin = np.searchsorted(cumulative, np.array(percentiles) / 100 * total)
+    low = int(low_bin) * bin_width
+    high = (int(high_bin) + 1) * bin_width - 1
+    return low, max(high, low + 1)
+
+
+def normalize_rows(
+    readers: list,
+    out: np.ndarray,
+    row_f: int,
+    row_t: int,
+    low: int,
+    high: int,
+    factor: Tuple[int, int] = (1, 1),
+):
+    """Sums rows of all channel pages and rescales [low, high] to the full range of out dtype"""
+    acc = read_rows(readers, row_f, row_t, factor).astype(np.float32)
+    acc -= low
+    acc *= np.iinfo(out.dtype).max / (high - low)
+    np.clip(acc, 0, np.iinfo(out.dtype).max, out=acc)
+    out[get_out_rows(row_f, row_t, factor)] = np.rint(acc)
+
+
+def get_downsampling_factor(
+    pixel_size_y: float, pixel_size_x: float, target_pixel_size: float
+) -> Tuple[int, int]:
+    """Largest integer factors that keep pixels no larger than target_pixel_size"""
+    return tuple(
+        max(1, math.floor(target_pixel_size / pixel_size + 1e-6))
+        for pixel_size in (pixel_size_y, pixel_size_x)
+    )
+
+
+def run_in_threads(tasks: list, num_workers: Optional[int]) -> list:
+    """Runs (function, *args) tasks in a thread pool, returns their results in order"""
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(*task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def extract_segm_channels(
+    path: Path,
+    segm_ch_ids: dict[str, list[int]],
+    out_paths: dict[str, Path],
+    dtype: str = "input",
+    num_workers: Optional[int] = None,
+    chunk_rows: int = CHUNK_ROWS,
+    normalize: str = "none",
+    percentiles: Tuple[float, float] = NORMALIZATION_PERCENTILES,
+    downsampling: Tuple[int, int] = (1, 1),
+) -> dict[str, tuple]:
+    """Reads only the pages of segmentation channels and sums them chunk by chunk
+    straight into memory-mapped output files, so that neither the input stack
+    nor a whole output channel is held in memory. Sums saturate at the limits
+    of dtype, "input" keeps the dtype of the input image.
+    With normalize set to uint8 or uint16, dtype is ignored: a first pass builds
+    a histogram of the nonzero sums of every channel, and the second one rescales
+    the sums between its low and high percentiles to the full range of that dtype.
+    With downsampling factors above 1 every block of that many pixels (y, x)
+    is replaced by its mean before normalization.
+    Chunks of rows of all channels are processed in parallel threads.
+    Returns shape, dtype and normalization parameters (or None) of every output channel.
+    """
+    with tif.TiffFile(path) as TF:
+        series = TF.series[0]
+        if len(series.shape) < 3:
+            raise ValueError("Input image is not multichannel")
+        page_indices = {
+            ch_name: get_channel_page_indices(series, ids) for ch_name, ids in segm_ch_ids.items()
+        }
+        in_shape = series.shape[-2:]
+        in_dtype = series.dtype
+    img_shape = tuple(math.ceil(size / f) for size, f in zip(in_shape, downsampling))
+    # chunks start at block boundaries
+    chunk_rows = math.ceil(chunk_rows / downsampling[0]) * downsampling[0]
+    if normalize != "none":
+        if not np.issubdtype(in_dtype, np.integer):
+            raise ValueError(f"Normalization needs an integer input image, got {in_dtype}")
+        out_dtype = np.dtype(normalize)
+    else:
+        out_dtype = in_dtype if dtype == "input" else np.dtype(dtype)
+    readers = {
+        ch_name: [open_page_reader(path, i) for i in indices]
+        for ch_name, indices in page_indices.items()
+    }
+    row_ranges = [
+        (row_f, min(row_f + chunk_rows, in_shape[0]))
+        for row_f in range(0, in_shape[0], chunk_rows)
+    ]
+
+    normalization = {ch_name: None for ch_name in readers}
+    if normalize != "none":
+        bin_widths = {
+            ch_name: get_histogram_bin_width(in_dtype, len(ch_readers))
+            for ch_name, ch_readers in readers.items()
+        }
+        tasks = [
+            (histogram_rows, ch_readers, row_f, row_t, bin_widths[ch_name], downsampling)
+            for ch_name, ch_readers in readers.items()
+            for row_f, row_t in row_ranges
+        ]
+        hists = iter(run_in_threads(tasks, num_workers))
+        for ch_name in readers:
+            hist = sum(next(hists) for _ in row_ranges)
+            low, high = get_percentile_bounds(hist, bin_widths[ch_name], percentiles)
+            normalization[ch_name] = {
+                "dtype": normalize,
+                "percentiles": list(percentiles),
+                "low": low,
+                "high": high,
+                "histogram_bin_width": bin_widths[ch_name],
+            }
+
+    outputs = dict()
+    tasks = []
+    for ch_name, ch_readers in readers.items():
+        out = tif.memmap(out_paths[ch_name], shape=img_shape, dtype=out_dtype)
+        outputs[ch_name] = out
+        for row_f, row_t in row_ranges:
+            if normalization[ch_name] is None:
+                tasks.append((sum_rows, ch_readers, out, row_f, row_t, downsampling))
+            else:
+                low, high = normalization[ch_name]["low"], normalization[ch_name]["high"]
+                tasks.append(
+                    (normalize_rows, ch_readers, out, row_f, row_t, low, high, downsampling)
+                )
+    run_in_threads(tasks, num_workers)
+    for out in outputs.values():
+        out.flush()
+    return {
+        ch_name: (out.shape, out.dtype, normalization[ch_name]) for ch_name, out in outputs.items()
+    }
 
 
 def copy_channels(
@@ -40,19 +247,45 @@ def copy_channels(
     img_path: Path,
     img_slice_name: str,
     segmentation_channel_ids: dict[str, list[int]],
-):
+    dtype: str = "input",
+    num_workers: Optional[int] = None,
+    normalize: str = "none",
+    percentiles: Tuple[float, float] = NORMALIZATION_PERCENTILES,
+    downsampling: Tuple[int, int] = (1, 1),
+) -> dict[str, dict]:
+    """Returns normalization parameters by output file name, if normalized"""
     new_name_template = "{slice_name}_{segm_ch_name}.tif"
-    segm_channels = extract_segm_channels(img_path, segmentation_channel_ids)
-    print("segm_channels:")
-    pprint(segm_channels)
-    for ch_name, img in segm_channels.items():
-        new_name = new_name_template.format(
-            slice_name=img_slice_name,
-            segm_ch_name=ch_name,
+    out_paths = {
+        ch_name: out_dir
+        / new_name_template.format(slice_name=img_slice_name, segm_ch_name=ch_name)
+        for ch_name in segmentation_channel_ids
+    }
+    segm_channels = extract_segm_channels(
+        img_path,
+        segmentation_channel_ids,
+        out_paths,
+        dtype,
+        num_workers,
+        normalize=normalize,
+        percentiles=percentiles,
+        downsampling=downsampling,
+    )
+    normalization = dict()
+    for ch_name, (shape, ch_dtype, ch_normalization) in segm_channels.items():
+        print(
+            "channel:",
+            ch_name,
+            "| shape:",
+            shape,
+            "| dtype:",
+            ch_dtype,
+            "| new_location:",
+            out_paths[ch_name],
         )
-        dst = out_dir / new_name
-        tif.imwrite(dst, img)
-        print("channel:", ch_name, "| new_location:", dst)
+        if ch_normalization is not None:
+            print("\tnormalized from", ch_normalization["low"], "-", ch_normalization["high"])
+            normalization[out_paths[ch_name].name] = ch_normalization
+    return normalization
 
 
 def copy_segm_channels_to_out_dirs(
@@ -60,21 +293,45 @@ def copy_segm_channels_to_out_dirs(
     listing: dict[int, dict[str, str]],
     segmentation_channel_ids: dict[str, list[int]],
     out_dir: Path,
+    dtype: str = "input",
+    num_workers: Optional[int] = None,
+    normalize: str = "none",
+    percentiles: Tuple[float, float] = NORMALIZATION_PERCENTILES,
+    downsampling: Tuple[int, int] = (1, 1),
 ):
-    tasks = []
+    normalization = dict()
     for img_slice_name, path in listing.items():
         # img_path = data_dir / "converted.ome.tiff"
-        task = dask.delayed(copy_channels)(
-            out_dir,
-            img_path,
-            img_slice_name,
-            segmentation_channel_ids,
+        normalization.update(
+            copy_channels(
+                out_dir,
+                img_path,
+                img_slice_name,
+                segmentation_channel_ids,
+                dtype,
+                num_workers,
+                normalize,
+                percentiles,
+                downsampling,
+            )
         )
-        tasks.append(task)
-    dask.compute(*tasks)
+    if normalization:
+        with open((p := out_dir / NORMALIZATION_FILE_NAME), "w") as f:
+            print("Saving normalization parameters to", p)
+            json.dump(normalization, f, indent=4)
 
 
-def main(data_dir: Path, pipeline_config_path: Path, ome_tiff: Path, output_dir: Path):
+def main(
+    data_dir: Path,
+    pipeline_config_path: Path,
+    ome_tiff: Path,
+    output_dir: Path,
+    dtype: str = "input",
+    num_workers: Optional[int] = None,
+    normalize: str = "none",
+    percentiles: Tuple[float, float] = NORMALIZATION_PERCENTILES,
+    target_pixel_size: Optional[float] = None,
+):
     print("data_dir contents:")
     from pprint import pprint
 
@@ -92,9 +349,43 @@ def main(data_dir: Path, pipeline_config_path: Path, ome_tiff: Path, output_dir:
         for channel_index in channel_indexes:
             print("\t", pipeline_config["channel_names"][channel_index], sep="")
 
-    dask.config.set({"num_workers": 5, "scheduler": "processes"})
+    downsampling = (1, 1)
+    if target_pixel_size is not None:
+        downsampling = get_downsampling_factor(
+            pipeline_config["pixel_size_y"], pipeline_config["pixel_size_x"], target_pixel_size
+        )
+        print(
+            "Segmentation channels downsampled by (y, x):",
+            downsampling,
+            "to pixel size of at most",
+            target_pixel_size,
+            pipeline_config["pixel_unit_x"],
+        )
+        with tif.TiffFile(ome_tiff) as TF:
+            source_shape = TF.series[0].shape[-2:]
+        downsampling_info = {
+            "factor": list(downsampling),
+            "source_shape": list(source_shape),
+            "target_pixel_size": target_pixel_size,
+            "pixel_size_x": pipeline_config["pixel_size_x"],
+            "pixel_size_y": pipeline_config["pixel_size_y"],
+            "pixel_unit_x": pipeline_config["pixel_unit_x"],
+        }
+        with open((p := segm_ch_out_dir / DOWNSAMPLING_FILE_NAME), "w") as f:
+            print("Saving downsampling parameters to", p)
+            json.dump(downsampling_info, f, indent=4)
 
-    copy_segm_channels_to_out_dirs(ome_tiff, listing, segm_ch_ids, segm_ch_out_dir)
+    copy_segm_channels_to_out_dirs(
+        ome_tiff,
+        listing,
+        segm_ch_ids,
+        segm_ch_out_dir,
+        dtype,
+        num_workers,
+        normalize,
+        percentiles,
+        downsampling,
+    )
 
 
 if __name__ == "__main__":
@@ -123,6 +414,41 @@ if __name__ == "__main__":
         default=Path("/output"),
         help="path to the converted ome.tiff file",
     )
+    parser.add_argument(
+        "--dtype",
+        choices=ACCUMULATION_DTYPES,
+        default="input",
+        help="dtype of summed segmentation channels, sums saturate at its maximum",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of threads that read and sum chunks of channel pages",
+    )
+    parser.add_argument(
+        "--normalize",
+        choices=NORMALIZATION_DTYPES,
+        default="none",
+        help="rescale every segmentation channel between its percentiles to this dtype",
+    )
+    parser.add_argument(
+        "--normalize_percentiles",
+        type=float,
+        nargs=2,
+        default=NORMALIZATION_PERCENTILES,
+        metavar=("LOW", "HIGH"),
+        help="percentiles of nonzero pixels mapped to 0 and to the dtype maximum",
+    )
+    parser.add_argument(
+        "--target_pixel_size",
+        type=float,
+        default=None,
+        help=(
+            "segment at this pixel size, in the unit of the dataset pixel size: "
+            "channels are block-averaged by integer factors and masks are upsampled back"
+        ),
+    )
     args = parser.parse_args()
 
     main(
@@ -130,4 +456,9 @@ if __name__ == "__main__":
         pipeline_config_path=args.pipeline_config,
         ome_tiff=args.ome_tiff,
         output_dir=args.output_dir,
+        dtype=args.dtype,
+        num_workers=args.num_workers,
+        normalize=args.normalize,
+        percentiles=tuple(args.normalize_percentiles),
+        target_pixel_size=args.target_pixel_size,
     )
@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import List, Tuple
+
+# Layout shared with slicing/segmentation_cache.py, which looks up masks:
+# cache_dir/<method>/<key[:2]>/<key>/<mask file>.tiff
+# mtime of the entry directory is its last use, the oldest entries are evicted first
+
+
+def get_entry_dir(cache_dir: Path, method: str, key: str) -> Path:
+    return cache_dir / method / key[:2] / key
+
+
+def store_mask(cache_dir: Path, method: str, key: str, mask_path: Path) -> Path:
+    """Copies a segmentation mask tile into the cache. The entry is assembled
+    in a temporary directory and renamed into place, so readers never see
+    a partial entry. An entry that already exists is kept.
+    """
+    entry_dir = get_entry_dir(cache_dir, method, key)
+    if entry_dir.is_dir():
+        os.utime(entry_dir)
+        return entry_dir / mask_path.name
+    entry_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=".tmp_", dir=entry_dir.parent))
+    shutil.copyfile(mask_path, tmp_dir / mask_path.name)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # stored by a concurrent run in the meantime
+        shutil.rmtree(tmp_dir)
+    return entry_dir / mask_path.name
+
+
+def list_entries(cache_dir: Path) -> List[Tuple[float, int, Path]]:
+    """(last use, size in bytes, entry directory) of every cache entry"""
+    entries = []
+    for entry_dir in cache_dir.glob("*/*/*"):
+        if not entry_dir.is_dir() or entry_dir.name.startswith(".tmp_"):
+            continue
+        size = sum(f.stat().st_size for f in entry_dir.iterdir() if f.is_file())
+        entries.append((entry_dir.stat().st_mtime, size, entry_dir))
+    return entries
+
+
+def evict_to_size(cache_dir: Path, max_size_bytes: int) -> int:
+    """Removes least recently used entries until the cache fits into max_size_bytes,
+    returns number of removed entries
+    """
+    entries = sorted(list_entries(cache_dir), key=lambda e: e[0])
+    total_size = sum(size for _, size, _ in entries)
+    num_removed = 0
+    for _, size, entry_dir in entries:
+        if total_size <= max_size_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+        num_removed += 1
+    return num_removed
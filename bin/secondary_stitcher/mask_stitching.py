@@ -1,6 +1,6 @@
 import gc
 from copy import deepcopy
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import dask
 import numpy as np
@@ -9,6 +9,7 @@ from match_masks import get_matched_masks
 from skimage.measure import regionprops_table
 
 Image = np.ndarray
+SliceTable = List[Tuple[Tuple[slice, slice], Tuple[slice, slice]]]
 
 
 def generate_ome_meta_for_mask(size_y: int, size_x: int, dtype, match_fraction: float) -> str:
@@ -122,6 +123,9 @@ def remove_labels(
 
 
 def remove_overlapping_labels(img: Image, overlap: int, mode: str) -> Tuple[Image, List[int]]:
+    if img is None:
+        # empty tile, left out by the slicer
+        return img, []
     left = (slice(None), slice(None, overlap))
     right = (slice(None), slice(-overlap, None))
     top = (slice(None, overlap), slice(None))
@@ -184,6 +188,8 @@ def remove_overlapping_labels_in_another_channel(
     tiles: List[Image], excluded_labels: dict
 ) -> List[Image]:
     def exclude_labels(tile, labels):
+        if tile is None:
+            return tile
         for lab in labels:
             tile[tile == lab] = 0
         return tile
@@ -264,20 +270,27 @@ def find_and_replace_overlapping_border_labels_in_first_channel(
     for i in range(0, y_ntiles):
         for j in range(0, x_ntiles):
             tile = tiles[n]
+            if tile is None:
+                # empty tile has no labels to offset or to match with neighbours
+                tile_additions.append(previous_tile_max)
+                modified_tiles.append(None)
+                border_maps[n] = dict()
+                n += 1
+                continue
             tile = tile.astype(dtype)
             this_tile_max = tile.max()
             tile_additions.append(previous_tile_max)
             tile[np.nonzero(tile)] += previous_tile_max
 
-            if i != 0:
+            if i != 0 and modified_tiles[tile_ids[i - 1, j]] is not None:
                 top_tile_id = tile_ids[i - 1, j]
             else:
                 top_tile_id = None
-            if j != 0:
+            if j != 0 and modified_tiles[tile_ids[i, j - 1]] is not None:
                 left_tile_id = tile_ids[i, j - 1]
             else:
                 left_tile_id = None
-            if i != 0 and j != 0:
+            if i != 0 and j != 0 and modified_tiles[tile_ids[i - 1, j - 1]] is not None:
                 top_left_tile_id = tile_ids[i - 1, j - 1]
             else:
                 top_left_tile_id = None
@@ -310,6 +323,8 @@ def replace_overlapping_border_labels_in_another_channel(
     tiles: List[Image], border_maps: Dict[int, dict], tile_additions: List[int], dtype
 ) -> List[Image]:
     def replace_values(tile, value_map, tile_addition, dtype):
+        if tile is None:
+            return tile
         modified_tile = tile.astype(dtype)
         modified_tile[np.nonzero(modified_tile)] += tile_addition
         if value_map != {}:
@@ -451,6 +466,10 @@ def stitch_mask(
             )
 
             tile = tiles[n]
+            if tile is None:
+                # empty tile, this part of big image stays zero
+                n += 1
+                continue
             tile = tile.astype(dtype)
 
             mask_nonzeros = tile[tile_slice] != 0
@@ -461,14 +480,46 @@ def stitch_mask(
     return big_image[: new_big_image_shape[0], : new_big_image_shape[1]]
 
 
+def stitch_mask_from_slice_table(
+    tiles: List[Image],
+    image_shape: Tuple[int, int],
+    slice_table: SliceTable,
+    dtype,
+) -> Image:
+    """Places tiles with precomputed (tile slice, image slice) pairs from the
+    slicer tile manifest, slices are already clipped to the image so no padding is cropped
+    """
+    big_image = np.zeros(image_shape, dtype=dtype)
+    print("plane shape x,y:", image_shape[::-1])
+
+    for tile, (tile_slice, big_image_slice) in zip(tiles, slice_table):
+        if tile is None:
+            # empty tile, this part of big image stays zero
+            continue
+        tile = tile.astype(dtype)
+
+        mask_nonzeros = tile[tile_slice] != 0
+        big_image[big_image_slice][mask_nonzeros] = tile[tile_slice][mask_nonzeros]
+    return big_image
+
+
 def process_all_masks(
-    tiles, tile_shape, y_ntiles, x_ntiles, overlap, padding, dtype
+    tiles,
+    tile_shape,
+    y_ntiles,
+    x_ntiles,
+    overlap,
+    padding,
+    dtype,
+    slice_table: Optional[SliceTable] = None,
+    image_shape: Optional[Tuple[int, int]] = None,
 ) -> Tuple[List[Image], str]:
     print("Started processing masks")
-    tiles_cell = [t[0, :, :] for t in tiles]
-    tiles_nuc = [t[1, :, :] for t in tiles]
-    tiles_cell_b = [t[2, :, :] for t in tiles]
-    tiles_nuc_b = [t[3, :, :] for t in tiles]
+    # empty tiles left out by the slicer are None and stay None in every channel
+    tiles_cell = [t[0, :, :] if t is not None else None for t in tiles]
+    tiles_nuc = [t[1, :, :] if t is not None else None for t in tiles]
+    tiles_cell_b = [t[2, :, :] if t is not None else None for t in tiles]
+    tiles_nuc_b = [t[3, :, :] if t is not None else None for t in tiles]
     raw_tile_groups = [tiles_cell, tiles_nuc, tiles_cell_b, tiles_nuc_b]
     print("Identifying and trimming border labels in all tiles")
     (
@@ -513,9 +564,14 @@ def process_all_masks(
     print("Stitching masks")
     stitched_imgs = []
     for tile_group in mod_tile_groups:
-        stitched_img = stitch_mask(
-            tile_group, y_ntiles, x_ntiles, tile_shape, dtype, overlap, padding
-        )
+        if slice_table is None:
+            stitched_img = stitch_mask(
+                tile_group, y_ntiles, x_ntiles, tile_shape, dtype, overlap, padding
+            )
+        else:
+            stitched_img = stitch_mask_from_slice_table(
+                tile_group, image_shape, slice_table, dtype
+            )
         stitched_imgs.append(stitched_img)
 
     del mod_tile_groups
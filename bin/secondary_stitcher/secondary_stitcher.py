@@ -1,16 +1,19 @@
+import json
 import re
 import xml.etree.ElementTree as ET
 from itertools import chain
 from pathlib import Path
-from typing import Dict, Iterable, List, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
 import tifffile as tif
-from mask_stitching import process_all_masks
+from mask_stitching import generate_ome_meta_for_mask, process_all_masks
 from skimage.measure import regionprops_table
 
 Image = np.ndarray
+# tile size of masks upsampled back from downsampled segmentation
+UPSAMPLED_TILE_SIZE = 1024
 
 
 def add_structured_annotations(omexml_str: str, nucleus_channel: str, cell_channel: str) -> str:
@@ -123,34 +126,145 @@ def get_slices(
     return big_image_slice, tile_slice
 
 
-def get_dataset_info(img_dirs: Iterable[Path]):
+def get_shard_per_tile(shard_manifest: Optional[dict]) -> Dict[str, str]:
+    """Shard directory name of every tile from the slicer shard manifest"""
+    if shard_manifest is None:
+        return dict()
+    return {name: shard["name"] for shard in shard_manifest["shards"] for name in shard["tiles"]}
+
+
+def missing_tile_error(name: str, shard_per_tile: Dict[str, str]) -> ValueError:
+    if name in shard_per_tile:
+        return ValueError(
+            f"Tile {name} is missing and was not empty, "
+            f"check segmentation output of {shard_per_tile[name]}"
+        )
+    return ValueError(f"Tile {name} is missing and was not empty")
+
+
+def get_dataset_info(
+    img_dirs: Iterable[Path],
+    num_tiles: Optional[Dict[str, int]] = None,
+    empty_tiles: Iterable[str] = (),
+    shard_manifest: Optional[dict] = None,
+):
+    """Returns paths of tiles per region in row-major grid order.
+    Tiles that the slicer left out as empty have None instead of a path,
+    num_tiles from the slicer config is required to know the grid size then.
+    Tiles are collected from all img_dirs, with sharded slicing
+    the shard manifest names the shard of a missing tile.
+    """
     img_paths = get_img_listing(img_dirs)
+    if not img_paths and num_tiles is not None:
+        # every tile was left out as empty, there are no regions to list
+        return [], num_tiles["y"], num_tiles["x"]
     positions = [path_to_dict(p) for p in img_paths]
     df = pd.DataFrame(positions)
     df.sort_values(["R", "Y", "X"], inplace=True)
     df.reset_index(inplace=True)
 
     region_ids = list(df["R"].unique())
-    y_ntiles = df["Y"].max()
-    x_ntiles = df["X"].max()
+    if num_tiles is None:
+        y_ntiles = df["Y"].max()
+        x_ntiles = df["X"].max()
+    else:
+        y_ntiles = num_tiles["y"]
+        x_ntiles = num_tiles["x"]
+    empty_tiles = set(empty_tiles)
+    shard_per_tile = get_shard_per_tile(shard_manifest)
 
     path_list_per_region = []
 
     for r in region_ids:
-        region_selection = df[df["R"] == r].index
-        path_list = list(df.loc[region_selection, "path"])
+        region_selection = df[df["R"] == r]
+        path_per_position = dict(
+            zip(zip(region_selection["Y"], region_selection["X"]), region_selection["path"])
+        )
+        path_list = []
+        for y in range(1, y_ntiles + 1):
+            for x in range(1, x_ntiles + 1):
+                if (y, x) in path_per_position:
+                    path_list.append(path_per_position[(y, x)])
+                elif f"R{r}_X{x}_Y{y}" in empty_tiles:
+                    path_list.append(None)
+                else:
+                    raise missing_tile_error(f"R{r}_X{x}_Y{y}", shard_per_tile)
         path_list_per_region.append(path_list)
 
     return path_list_per_region, y_ntiles, x_ntiles
 
 
-def load_tiles(path_list: List[Path], key: Union[None, int]):
+def read_tile_manifest(path: Path) -> dict:
+    with open(path, "r") as s:
+        manifest = json.load(s)
+    return manifest
+
+
+def get_tile_key(path: Path) -> str:
+    """Tile name like R1_X1_Y1 from the start of a tile file name"""
+    return "_".join(path.name.split(".", 1)[0].split("_")[:3])
+
+
+def get_dataset_info_from_manifest(
+    img_dirs: Iterable[Path],
+    manifest: dict,
+    shard_manifest: Optional[dict] = None,
+    segmentation_cache_dir: Optional[Path] = None,
+):
+    """Same as get_dataset_info, but the grid comes from the slicer tile manifest:
+    tiles are taken in manifest order and matched to files by name,
+    without parsing grid positions from file names or sorting the listing.
+    Output directories of segmentation are still listed once, their names are not known.
+    Tiles with a mask in the segmentation cache are read from segmentation_cache_dir,
+    the manifest has their paths relative to it.
+    """
+    tile_names = {tile["name"] for tile in manifest["tiles"]}
+    shard_per_tile = get_shard_per_tile(shard_manifest)
+    path_per_name = dict()
+    for in_dir in img_dirs:
+        for path in in_dir.glob("**/*.tiff"):
+            if (key := get_tile_key(path)) in tile_names:
+                path_per_name[key] = path
+
+    path_list = []
+    for tile in manifest["tiles"]:
+        if tile["empty"]:
+            path_list.append(None)
+        elif tile.get("cached_mask") is not None:
+            if segmentation_cache_dir is None:
+                raise ValueError(
+                    f"Tile {tile['name']} has a mask in the segmentation cache, "
+                    "but no segmentation cache directory was given"
+                )
+            path_list.append(segmentation_cache_dir / tile["cached_mask"])
+        elif tile["name"] in path_per_name:
+            path_list.append(path_per_name[tile["name"]])
+        else:
+            raise missing_tile_error(tile["name"], shard_per_tile)
+
+    num_tiles = manifest["num_tiles"]
+    return [path_list], num_tiles["y"], num_tiles["x"]
+
+
+def get_slice_table(manifest: dict) -> List[Tuple[Tuple[slice, slice], Tuple[slice, slice]]]:
+    """(tile slice, stitched image slice) for every tile in manifest order"""
+    slice_table = []
+    for tile in manifest["tiles"]:
+        tile_slice = tuple(slice(*r) for r in tile["stitch"]["tile_slice"])
+        big_image_slice = tuple(slice(*r) for r in tile["stitch"]["image_slice"])
+        slice_table.append((tile_slice, big_image_slice))
+    return slice_table
+
+
+def load_tiles(path_list: List[Optional[Path]], key: Union[None, int]) -> List[Optional[Image]]:
+    """Tiles without path (left out as empty by the slicer) are returned as None"""
     tiles = []
-    if key is None:
-        for path in path_list:
+    for path in path_list:
+        if path is None:
+            tiles.append(None)
+        elif key is None:
             tiles.append(tif.imread(path_to_str(path)))
-    else:
-        for path in path_list:
+        else:
             tiles.append(tif.imread(path_to_str(path), key=key))
 
     return tiles
@@ -221,13 +335,89 @@ def stitch_plane(
                 big_image, hor_f, hor_t, ver_f, ver_t, padding, overlap
             )
             tile = tiles[n]
-
-            big_image[tuple(big_image_slice)] = tile[tuple(tile_slice)]
+            if tile is not None:
+                big_image[tuple(big_image_slice)] = tile[tuple(tile_slice)]
 
             n += 1
     return big_image
 
 
+def iter_upsampled_tiles(
+    mask: Image, factor: Tuple[int, int], out_shape: Tuple[int, int], tile_size: int
+) -> Iterator[Image]:
+    """Tiles of the mask upsampled by nearest neighbour and cut to out_shape,
+    in row-major order, so the full resolution mask is never held in memory
+    """
+    factor_y, factor_x = factor
+    for ver_f in range(0, out_shape[0], tile_size):
+        rows = np.arange(ver_f, min(ver_f + tile_size, out_shape[0])) // factor_y
+        for hor_f in range(0, out_shape[1], tile_size):
+            cols = np.arange(hor_f, min(hor_f + tile_size, out_shape[1])) // factor_x
+            yield mask[np.ix_(rows, cols)]
+
+
+def write_upsampled_mask(
+    TW: tif.TiffWriter, mask: Image, downsampling: dict, ome_meta: str, tile_size: int
+):
+    out_shape = tuple(downsampling["source_shape"])
+    TW.write(
+        iter_upsampled_tiles(mask, tuple(downsampling["factor"]), out_shape, tile_size),
+        shape=(1,) + out_shape,
+        dtype=mask.dtype,
+        tile=(tile_size, tile_size),
+        photometric="minisblack",
+        description=ome_meta,
+    )
+
+
+def write_mask(TW: tif.TiffWriter, mask: Image, ome_meta: str, downsampling: Optional[dict]):
+    if downsampling is not None:
+        write_upsampled_mask(TW, mask, downsampling, ome_meta, UPSAMPLED_TILE_SIZE)
+        return
+    new_shape = (1, mask.shape[0], mask.shape[1])
+    TW.write(
+        mask.reshape(new_shape),
+        contiguous=True,
+        photometric="minisblack",
+        description=ome_meta,
+    )
+
+
+def write_empty_masks(
+    out_dir: Path,
+    img_name_template: str,
+    is_mask: bool,
+    image_shape: Optional[Tuple[int, int]],
+    downsampling: Optional[dict],
+) -> dict:
+    """All-zero masks for a slide where the slicer left out every tile as empty,
+    e.g. a blank slide or a threshold above all intensities
+    """
+    if not is_mask:
+        raise ValueError("All tiles are empty, there are no expressions to stitch")
+    if image_shape is None:
+        raise ValueError(
+            "All tiles are empty, stitched image shape is only known from the tile manifest"
+        )
+    print("All tiles are empty, writing empty masks of shape", image_shape)
+    dtype = np.uint32
+    mask = np.zeros(image_shape, dtype=dtype)
+    report = dict()
+    out_shape = image_shape
+    if downsampling is not None:
+        out_shape = tuple(downsampling["source_shape"])
+        report["segmentation_downsampling"] = downsampling["factor"]
+    ome_meta = generate_ome_meta_for_mask(*out_shape, dtype, 0.0)
+    with tif.TiffWriter(
+        path_to_str(out_dir / img_name_template.format(r=1)), bigtiff=True, shaped=False
+    ) as TW:
+        # cells, nuclei, cell boundaries, nucleus boundaries
+        for _ in range(4):
+            write_mask(TW, mask, ome_meta, downsampling)
+    report.update(num_cells=0, num_nuclei=0, cell_coverage=0.0, nuclei_coverage=0.0)
+    return {"reg1": report}
+
+
 def main(
     img_dirs: Iterable[Path],
     out_dir: Path,
@@ -237,7 +427,16 @@ def main(
     is_mask: bool,
     nucleus_channel: str,
     cell_channel: str,
+    num_tiles: Optional[Dict[str, int]] = None,
+    empty_tiles: Iterable[str] = (),
+    tile_manifest: Optional[dict] = None,
+    shard_manifest: Optional[dict] = None,
+    downsampling: Optional[dict] = None,
+    segmentation_cache_dir: Optional[Path] = None,
 ):
+    """With downsampling from the slicer config, tiles were segmented at lower resolution
+    and stitched masks are upsampled by nearest neighbour to its source shape when written
+    """
     padding_int = [int(i) for i in padding_str.split(",")]
     padding = {
         "left": padding_int[0],
@@ -246,9 +445,25 @@ def main(
         "bottom": padding_int[3],
     }
 
-    path_list_per_region, y_ntiles, x_ntiles = get_dataset_info(img_dirs)
-
-    with tif.TiffFile(path_to_str(path_list_per_region[0][0])) as TF:
+    slice_table = None
+    image_shape = None
+    if tile_manifest is None:
+        path_list_per_region, y_ntiles, x_ntiles = get_dataset_info(
+            img_dirs, num_tiles, empty_tiles, shard_manifest
+        )
+    else:
+        path_list_per_region, y_ntiles, x_ntiles = get_dataset_info_from_manifest(
+            img_dirs, tile_manifest, shard_manifest, segmentation_cache_dir
+        )
+        slice_table = get_slice_table(tile_manifest)
+        image_shape = tuple(tile_manifest["image_shape"])
+
+    first_tile_path = next(
+        (p for p in chain.from_iterable(path_list_per_region) if p is not None), None
+    )
+    if first_tile_path is None:
+        return write_empty_masks(out_dir, img_name_template, is_mask, image_shape, downsampling)
+    with tif.TiffFile(path_to_str(first_tile_path)) as TF:
         tile_shape = list(TF.series[0].shape)
         npages = len(TF.pages)
         dtype = TF.series[0].dtype
@@ -279,16 +494,24 @@ def main(
             # mask channels 0 - cells, 1 - nuclei, 2 - cell boundaries, 3 - nucleus boundaries
             tiles = load_tiles(path_list, key=None)
             masks, ome_meta = process_all_masks(
-                tiles, tile_shape, y_ntiles, x_ntiles, overlap, padding, dtype
+                tiles,
+                tile_shape,
+                y_ntiles,
+                x_ntiles,
+                overlap,
+                padding,
+                dtype,
+                slice_table,
+                image_shape,
             )
+            if downsampling is not None:
+                source_y_size, source_x_size = downsampling["source_shape"]
+                ome_meta = re.sub(r'\sSizeY="\d+"', f' SizeY="{source_y_size}"', ome_meta)
+                ome_meta = re.sub(r'\sSizeX="\d+"', f' SizeX="{source_x_size}"', ome_meta)
+                print("Upsampling masks by (y, x):", downsampling["factor"])
+                this_region_report["segmentation_downsampling"] = downsampling["factor"]
             for mask in masks:
-                new_shape = (1, mask.shape[0], mask.shape[1])
-                TW.write(
-                    mask.reshape(new_shape),
-                    contiguous=True,
-                    photometric="minisblack",
-                    description=ome_meta,
-                )
+                write_mask(TW, mask, ome_meta, downsampling)
 
             this_region_report["num_cells"] = int(masks[0].max())
             this_region_report["num_nuclei"] = int(masks[1].max())
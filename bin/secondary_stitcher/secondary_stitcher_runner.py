@@ -1,8 +1,11 @@
 import argparse
 import json
+import os
 from pathlib import Path
 from pprint import pprint
-from typing import Any, Dict, Iterable
+from typing import Any, Dict, Iterable, Optional
+
+from mask_cache import evict_to_size, store_mask
 
 import secondary_stitcher
 
@@ -34,6 +37,12 @@ def run_stitcher(
     is_mask: bool,
     nucleus_channel: str,
     cell_channel: str,
+    num_tiles: Optional[Dict[str, int]] = None,
+    empty_tiles: Iterable[str] = (),
+    tile_manifest: Optional[dict] = None,
+    shard_manifest: Optional[dict] = None,
+    downsampling: Optional[dict] = None,
+    segmentation_cache_dir: Optional[Path] = None,
 ) -> Report:
     padding_str = ",".join((str(i) for i in list(padding.values())))
     report = secondary_stitcher.main(
@@ -45,10 +54,43 @@ def run_stitcher(
         is_mask,
         nucleus_channel,
         cell_channel,
+        num_tiles,
+        empty_tiles,
+        tile_manifest,
+        shard_manifest,
+        downsampling,
+        segmentation_cache_dir,
     )
     return report
 
 
+def update_segmentation_cache(
+    ometiff_dirs: Iterable[Path],
+    tile_manifest: dict,
+    cache_dir: Path,
+    method: str,
+    max_size_gb: float,
+):
+    """Stores masks of tiles that were segmented in this run, marks masks
+    taken from the cache as used and evicts least recently used masks beyond max_size_gb
+    """
+    path_list_per_region, _, _ = secondary_stitcher.get_dataset_info_from_manifest(
+        ometiff_dirs, tile_manifest, segmentation_cache_dir=cache_dir
+    )
+    num_stored = 0
+    for tile, path in zip(tile_manifest["tiles"], path_list_per_region[0]):
+        if tile.get("cached_mask") is not None:
+            # mark as recently used, the slicer may have seen the cache read-only
+            os.utime(path.parent)
+            continue
+        if path is None or tile.get("key") is None:
+            continue
+        store_mask(cache_dir, method, tile["key"], path)
+        num_stored += 1
+    num_evicted = evict_to_size(cache_dir, int(max_size_gb * 1024**3))
+    print("Segmentation cache: stored", num_stored, "masks, evicted", num_evicted)
+
+
 def merge_reports(mask_report: Report, expr_report: Report) -> Report:
     total_report = dict()
     for region in mask_report:
@@ -56,14 +98,32 @@ def merge_reports(mask_report: Report, expr_report: Report) -> Report:
     return total_report
 
 
-def main(pipeline_config_path: Path, ometiff_dirs: Iterable[Path]):
+def main(
+    pipeline_config_path: Path,
+    ometiff_dirs: Iterable[Path],
+    tile_manifest_path: Optional[Path] = None,
+    shard_manifest_path: Optional[Path] = None,
+    segmentation_cache_max_gb: float = 50,
+    segmentation_cache_dir: Optional[Path] = None,
+):
+    ometiff_dirs = ometiff_dirs or []
     pipeline_config = read_pipeline_config(pipeline_config_path)
+    tile_manifest = None
+    if tile_manifest_path is not None:
+        print("Using tile manifest", tile_manifest_path)
+        tile_manifest = secondary_stitcher.read_tile_manifest(tile_manifest_path)
+    shard_manifest = None
+    if shard_manifest_path is not None:
+        print("Using shard manifest", shard_manifest_path)
+        shard_manifest = secondary_stitcher.read_tile_manifest(shard_manifest_path)
     slicer_meta = pipeline_config["slicer"]
     nucleus_channel = pipeline_config.get("nuclei_channel", "None")
     cell_channel = pipeline_config.get("membrane_channel", "None")
 
     overlap = slicer_meta["overlap"]
     padding = slicer_meta["padding"]
+    num_tiles = slicer_meta["num_tiles"]
+    empty_tiles = slicer_meta.get("empty_tiles", [])
 
     mask_out_dir = Path("output/pipeline_output/mask")
     final_pipeline_config_path = Path("output/pipelineConfig.json")
@@ -81,8 +141,27 @@ def main(pipeline_config_path: Path, ometiff_dirs: Iterable[Path]):
         True,
         nucleus_channel,
         cell_channel,
+        num_tiles,
+        empty_tiles,
+        tile_manifest,
+        shard_manifest,
+        pipeline_config.get("segmentation_downsampling"),
+        segmentation_cache_dir,
     )
 
+    cache_meta = slicer_meta.get("segmentation_cache")
+    if cache_meta is not None and tile_manifest is not None:
+        if segmentation_cache_dir is None:
+            print("No segmentation cache directory given, new masks are not cached")
+        else:
+            update_segmentation_cache(
+                ometiff_dirs,
+                tile_manifest,
+                segmentation_cache_dir,
+                cache_meta["method"],
+                segmentation_cache_max_gb,
+            )
+
     final_pipeline_config = pipeline_config
     final_pipeline_config.update({"report": mask_report})
     print("\nfinal_pipeline_config")
@@ -100,5 +179,41 @@ if __name__ == "__main__":
         action="append",
     )
 
+    parser.add_argument(
+        "--tile_manifest_path",
+        type=Path,
+        help="tile manifest written by the slicer, grid and tile placement are taken from it",
+    )
+
+    parser.add_argument(
+        "--shard_manifest_path",
+        type=Path,
+        help="shard manifest written by the slicer when tiles are grouped into shards",
+    )
+
+    parser.add_argument(
+        "--segmentation_cache_max_gb",
+        type=float,
+        default=50,
+        help="size of the segmentation cache after new masks are added, oldest are removed",
+    )
+
+    parser.add_argument(
+        "--segmentation_cache_dir",
+        type=Path,
+        default=None,
+        help=(
+            "segmentation cache given to the slicer, cached masks are read from it "
+            "and masks of newly segmented tiles are added to it"
+        ),
+    )
+
     args = parser.parse_args()
-    main(args.pipeline_config_path, args.ometiff_dir)
+    main(
+        args.pipeline_config_path,
+        args.ometiff_dir,
+        args.tile_manifest_path,
+        args.shard_manifest_path,
+        args.segmentation_cache_max_gb,
+        args.segmentation_cache_dir,
+    )
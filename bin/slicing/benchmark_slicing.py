@@ -0,0 +1,343 @@
+"""Micro-benchmarks of the slicer on synthetic slides.
+
+Example:
+    python bin/slicing/benchmark_slicing.py --grids 10 30 60 --tile_size 512 \
+        --out slicing_benchmark.json --baseline slicing_baseline.json
+
+Every case runs in a fresh process, so peak RSS belongs to that case only.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import tifffile as tif
+from run_slicing import split_channels_into_tiles
+from slicer import (
+    READ_MODES,
+    get_tile,
+    get_tile_grid,
+    open_image,
+    slice_img,
+    split_by_size,
+)
+
+BENCHMARKS = ("get_tile", "split_by_size", "slice_img", "split_channels_into_tiles")
+CHANNELS = ("nucleus", "cell")
+RESULT_KEYS = ("name", "grid", "tile_size", "overlap", "read_mode", "layout")
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == "Darwin":
+        peak /= 1024
+    return peak / 1024
+
+
+def generate_strips(shape, seed: int, strip_height: int):
+    """Yields row strips of a synthetic slide: uniform noise inside
+    an elliptical tissue region, zero background outside of it
+    """
+    height, width = shape
+    rng = np.random.default_rng(seed)
+    xx = (np.arange(width) - width / 2) / (width * 0.45)
+    for row_f in range(0, height, strip_height):
+        rows = np.arange(row_f, min(row_f + strip_height, height))
+        yy = (rows - height / 2) / (height * 0.45)
+        tissue = yy[:, None] ** 2 + xx[None, :] ** 2 <= 1
+        strip = rng.integers(1, 2**16, size=tissue.shape, dtype=np.uint16)
+        strip[~tissue] = 0
+        yield strip
+
+
+def generate_tiles(shape, seed: int, tile_shape):
+    tile_h, tile_w = tile_shape
+    for strip in generate_strips(shape, seed, tile_h):
+        strip = np.pad(strip, ((0, tile_h - strip.shape[0]), (0, (-strip.shape[1]) % tile_w)))
+        for col_f in range(0, strip.shape[1], tile_w):
+            yield strip[:, col_f : col_f + tile_w]
+
+
+def make_synthetic_slide(out_path: Path, shape, seed: int = 0, layout: str = "contiguous"):
+    """Writes a uint16 slide without holding it in memory.
+    contiguous: uncompressed and memory-mappable, tiled: 512 x 512 zlib-compressed tiles
+    """
+    if layout == "contiguous":
+        arr = tif.memmap(out_path, shape=shape, dtype=np.uint16, photometric="minisblack")
+        row_f = 0
+        for strip in generate_strips(shape, seed, 1024):
+            arr[row_f : row_f + strip.shape[0]] = strip
+            row_f += strip.shape[0]
+        arr.flush()
+        del arr
+    elif layout == "tiled":
+        tile_shape = (512, 512)
+        tif.imwrite(
+            out_path,
+            generate_tiles(shape, seed, tile_shape),
+            shape=shape,
+            dtype=np.uint16,
+            tile=tile_shape,
+            compression="zlib",
+            photometric="minisblack",
+        )
+    else:
+        raise ValueError(f"Unknown slide layout {layout!r}")
+
+
+def make_slides(data_dir: Path, ntiles: int, tile_size: int, layout: str) -> Path:
+    """One slide per segmentation channel, named like the output of
+    prepare_segmentation_channels, so that run_slicing can pick them up
+    """
+    slide_dir = data_dir / f"slides_{ntiles}x{ntiles}_{tile_size}_{layout}"
+    if slide_dir.exists():
+        return slide_dir
+    slide_dir.mkdir(parents=True)
+    # last row and column are partial, like on a real slide
+    size = ntiles * tile_size - tile_size // 3
+    for seed, channel_name in enumerate(CHANNELS):
+        make_synthetic_slide(slide_dir / f"img_{channel_name}.tif", (size, size), seed, layout)
+    return slide_dir
+
+
+def run_case(name: str, slide_dir: Path, tile_size: int, overlap: int, read_mode: str) -> dict:
+    """Runs one benchmark, returns number of tiles and bytes of tile data"""
+    in_path = slide_dir / f"img_{CHANNELS[0]}.tif"
+    out_dir = Path(tempfile.mkdtemp(prefix="tiles_", dir=slide_dir.parent))
+    num_tiles = 0
+    num_bytes = 0
+    try:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            if name == "get_tile":
+                arr = open_image(in_path, read_mode)
+                grid, _, _ = get_tile_grid(arr.shape[1], arr.shape[0], tile_size, tile_size)
+                for _, window in grid:
+                    # memmap tiles are views, copy them to read the pixels
+                    tile = np.array(get_tile(arr, *window, overlap))
+                    num_tiles += 1
+                    num_bytes += tile.nbytes
+            elif name == "split_by_size":
+                arr = open_image(in_path, read_mode)
+                for tile, _ in split_by_size(arr, CHANNELS[0], tile_size, tile_size, overlap):
+                    tile = np.array(tile)
+                    num_tiles += 1
+                    num_bytes += tile.nbytes
+            elif name == "slice_img":
+                stats = slice_img(
+                    in_path, out_dir, tile_size, overlap, 1, CHANNELS[0], read_mode, resume=False
+                )
+                num_tiles = stats["num_tiles"]
+                num_bytes = stats["num_bytes"]
+            elif name == "split_channels_into_tiles":
+                occupancy, _, _ = split_channels_into_tiles(
+                    slide_dir,
+                    out_dir,
+                    tile_size,
+                    overlap,
+                    read_mode,
+                    num_workers=len(CHANNELS),
+                    resume=False,
+                )
+                num_tiles = sum(len(o) for o in occupancy.values())
+                num_bytes = (
+                    num_tiles * (tile_size + overlap * 2) ** 2 * np.dtype(np.uint16).itemsize
+                )
+            else:
+                raise ValueError(f"Unknown benchmark {name!r}, expected one of {BENCHMARKS}")
+    finally:
+        shutil.rmtree(out_dir)
+    return {"num_tiles": num_tiles, "num_bytes": num_bytes}
+
+
+def run_case_in_process(queue, name, slide_dir, tile_size, overlap, read_mode):
+    start = time.perf_counter()
+    counts = run_case(name, slide_dir, tile_size, overlap, read_mode)
+    seconds = time.perf_counter() - start
+    queue.put({**counts, "seconds": seconds, "peak_rss_mb": get_peak_rss_mb()})
+
+
+def measure(name: str, slide_dir: Path, tile_size: int, overlap: int, read_mode: str) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(
+        target=run_case_in_process, args=(queue, name, slide_dir, tile_size, overlap, read_mode)
+    )
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Benchmark {name} failed with exit code {process.exitcode}")
+    result = queue.get()
+    seconds = max(result["seconds"], 1e-9)
+    result["mb_per_s"] = result["num_bytes"] / 1e6 / seconds
+    result["tiles_per_s"] = result["num_tiles"] / seconds
+    return result
+
+
+def get_result_key(result: dict) -> tuple:
+    return tuple(result[k] for k in RESULT_KEYS)
+
+
+def compare_to_baseline(results: List[dict], baseline: List[dict], tolerance: float) -> List[dict]:
+    """Time ratio of every case to the same case in baseline,
+    cases slower than baseline by more than tolerance are marked as regressions
+    """
+    baseline_per_key = {get_result_key(r): r for r in baseline}
+    comparison = []
+    for result in results:
+        base = baseline_per_key.get(get_result_key(result))
+        if base is None:
+            continue
+        ratio = result["seconds"] / max(base["seconds"], 1e-9)
+        comparison.append(
+            {
+                **{k: result[k] for k in RESULT_KEYS},
+                "baseline_seconds": base["seconds"],
+                "seconds": result["seconds"],
+                "time_ratio": ratio,
+                "peak_rss_ratio": result["peak_rss_mb"] / max(base["peak_rss_mb"], 1e-9),
+                "regression": ratio > 1 + tolerance,
+            }
+        )
+    return comparison
+
+
+def print_result(result: dict):
+    print(
+        "{name:<26} grid: {grid:>5} | time, s: {seconds:8.3f} | MB/s: {mb_per_s:8.1f}"
+        " | tiles/s: {tiles_per_s:8.1f} | peak RSS, MB: {peak_rss_mb:8.1f}".format(**result)
+    )
+
+
+def print_comparison(comparison: List[dict]):
+    for c in comparison:
+        print(
+            "{name:<26} grid: {grid:>5} | baseline, s: {baseline_seconds:8.3f}"
+            " | now, s: {seconds:8.3f} | time ratio: {time_ratio:5.2f}"
+            " | peak RSS ratio: {peak_rss_ratio:5.2f}".format(**c),
+            "| REGRESSION" if c["regression"] else "",
+        )
+
+
+def main(
+    out_path: Path,
+    grids: List[int],
+    tile_size: int,
+    overlap: int,
+    read_mode: str,
+    layout: str,
+    benchmarks: List[str],
+    data_dir: Optional[Path] = None,
+    baseline_path: Optional[Path] = None,
+    tolerance: float = 0.1,
+) -> bool:
+    """Returns False if any case regressed against baseline"""
+    keep_data = data_dir is not None
+    if data_dir is None:
+        data_dir = Path(tempfile.mkdtemp(prefix="slicing_benchmark_"))
+    data_dir.mkdir(exist_ok=True, parents=True)
+
+    results = []
+    try:
+        for ntiles in grids:
+            print("Generating", f"{ntiles}x{ntiles}", "tile slides of", layout, "layout")
+            slide_dir = make_slides(data_dir, ntiles, tile_size, layout)
+            for name in benchmarks:
+                result = {
+                    "name": name,
+                    "grid": f"{ntiles}x{ntiles}",
+                    "tile_size": tile_size,
+                    "overlap": overlap,
+                    "read_mode": read_mode,
+                    "layout": layout,
+                    **measure(name, slide_dir, tile_size, overlap, read_mode),
+                }
+                print_result(result)
+                results.append(result)
+    finally:
+        if not keep_data:
+            shutil.rmtree(data_dir)
+
+    report: Dict[str, object] = {
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    ok = True
+    if baseline_path is not None:
+        with open(baseline_path, "r") as s:
+            baseline = json.load(s)["results"]
+        comparison = compare_to_baseline(results, baseline, tolerance)
+        print("\nComparison to baseline", baseline_path)
+        print_comparison(comparison)
+        report["baseline"] = str(baseline_path)
+        report["comparison"] = comparison
+        ok = not any(c["regression"] for c in comparison)
+
+    with open(out_path, "w") as s:
+        json.dump(report, s, indent=4)
+    print("Saved benchmark results to", out_path)
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", type=Path, default=Path("slicing_benchmark.json"))
+    parser.add_argument(
+        "--grids",
+        type=int,
+        nargs="+",
+        default=[10, 30, 60],
+        help="number of tiles along each side of the synthetic slide",
+    )
+    parser.add_argument("--tile_size", type=int, default=512)
+    parser.add_argument("--tile_overlap", type=int, default=50)
+    parser.add_argument("--read_mode", choices=READ_MODES, default="windowed")
+    parser.add_argument(
+        "--layout",
+        choices=("contiguous", "tiled"),
+        default="contiguous",
+        help="contiguous: memory-mappable slide, tiled: zlib-compressed 512 x 512 tiles",
+    )
+    parser.add_argument("--benchmarks", choices=BENCHMARKS, nargs="+", default=list(BENCHMARKS))
+    parser.add_argument(
+        "--data_dir",
+        type=Path,
+        default=None,
+        help="keep synthetic slides here and reuse them in later runs, temporary dir by default",
+    )
+    parser.add_argument(
+        "--baseline", type=Path, default=None, help="results file of an earlier run"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="relative slowdown against baseline that is reported as regression",
+    )
+    args = parser.parse_args()
+
+    ok = main(
+        args.out,
+        args.grids,
+        args.tile_size,
+        args.tile_overlap,
+        args.read_mode,
+        args.layout,
+        args.benchmarks,
+        args.data_dir,
+        args.baseline,
+        args.tolerance,
+    )
+    if not ok:
+        raise SystemExit(1)
@@ -0,0 +1,74 @@
+import os
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import tifffile as tif
+from tiff_pages import (
+    get_channel_page_indices,
+    get_dtype_limits,
+    get_wide_dtype,
+    open_page_reader,
+)
+
+# Same page selection and saturating sum as prepare_segmentation_channels.py,
+# but per window, so that tiles can be cut from the OME-TIFF without writing
+# full-size segmentation channel images first
+
+
+class ChannelSum:
+    """Read-only 2D array-like: saturating sum of a few pages of a TIFF file.
+    Slicing it reads and sums only the requested window of every page,
+    so it can be passed to slicer.get_tile like a memory-mapped image.
+    Pages are opened on first access, so the object can be sent to another process.
+    """
+
+    def __init__(self, path: Path, page_indices: List[int], dtype: Optional[str] = None):
+        self.path = Path(path)
+        self.page_indices = list(page_indices)
+        with tif.TiffFile(self.path) as TF:
+            page = TF.pages[self.page_indices[0]]
+            self.shape = tuple(page.shape[-2:])
+            in_dtype = page.dtype
+        self.dtype = in_dtype if dtype in (None, "input") else np.dtype(dtype)
+        self._readers = None
+
+    def _open(self):
+        return [open_page_reader(self.path, page_index) for page_index in self.page_indices]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_readers"] = None
+        return state
+
+    def __getitem__(self, key) -> np.ndarray:
+        if self._readers is None:
+            self._readers = self._open()
+        acc = np.asarray(self._readers[0][key], dtype=get_wide_dtype(self.dtype))
+        for reader in self._readers[1:]:
+            acc += np.asarray(reader[key])
+        return np.clip(acc, *get_dtype_limits(self.dtype)).astype(self.dtype)
+
+    def get_source_info(self) -> dict:
+        """Identifies the input for the slicing journal"""
+        stat = os.stat(self.path)
+        name = f"{self.path.name}:pages={self.page_indices}:{self.dtype}"
+        return {name: [stat.st_size, stat.st_mtime_ns]}
+
+    def __repr__(self):
+        return f"ChannelSum({self.path.name}, pages={self.page_indices}, dtype={self.dtype})"
+
+
+def open_segmentation_channels(
+    ome_tiff: Path, segm_ch_ids: Dict[str, List[int]], dtype: Optional[str] = None
+) -> Dict[str, ChannelSum]:
+    with tif.TiffFile(ome_tiff) as TF:
+        series = TF.series[0]
+        if len(series.shape) < 3:
+            raise ValueError("Input image is not multichannel")
+        page_indices = {
+            ch_name: get_channel_page_indices(series, ids) for ch_name, ids in segm_ch_ids.items()
+        }
+    return {
+        ch_name: ChannelSum(ome_tiff, indices, dtype) for ch_name, indices in page_indices.items()
+    }
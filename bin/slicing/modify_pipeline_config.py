@@ -6,7 +6,10 @@ import yaml
 
 
 def generate_slicer_info(
-    tile_shape_no_overlap: Tuple[int, int], overlap: int, stitched_img_shape: Tuple[int, int]
+    tile_shape_no_overlap: Tuple[int, int],
+    overlap: int,
+    stitched_img_shape: Tuple[int, int],
+    tile_layout: str = "fixed",
 ) -> dict:
     slicer_info = dict()
     slicer_info["slicer"] = dict()
@@ -33,6 +36,7 @@ def generate_slicer_info(
         else (img_height // tile_height) + 1
     )
 
+    slicer_info["slicer"]["tile_layout"] = tile_layout
     slicer_info["slicer"]["padding"] = padding
     slicer_info["slicer"]["overlap"] = overlap
     slicer_info["slicer"]["num_tiles"] = {"x": x_ntiles, "y": y_ntiles}
@@ -64,16 +68,24 @@ def add_slicer_config(exp, slicer_info):
     return exp
 
 
+def read_pipeline_config(path_to_config: Path) -> dict:
+    with open(path_to_config, "r") as s:
+        config = yaml.safe_load(s)
+    return config
+
+
 def modify_pipeline_config(
     path_to_config: Path,
     tile_shape_no_overlap: Tuple[int, int],
     overlap: int,
     stitched_img_shape: Tuple[int, int],
+    tile_layout: str = "fixed",
 ):
-    with open(path_to_config, "r") as s:
-        config = yaml.safe_load(s)
+    config = read_pipeline_config(path_to_config)
 
-    slicer_info = generate_slicer_info(tile_shape_no_overlap, overlap, stitched_img_shape)
+    slicer_info = generate_slicer_info(
+        tile_shape_no_overlap, overlap, stitched_img_shape, tile_layout
+    )
     config = add_slicer_config(config, slicer_info)
     config.update(slicer_info)
 
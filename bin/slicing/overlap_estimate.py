@@ -0,0 +1,137 @@
+import math
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+from scipy import ndimage
+from skimage.filters import threshold_otsu
+from slicer import get_tile, open_image
+
+SAMPLE_WINDOW_SIZE = 1024
+NUM_SAMPLE_WINDOWS = 16
+# windows with less tissue than this are not sampled
+MIN_WINDOW_NONZERO_FRACTION = 0.05
+# objects smaller than this are noise, not nuclei
+MIN_NUCLEUS_AREA = 9
+NUCLEUS_SIZE_PERCENTILE = 99
+# segmented cells extend beyond the nucleus, cell diameter is taken as twice the nucleus one
+CELL_TO_NUCLEUS_RATIO = 2.0
+SAFETY_MARGIN = 1.25
+# no cell is larger than this, merged nuclei above it do not inflate the overlap
+MAX_CELL_DIAMETER_UM = 80
+MIN_OVERLAP = 8
+
+UNIT_TO_UM = {"nm": 1e-3, "µm": 1.0, "um": 1.0, "micron": 1.0, "mm": 1e3}
+
+
+def get_pixel_size_um(pixel_size: Optional[float], pixel_unit: Optional[str]) -> Optional[float]:
+    if pixel_size is None or pixel_unit not in UNIT_TO_UM:
+        return None
+    return float(pixel_size) * UNIT_TO_UM[pixel_unit]
+
+
+def get_sample_windows(
+    img_shape: Tuple[int, int], window_size: int, num_windows: int
+) -> List[Tuple[int, int, int, int]]:
+    """Windows (hor_f, hor_t, ver_f, ver_t) evenly spread over the image"""
+    img_height, img_width = img_shape
+    n_per_side = max(1, math.isqrt(num_windows))
+    window_h = min(window_size, img_height)
+    window_w = min(window_size, img_width)
+    ver_fs = np.linspace(0, img_height - window_h, n_per_side).astype(int)
+    hor_fs = np.linspace(0, img_width - window_w, n_per_side).astype(int)
+    windows = {(h, h + window_w, v, v + window_h) for v in ver_fs for h in hor_fs}
+    return sorted(windows, key=lambda w: (w[2], w[0]))
+
+
+def measure_nucleus_sizes(window: np.ndarray) -> np.ndarray:
+    """Largest bounding box side of every nucleus found by Otsu thresholding
+    and connected components. Nuclei cut by the window border are left out.
+    """
+    nonzero = window[window > 0]
+    if nonzero.size == 0:
+        return np.empty(0, dtype=int)
+    if nonzero.min() == nonzero.max():
+        # already binary, e.g. after thresholding
+        foreground = window > 0
+    else:
+        foreground = window > threshold_otsu(nonzero)
+    labels, num_labels = ndimage.label(foreground)
+    if num_labels == 0:
+        return np.empty(0, dtype=int)
+    border_labels = np.unique(np.concatenate((labels[0], labels[-1], labels[:, 0], labels[:, -1])))
+    areas = np.bincount(labels.ravel(), minlength=num_labels + 1)
+    sizes = []
+    for label, bbox in enumerate(ndimage.find_objects(labels), start=1):
+        if bbox is None or label in border_labels or areas[label] < MIN_NUCLEUS_AREA:
+            continue
+        sizes.append(max(s.stop - s.start for s in bbox))
+    return np.array(sizes, dtype=int)
+
+
+def estimate_overlap(
+    nucleus_img_path: Path,
+    pixel_size: Optional[float],
+    pixel_unit: Optional[str],
+    fallback_overlap: int,
+    window_size: int = SAMPLE_WINDOW_SIZE,
+    num_windows: int = NUM_SAMPLE_WINDOWS,
+) -> Tuple[int, dict]:
+    """Smallest tile overlap that fits the largest expected cell, so that the stitcher
+    can remove every label that touches the tile border. Nucleus sizes are measured
+    on a few windows of the nucleus channel, a high percentile is scaled
+    to cell size with a safety margin. The pixel size caps the overlap at the size
+    of the largest plausible cell. If no nuclei are found fallback_overlap is kept.
+    Returns overlap in pixels and the measurements it is based on.
+    """
+    arr = open_image(nucleus_img_path, "windowed")
+    img_shape = arr.shape[-2:]
+    windows = get_sample_windows(img_shape, window_size, num_windows)
+    sizes = []
+    num_sampled = 0
+    for window in windows:
+        tile = get_tile(arr, *window)
+        if np.count_nonzero(tile) / tile.size < MIN_WINDOW_NONZERO_FRACTION:
+            continue
+        num_sampled += 1
+        sizes.append(measure_nucleus_sizes(tile))
+    sizes = np.concatenate(sizes) if sizes else np.empty(0, dtype=int)
+
+    pixel_size_um = get_pixel_size_um(pixel_size, pixel_unit)
+    justification = {
+        "method": "nucleus_size",
+        "sampled_windows": num_sampled,
+        "window_size": window_size,
+        "nuclei_measured": int(sizes.size),
+        "pixel_size_x": pixel_size,
+        "pixel_unit_x": pixel_unit,
+    }
+    if sizes.size == 0:
+        justification["reason"] = "no nuclei found in sampled windows, kept --tile_overlap"
+        justification["overlap"] = fallback_overlap
+        return fallback_overlap, justification
+
+    nucleus_size = float(np.percentile(sizes, NUCLEUS_SIZE_PERCENTILE))
+    cell_size = nucleus_size * CELL_TO_NUCLEUS_RATIO
+    overlap = max(MIN_OVERLAP, math.ceil(cell_size * SAFETY_MARGIN))
+    justification.update(
+        {
+            "nucleus_size_percentile": NUCLEUS_SIZE_PERCENTILE,
+            "nucleus_size_px": nucleus_size,
+            "cell_to_nucleus_ratio": CELL_TO_NUCLEUS_RATIO,
+            "safety_margin": SAFETY_MARGIN,
+        }
+    )
+    if pixel_size_um is not None:
+        justification["nucleus_size_um"] = nucleus_size * pixel_size_um
+        max_overlap = math.ceil(MAX_CELL_DIAMETER_UM / pixel_size_um)
+        if overlap > max_overlap:
+            justification["capped_at_max_cell_diameter_um"] = MAX_CELL_DIAMETER_UM
+            overlap = max(MIN_OVERLAP, max_overlap)
+    justification["reason"] = (
+        "overlap fits a cell of {:.1f} px, {} x {}th percentile of nucleus size".format(
+            cell_size, CELL_TO_NUCLEUS_RATIO, NUCLEUS_SIZE_PERCENTILE
+        )
+    )
+    justification["overlap"] = overlap
+    return overlap, justification
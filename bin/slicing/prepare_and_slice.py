@@ -0,0 +1,46 @@
+import argparse
+from pathlib import Path
+
+from channel_pages import open_segmentation_channels
+from modify_pipeline_config import read_pipeline_config
+from run_slicing import add_slicing_arguments, check_slicing_arguments, main_from_args
+from tiff_pages import ACCUMULATION_DTYPES
+
+
+def main(ome_tiff: Path, dtype: str, args: argparse.Namespace):
+    """Same tiles as prepare_segmentation_channels.py followed by run_slicing.py,
+    but every tile window is read from the OME-TIFF pages and summed on the fly,
+    without full-size segmentation channel images in between
+    """
+    pipeline_config = read_pipeline_config(args.pipeline_config_path)
+    segm_ch_ids = pipeline_config["segmentation_channel_ids"]
+    for segm_type, channel_indexes in segm_ch_ids.items():
+        print(segm_type, "segmentation channels:")
+        for channel_index in channel_indexes:
+            print("\t", pipeline_config["channel_names"][channel_index], sep="")
+
+    channels = open_segmentation_channels(ome_tiff, segm_ch_ids, dtype)
+    for ch_name, channel in channels.items():
+        print("channel:", ch_name, "| shape:", channel.shape, "| dtype:", channel.dtype)
+    main_from_args(channels, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--ome_tiff",
+        type=Path,
+        required=True,
+        help="multichannel OME-TIFF to cut segmentation channel tiles from",
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=ACCUMULATION_DTYPES,
+        default="input",
+        help="dtype of summed segmentation channels, sums saturate at its maximum",
+    )
+    add_slicing_arguments(parser)
+    args = parser.parse_args()
+    check_slicing_arguments(parser, args)
+
+    main(args.ome_tiff, args.dtype, args)
@@ -1,14 +1,54 @@
 import argparse
 import json
+import os
 import re
+import shutil
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import tifffile as tif
-from modify_pipeline_config import modify_pipeline_config
-from slicer import slice_img
+from modify_pipeline_config import modify_pipeline_config, read_pipeline_config
+from overlap_estimate import estimate_overlap
+from segmentation_cache import get_tile_key, lookup_mask
+from slicer import (
+    MULTICHANNEL_TILE_SUFFIX,
+    OUTPUT_MODES,
+    READ_MODES,
+    estimate_slicing_memory,
+    fill_empty_tiles,
+    is_empty_tile,
+    slice_img,
+    slice_img_multichannel,
+)
+from tile_manifest import TILE_MANIFEST_NAME, build_tile_manifest, save_tile_manifest
+from tile_shards import (
+    SHARD_MANIFEST_NAME,
+    assign_tiles_to_shards,
+    build_shard_manifest,
+    estimate_tile_work,
+    move_tiles_into_shards,
+    print_shard_balance,
+    save_shard_manifest,
+    unshard_tiles,
+)
+from tile_size import choose_tile_size, print_tiling_estimate
+from tile_store import TILE_STORE_NAME, write_tile_store
+from tiling import TILE_LAYOUTS, TILINGS, get_balanced_tile_shape
+
+# path to a channel image or an opened array-like image, see slicer.open_image
+ChannelImage = Union[Path, Any]
 
 filename_pattern = re.compile(r"^(?P<label>.+)_(?P<channel>\w+)\.tif$")
+# written by prepare_segmentation_channels.py next to the channel images,
+# copied into pipelineConfig.json under these keys
+SEGMENTATION_CHANNEL_SIDECARS = {
+    "segmentation_channel_normalization.json": "segmentation_channel_normalization",
+    "segmentation_downsampling.json": "segmentation_downsampling",
+}
+# nucleus first, then cell, then anything else in file name order
+multichannel_order = ("nucleus", "cell")
 
 
 def path_to_str(path: Path):
@@ -43,59 +83,486 @@ def get_stitched_image_shape(directory: Path) -> Tuple[int, int]:
     return stitched_image_shape
 
 
+def print_slicing_throughput(channel_name: str, stats: dict):
+    seconds = max(stats["seconds"], 1e-9)
+    print(
+        "channel:",
+        channel_name,
+        "| tiles:",
+        stats["num_tiles"],
+        "| resumed:",
+        stats.get("num_resumed", 0),
+        "| time, s: {:.2f}".format(stats["seconds"]),
+        "| MB/s: {:.1f}".format(stats["num_bytes"] / 1e6 / seconds),
+        "| tiles/s: {:.1f}".format(stats["num_tiles"] / seconds),
+    )
+
+
+def get_num_concurrent_channels(
+    channel_paths: List[Path],
+    tile_size: int,
+    overlap: int,
+    read_mode: str,
+    num_workers: int,
+    memory_budget_gb: Optional[float],
+) -> int:
+    num_concurrent = max(1, min(num_workers, len(channel_paths)))
+    if memory_budget_gb is not None and channel_paths:
+        per_channel = max(
+            estimate_slicing_memory(p, tile_size, overlap, read_mode) for p in channel_paths
+        )
+        fits_in_budget = int(memory_budget_gb * 1024**3 // per_channel)
+        print(
+            "Estimated memory per channel, GB: {:.2f}".format(per_channel / 1024**3),
+            "| channels that fit into budget:",
+            fits_in_budget,
+        )
+        num_concurrent = max(1, min(num_concurrent, fits_in_budget))
+    return num_concurrent
+
+
+def get_channel_paths(input_dir: Path) -> Dict[str, Path]:
+    channels = dict()
+    for file_path in sorted(input_dir.iterdir()):
+        if m := filename_pattern.match(file_path.name):
+            channels[m.group("channel")] = file_path
+    return channels
+
+
+def get_channels(
+    segmentation_channels: Union[Path, Dict[str, ChannelImage]],
+) -> Dict[str, ChannelImage]:
+    """Channel images by channel name: from a directory with one image per channel
+    or already opened, e.g. channel_pages.ChannelSum read straight from the OME-TIFF
+    """
+    if isinstance(segmentation_channels, dict):
+        return segmentation_channels
+    return get_channel_paths(segmentation_channels)
+
+
+def read_segmentation_channel_sidecars(
+    segmentation_channels: Union[Path, Dict[str, ChannelImage]],
+) -> Dict[str, dict]:
+    """Parameters that prepare_segmentation_channels.py saved next to the channel images,
+    by pipeline config key
+    """
+    sidecars = dict()
+    if isinstance(segmentation_channels, dict):
+        return sidecars
+    for file_name, config_key in SEGMENTATION_CHANNEL_SIDECARS.items():
+        if (sidecar_path := segmentation_channels / file_name).is_file():
+            with open(sidecar_path) as f:
+                sidecars[config_key] = json.load(f)
+    return sidecars
+
+
+def get_ordered_channel_paths(
+    segmentation_channels: Union[Path, Dict[str, ChannelImage]],
+) -> Dict[str, ChannelImage]:
+    channels = get_channels(segmentation_channels)
+    channel_order = sorted(
+        channels,
+        key=lambda c: multichannel_order.index(c) if c in multichannel_order else 2,
+    )
+    return {c: channels[c] for c in channel_order}
+
+
+def split_channels_into_tile_store(
+    segmentation_channels: Union[Path, Dict[str, ChannelImage]],
+    store_path: Path,
+    tile_size=1000,
+    overlap=50,
+    read_mode="windowed",
+    empty_tile_threshold=None,
+) -> Tuple[List[str], dict, List[str]]:
+    channels = get_ordered_channel_paths(segmentation_channels)
+    stats = write_tile_store(
+        channels,
+        store_path,
+        tile_size=tile_size,
+        overlap=overlap,
+        read_mode=read_mode,
+        empty_tile_threshold=empty_tile_threshold,
+    )
+    print_slicing_throughput("+".join(channels), stats)
+    return list(channels), stats["occupancy"], stats["empty_tiles"]
+
+
+def split_channels_into_multichannel_tiles(
+    segmentation_channels: Union[Path, Dict[str, ChannelImage]],
+    output_dir: Path,
+    tile_size=1000,
+    overlap=50,
+    read_mode="windowed",
+    empty_tile_threshold=None,
+    resume=True,
+    tile_order="grid",
+) -> Tuple[List[str], dict, List[str], Dict[str, Dict[str, str]]]:
+    channels = get_ordered_channel_paths(segmentation_channels)
+    channel_order = list(channels)
+    print("Slicing channels", channel_order, "into multichannel tiles")
+    stats = slice_img_multichannel(
+        channels,
+        output_dir,
+        tile_size=tile_size,
+        overlap=overlap,
+        read_mode=read_mode,
+        empty_tile_threshold=empty_tile_threshold,
+        resume=resume,
+        tile_order=tile_order,
+    )
+    print_slicing_throughput("+".join(channel_order), stats)
+    hashes = {label: {MULTICHANNEL_TILE_SUFFIX: h} for label, h in stats["hashes"].items()}
+    return channel_order, stats["occupancy"], stats["empty_tiles"], hashes
+
+
 def split_channels_into_tiles(
-    input_dir: Path,
+    segmentation_channels: Union[Path, Dict[str, ChannelImage]],
     output_dir: Path,
     tile_size=1000,
     overlap=50,
-):
-    for file_path in input_dir.iterdir():
-        if m := filename_pattern.match(file_path.name):
-            channel_name = m.group("channel")
-            print("channel_name:", channel_name)
+    read_mode="windowed",
+    num_workers=1,
+    memory_budget_gb=None,
+    pool="thread",
+    resume=True,
+    tile_order="grid",
+    empty_tile_threshold=None,
+) -> Tuple[Dict[str, Dict[str, dict]], List[str], Dict[str, Dict[str, str]]]:
+    """Returns occupancy of every tile per channel (see slicer.get_tile_occupancy),
+    names of tiles that are empty in all channels and are not written,
+    and content hash of every tile file per channel.
+    Every channel skips its own empty tiles while slicing, tiles that turn out
+    to be non-empty in another channel are filled in afterwards.
+    """
+    channels = get_channels(segmentation_channels)
+
+    num_concurrent = get_num_concurrent_channels(
+        list(channels.values()), tile_size, overlap, read_mode, num_workers, memory_budget_gb
+    )
+    print("Slicing", len(channels), "channel(s),", num_concurrent, "at a time")
 
-            slice_img(
+    executor_class = ProcessPoolExecutor if pool == "process" else ThreadPoolExecutor
+    with executor_class(max_workers=num_concurrent) as executor:
+        futures = dict()
+        for channel_name, file_path in channels.items():
+            print("channel_name:", channel_name)
+            future = executor.submit(
+                slice_img,
                 file_path,
                 output_dir,
                 tile_size=tile_size,
                 overlap=overlap,
                 zplane=1,
                 channel_name=channel_name,
+                read_mode=read_mode,
+                resume=resume,
+                tile_order=tile_order,
+                empty_tile_threshold=empty_tile_threshold,
+            )
+            futures[future] = channel_name
+        occupancy = defaultdict(dict)
+        skipped = defaultdict(list)
+        hashes = defaultdict(dict)
+        for future in as_completed(futures):
+            channel_name = futures[future]
+            stats = future.result()
+            print_slicing_throughput(channel_name, stats)
+            for label, tile_occupancy in stats["occupancy"].items():
+                occupancy[label][channel_name] = tile_occupancy
+            for label in stats["empty_tiles"]:
+                skipped[channel_name].append(label)
+            for label, tile_hash in stats["hashes"].items():
+                hashes[label][channel_name] = tile_hash
+
+        empty_tiles = [
+            label
+            for label, occupancy_per_channel in occupancy.items()
+            if is_empty_tile(occupancy_per_channel, empty_tile_threshold)
+        ]
+        futures = dict()
+        for channel_name, labels in skipped.items():
+            to_fill = sorted(set(labels).difference(empty_tiles))
+            if not to_fill:
+                continue
+            print("Filling", len(to_fill), "tile(s) of channel", channel_name)
+            future = executor.submit(
+                fill_empty_tiles,
+                channels[channel_name],
+                output_dir,
+                to_fill,
+                tile_size=tile_size,
+                overlap=overlap,
+                channel_name=channel_name,
+                read_mode=read_mode,
+                empty_tile_threshold=empty_tile_threshold,
             )
+            futures[future] = channel_name
+        for future in as_completed(futures):
+            channel_name = futures[future]
+            for label, tile_hash in future.result()["hashes"].items():
+                hashes[label][channel_name] = tile_hash
+    return dict(occupancy), empty_tiles, dict(hashes)
+
+
+def take_cached_tiles(
+    output_dir: Path,
+    hashes: Dict[str, Dict[str, str]],
+    skipped_tiles: List[str],
+    cache_dir: Path,
+    method: str,
+) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """Looks up every sliced tile in the segmentation cache by content key.
+    Directories of tiles with a cached mask are removed, so only misses are segmented.
+    Returns key of every tile and path of the cached mask of every hit, relative
+    to cache_dir: the stitcher gets the cache staged at another location.
+    """
+    skipped_tiles = set(skipped_tiles)
+    keys = dict()
+    cached_tiles = dict()
+    for label, channel_hashes in hashes.items():
+        if label in skipped_tiles:
+            continue
+        keys[label] = get_tile_key(channel_hashes, method)
+        mask_path = lookup_mask(cache_dir, method, keys[label])
+        if mask_path is not None:
+            print("Using cached mask for tile", label)
+            shutil.rmtree(output_dir / label)
+            cached_tiles[label] = mask_path.relative_to(cache_dir).as_posix()
+    print("Segmentation cache hits:", len(cached_tiles), "/", len(keys))
+    return keys, cached_tiles
+
+
+def shard_tiles(
+    output_dir: Path,
+    occupancy: Dict[str, Dict[str, dict]],
+    skipped_tiles: List[str],
+    tile_shape: Tuple[int, int],
+    overlap: int,
+    num_shards: int,
+) -> dict:
+    """Groups sliced tiles into num_shards directories with about the same
+    number of nonzero pixels each, so that scattered segmentation jobs finish together.
+    Skipped (empty or cached) tiles are not segmented and not sharded.
+    """
+    tile_pixels = (tile_shape[0] + overlap * 2) * (tile_shape[1] + overlap * 2)
+    skipped_tiles = set(skipped_tiles)
+    work = {
+        label: estimate_tile_work(occupancy_per_channel, tile_pixels)
+        for label, occupancy_per_channel in occupancy.items()
+        if label not in skipped_tiles
+    }
+    shards = assign_tiles_to_shards(work, num_shards)
+    manifest = build_shard_manifest(shards, work)
+    print_shard_balance(manifest)
+    move_tiles_into_shards(output_dir, manifest)
+    return manifest
+
+
+def tile_size_arg(value: str) -> Union[int, str]:
+    if value == "auto":
+        return value
+    return int(value)
+
+
+def num_shards_arg(value: str) -> Union[int, str]:
+    if value == "auto":
+        return value
+    return int(value)
+
+
+def select_tile_overlap(
+    channels: Dict[str, Any], sidecars: Dict[str, dict], pipeline_config: dict, tile_overlap: int
+) -> Tuple[int, dict]:
+    """Estimates tile overlap from the nucleus channel,
+    keeps tile_overlap if the dataset has no nucleus channel
+    """
+    if "nucleus" not in channels:
+        overlap_estimate = {
+            "method": "nucleus_size",
+            "reason": "no nucleus segmentation channel, kept --tile_overlap",
+            "overlap": tile_overlap,
+        }
+        return tile_overlap, overlap_estimate
+    pixel_size = pipeline_config.get("pixel_size_x")
+    if pixel_size is not None and "segmentation_downsampling" in sidecars:
+        pixel_size *= sidecars["segmentation_downsampling"]["factor"][1]
+    return estimate_overlap(
+        channels["nucleus"],
+        pixel_size,
+        pipeline_config.get("pixel_unit_x"),
+        fallback_overlap=tile_overlap,
+    )
 
 
 def main(
-    segmentation_channels_dir: Path,
+    segmentation_channels: Union[Path, Dict[str, ChannelImage]],
     pipeline_config_path: Path,
-    tile_size: int,
+    tile_size: Union[int, str],
     tile_overlap: int,
+    read_mode: str = "windowed",
+    num_workers: int = 1,
+    memory_budget_gb: Optional[float] = None,
+    pool: str = "thread",
+    output_mode: str = "per_channel",
+    segmentation_memory_gb: float = 16,
+    segmentation_workers: int = 1,
+    tile_layout: str = "fixed",
+    empty_tile_threshold: Optional[float] = 0.0,
+    resume: bool = True,
+    num_shards: Union[int, str, None] = None,
+    tile_order: str = "grid",
+    auto_overlap: bool = False,
+    segmentation_cache_dir: Optional[Path] = None,
+    segmentation_method: Optional[str] = None,
 ):
     out_dir = Path("output/new_tiles")
     pipeline_conf_dir = Path("output/pipeline_conf")
     out_dir.mkdir(exist_ok=True, parents=True)
     pipeline_conf_dir.mkdir(exist_ok=True, parents=True)
+    unshard_tiles(out_dir)
 
-    stitched_img_shape = get_stitched_image_shape(segmentation_channels_dir)
+    channels = get_channels(segmentation_channels)
+    if isinstance(segmentation_channels, dict):
+        stitched_img_shape = next(iter(channels.values())).shape
+    else:
+        stitched_img_shape = get_stitched_image_shape(segmentation_channels)
+    sidecars = read_segmentation_channel_sidecars(segmentation_channels)
+    overlap_estimate = None
+    if auto_overlap:
+        pipeline_config = read_pipeline_config(pipeline_config_path)
+        tile_overlap, overlap_estimate = select_tile_overlap(
+            channels, sidecars, pipeline_config, tile_overlap
+        )
+        print("Selected tile overlap", tile_overlap, "|", overlap_estimate["reason"])
+    if tile_size == "auto":
+        tile_size = choose_tile_size(
+            stitched_img_shape[-2:], tile_overlap, segmentation_memory_gb, segmentation_workers
+        )
+        print(
+            "Selected tile size",
+            tile_size,
+            "for",
+            segmentation_workers,
+            "segmentation worker(s) with",
+            segmentation_memory_gb,
+            "GB each",
+        )
+    if tile_layout == "balanced":
+        fixed_tile_shape = (tile_size, tile_size)
+        print("Fixed tile layout would be:")
+        print_tiling_estimate(stitched_img_shape[-2:], fixed_tile_shape, tile_overlap)
+        tile_shape = get_balanced_tile_shape(stitched_img_shape[-2:], fixed_tile_shape)
+        print("Balanced tile layout:")
+    else:
+        tile_shape = (tile_size, tile_size)
+    print_tiling_estimate(stitched_img_shape[-2:], tile_shape, tile_overlap)
 
     print("Splitting images into tiles")
-    print("Tile size:", tile_size, "| overlap:", tile_overlap)
-    split_channels_into_tiles(segmentation_channels_dir, out_dir, tile_size, tile_overlap)
+    print(
+        "Tile shape:",
+        tile_shape,
+        "| overlap:",
+        tile_overlap,
+        "| read mode:",
+        read_mode,
+        "| tile order:",
+        tile_order,
+    )
+    hashes = dict()
+    if output_mode == "multichannel":
+        tile_channels, occupancy, empty_tiles, hashes = split_channels_into_multichannel_tiles(
+            channels,
+            out_dir,
+            tile_shape,
+            tile_overlap,
+            read_mode,
+            empty_tile_threshold,
+            resume,
+            tile_order,
+        )
+    elif output_mode == "zarr":
+        store_path = out_dir.parent / TILE_STORE_NAME
+        tile_channels, occupancy, empty_tiles = split_channels_into_tile_store(
+            channels,
+            store_path,
+            tile_shape,
+            tile_overlap,
+            read_mode,
+            empty_tile_threshold,
+        )
+    else:
+        occupancy, empty_tiles, hashes = split_channels_into_tiles(
+            channels,
+            out_dir,
+            tile_shape,
+            tile_overlap,
+            read_mode,
+            num_workers,
+            memory_budget_gb,
+            pool,
+            resume,
+            tile_order,
+            empty_tile_threshold,
+        )
+    print("Empty tiles left out of segmentation:", len(empty_tiles), "/", len(occupancy))
+    tile_keys = dict()
+    cached_tiles = dict()
+    use_cache = segmentation_cache_dir is not None and output_mode != "zarr"
+    if use_cache:
+        print("Looking up tiles in segmentation cache", segmentation_cache_dir)
+        tile_keys, cached_tiles = take_cached_tiles(
+            out_dir, hashes, empty_tiles, segmentation_cache_dir, segmentation_method
+        )
+    if num_shards == "auto":
+        num_shards = segmentation_workers
+    if num_shards and output_mode != "zarr":
+        print("Grouping tiles into", num_shards, "shard(s)")
+        shard_manifest = shard_tiles(
+            out_dir,
+            occupancy,
+            empty_tiles + list(cached_tiles),
+            tile_shape,
+            tile_overlap,
+            num_shards,
+        )
+        print("Saving shard manifest to", SHARD_MANIFEST_NAME)
+        save_shard_manifest(shard_manifest, Path(SHARD_MANIFEST_NAME))
+    with open((p := "tile_occupancy.json"), "w") as f:
+        print("Saving tile occupancy to", p)
+        json.dump(occupancy, f, indent=4)
 
     modified_experiment = modify_pipeline_config(
-        pipeline_config_path, (tile_size, tile_size), tile_overlap, stitched_img_shape
+        pipeline_config_path, tile_shape, tile_overlap, stitched_img_shape, tile_layout
+    )
+    modified_experiment["slicer"]["output_mode"] = output_mode
+    if overlap_estimate is not None:
+        modified_experiment["slicer"]["overlap_estimate"] = overlap_estimate
+    modified_experiment.update(sidecars)
+    if output_mode in ("multichannel", "zarr"):
+        modified_experiment["slicer"]["tile_channels"] = tile_channels
+    modified_experiment["slicer"]["empty_tile_threshold"] = empty_tile_threshold
+    modified_experiment["slicer"]["empty_tiles"] = sorted(empty_tiles)
+    if num_shards and output_mode != "zarr":
+        modified_experiment["slicer"]["num_shards"] = shard_manifest["num_shards"]
+    if use_cache:
+        modified_experiment["slicer"]["segmentation_cache"] = {
+            "method": segmentation_method,
+            "hits": len(cached_tiles),
+            "misses": len(tile_keys) - len(cached_tiles),
+        }
+    manifest = build_tile_manifest(
+        stitched_img_shape[-2:], tile_shape, tile_overlap, empty_tiles, tile_keys, cached_tiles
     )
+    print("Saving tile manifest to", TILE_MANIFEST_NAME)
+    save_tile_manifest(manifest, Path(TILE_MANIFEST_NAME))
     with open((p := "pipelineConfig.json"), "w") as f:
         print("Saving modified pipeline config to", p)
         json.dump(modified_experiment, f, indent=4)
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "--segmentation_channels_dir",
-        type=Path,
-        help="path to directory with one image per segmentation channel",
-    )
+def add_slicing_arguments(parser: argparse.ArgumentParser):
+    """Slicing options shared with prepare_and_slice.py"""
     parser.add_argument(
         "--pipeline_config_path",
         type=Path,
@@ -103,20 +570,175 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--tile_size",
-        type=int,
+        type=tile_size_arg,
         default=10_000,
+        help='tile size in pixels, or "auto" to pick it from image shape and memory budget',
     )
     parser.add_argument(
         "--tile_overlap",
         type=int,
         default=100,
+        help="tile overlap in pixels, with --auto_overlap used only if no nuclei are found",
+    )
+    parser.add_argument(
+        "--auto_overlap",
+        action="store_true",
+        help="pick the smallest overlap that fits the largest cells, from nucleus sizes "
+        "measured on sampled windows of the nucleus channel",
+    )
+    parser.add_argument(
+        "--read_mode",
+        choices=READ_MODES,
+        default="windowed",
+        help="windowed: read only each tile's window from disk, full: load whole image",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="max number of channels to slice concurrently",
+    )
+    parser.add_argument(
+        "--memory_budget_gb",
+        type=float,
+        default=None,
+        help="limit concurrent channels so that estimated slicing memory fits in this budget",
+    )
+    parser.add_argument(
+        "--pool",
+        choices=("thread", "process"),
+        default="thread",
+        help="slice channels in a thread or a process pool",
+    )
+    parser.add_argument(
+        "--output_mode",
+        choices=OUTPUT_MODES,
+        default="per_channel",
+        help=(
+            "per_channel: one file per channel per tile, multichannel: one file per tile, "
+            "zarr: all tiles in one chunked store, see tile_store.py"
+        ),
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--segmentation_memory_gb",
+        type=float,
+        default=16,
+        help="memory available to one segmentation worker, used with --tile_size auto",
+    )
+    parser.add_argument(
+        "--segmentation_workers",
+        type=int,
+        default=1,
+        help="number of tiles segmented in parallel, used with --tile_size auto",
+    )
+
+    parser.add_argument(
+        "--tile_layout",
+        choices=TILE_LAYOUTS,
+        default="fixed",
+        help=(
+            "fixed: tiles of --tile_size with padded last row and column, "
+            "balanced: near-equal tiles no larger than --tile_size with minimal padding"
+        ),
+    )
+
+    parser.add_argument(
+        "--empty_tile_threshold",
+        type=float,
+        default=0.0,
+        help=(
+            "tiles whose fraction of nonzero pixels is at or below this value in every channel "
+            "are left out of segmentation and stitched as empty masks"
+        ),
+    )
+    parser.add_argument(
+        "--keep_empty_tiles",
+        action="store_true",
+        help="segment all tiles, including empty ones",
+    )
+    parser.add_argument(
+        "--no_resume",
+        action="store_true",
+        help="slice all tiles again instead of skipping tiles recorded in the slicing journal",
+    )
+    parser.add_argument(
+        "--num_shards",
+        type=num_shards_arg,
+        default=None,
+        help=(
+            "group tiles into this many shard directories with equal amount of tissue, "
+            '"auto" for one shard per segmentation worker, by default every tile is its own job'
+        ),
+    )
+
+    parser.add_argument(
+        "--tile_order",
+        choices=tuple(TILINGS),
+        default="grid",
+        help=(
+            "order in which tiles are read, hilbert keeps consecutive tiles adjacent; "
+            "tile names and stitching order do not depend on it"
+        ),
+    )
+
+    parser.add_argument(
+        "--segmentation_cache_dir",
+        type=Path,
+        default=None,
+        help=(
+            "directory with masks of earlier runs by tile content and segmentation method, "
+            "tiles found there are not segmented again"
+        ),
+    )
+    parser.add_argument(
+        "--segmentation_method",
+        type=str,
+        default=None,
+        help="segmentation method, part of the cache key, required with --segmentation_cache_dir",
+    )
 
+
+def check_slicing_arguments(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    if args.segmentation_cache_dir is not None and args.segmentation_method is None:
+        parser.error("--segmentation_cache_dir requires --segmentation_method")
+
+
+def main_from_args(
+    segmentation_channels: Union[Path, Dict[str, ChannelImage]], args: argparse.Namespace
+):
     main(
-        segmentation_channels_dir=args.segmentation_channels_dir,
+        segmentation_channels=segmentation_channels,
         pipeline_config_path=args.pipeline_config_path,
         tile_size=args.tile_size,
         tile_overlap=args.tile_overlap,
+        read_mode=args.read_mode,
+        num_workers=args.num_workers,
+        memory_budget_gb=args.memory_budget_gb,
+        pool=args.pool,
+        output_mode=args.output_mode,
+        segmentation_memory_gb=args.segmentation_memory_gb,
+        segmentation_workers=args.segmentation_workers,
+        tile_layout=args.tile_layout,
+        empty_tile_threshold=None if args.keep_empty_tiles else args.empty_tile_threshold,
+        resume=not args.no_resume,
+        num_shards=args.num_shards,
+        tile_order=args.tile_order,
+        auto_overlap=args.auto_overlap,
+        segmentation_cache_dir=args.segmentation_cache_dir,
+        segmentation_method=args.segmentation_method,
     )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--segmentation_channels_dir",
+        type=Path,
+        help="path to directory with one image per segmentation channel",
+    )
+    add_slicing_arguments(parser)
+    args = parser.parse_args()
+    check_slicing_arguments(parser, args)
+
+    main_from_args(args.segmentation_channels_dir, args)
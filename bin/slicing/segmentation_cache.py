@@ -0,0 +1,39 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+# Layout shared with secondary_stitcher/mask_cache.py, which stores new masks:
+# cache_dir/<method>/<key[:2]>/<key>/<mask file>.tiff
+# mtime of the entry directory is its last use, the oldest entries are evicted first
+
+
+def get_tile_key(channel_hashes: Dict[str, str], method: str) -> str:
+    """Content key of a tile: hashes of all its channel files and the segmentation method"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(method.encode())
+    for channel_name in sorted(channel_hashes):
+        digest.update(f"\n{channel_name}:{channel_hashes[channel_name]}".encode())
+    return digest.hexdigest()
+
+
+def get_entry_dir(cache_dir: Path, method: str, key: str) -> Path:
+    return cache_dir / method / key[:2] / key
+
+
+def lookup_mask(cache_dir: Path, method: str, key: str) -> Optional[Path]:
+    """Path of the cached mask of a tile, None on a miss.
+    A hit marks the entry as recently used, if the cache is writable here;
+    the stitcher marks it again when it adds new masks.
+    """
+    entry_dir = get_entry_dir(cache_dir, method, key)
+    if not entry_dir.is_dir():
+        return None
+    masks = sorted(entry_dir.glob("*.tiff"))
+    if not masks:
+        return None
+    try:
+        os.utime(entry_dir)
+    except OSError:
+        pass
+    return masks[0]
@@ -1,11 +1,54 @@
 import os
-import os.path as osp
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterator, Optional, Sequence, Union
 
-import dask
 import numpy as np
 import tifffile as tif
-from tiling import GridTiling, SnakeTiling
+import zarr
+from tile_journal import TileJournal, get_journal_path
+from tiling import get_tiling_by_name
+
+READ_MODES = ("full", "windowed")
+OUTPUT_MODES = ("per_channel", "multichannel", "zarr")
+MULTICHANNEL_TILE_SUFFIX = "channels"
+
+
+def open_image_reader(in_path: Path):
+    """Opens image for windowed reading without loading it into memory.
+    Contiguous images are memory-mapped, chunked (tiled or strip-compressed)
+    images are opened as zarr arrays that decode only the chunks a window touches.
+    Both support numpy-style slicing, so they can be passed to get_tile as is.
+    """
+    try:
+        return tif.memmap(in_path, mode="r")
+    except ValueError:
+        store = tif.imread(in_path, aszarr=True)
+        return zarr.open(store, mode="r")
+
+
+def open_image(in_path: Path, read_mode: str):
+    """in_path can also be an already opened array-like image,
+    e.g. channel_pages.ChannelSum, which is returned as is in any read mode
+    """
+    if not isinstance(in_path, (str, Path)):
+        return in_path
+    if read_mode == "windowed":
+        return open_image_reader(in_path)
+    elif read_mode == "full":
+        return tif.imread(in_path)
+    else:
+        raise ValueError(f"Unknown read mode {read_mode!r}, expected one of {READ_MODES}")
+
+
+def get_tile_shape(tile_size: Union[int, Sequence[int]]) -> tuple[int, int]:
+    """Tile size can be a single number for square tiles or (height, width)"""
+    if isinstance(tile_size, int):
+        return tile_size, tile_size
+    tile_h, tile_w = tile_size
+    return int(tile_h), int(tile_w)
 
 
 def get_tile(arr, hor_f: int, hor_t: int, ver_f: int, ver_t: int, overlap=0):
@@ -38,95 +81,421 @@ def get_tile(arr, hor_f: int, hor_t: int, ver_f: int, ver_t: int, overlap=0):
         ver_t = arr.shape[0]
 
     tile_slice = (slice(ver_f, ver_t), slice(hor_f, hor_t))
-    tile = arr[tile_slice]
+    tile = np.asarray(arr[tile_slice])
     padding = ((top_pad_size, bot_pad_size), (left_pad_size, right_pad_size))
     if max(padding) > (0, 0):
         tile = np.pad(tile, padding, mode="constant")
     return tile
 
 
+def get_tile_grid(
+    arr_width: int, arr_height: int, tile_w: int, tile_h: int, tile_order: str = "grid"
+) -> tuple[list[tuple[tuple[int, int], tuple[int, int, int, int]]], int, int]:
+    """Returns 0-based grid coordinates (x, y) and pixel window
+    (hor_f, hor_t, ver_f, ver_t) without overlap for every tile,
+    and number of tiles along x and y.
+    Tiles are listed in the order of tile_order tiling, reading order by default.
+    """
+    x_ntiles = arr_width // tile_w if arr_width % tile_w == 0 else (arr_width // tile_w) + 1
+    y_ntiles = arr_height // tile_h if arr_height % tile_h == 0 else (arr_height // tile_h) + 1
+
+    tiling = get_tiling_by_name(tile_order)
+    xs, ys = tiling.coordinates_from_indices(np.arange(x_ntiles * y_ntiles), x_ntiles, y_ntiles)
+    hor_f = xs * tile_w
+    ver_f = ys * tile_h
+    windows = np.stack((hor_f, hor_f + tile_w, ver_f, ver_f + tile_h), axis=1)
+    co_ords = zip(xs.tolist(), ys.tolist())
+    grid = [(c, tuple(window)) for c, window in zip(co_ords, windows.tolist())]
+    return grid, x_ntiles, y_ntiles
+
+
+def get_tile_label(co_ords: tuple[int, int], region: int = 1) -> str:
+    return f"R{region:d}_X{co_ords[0] + 1:d}_Y{co_ords[1] + 1:d}"
+
+
+def get_tile_name(co_ords: tuple[int, int], channel_name: str, region: int = 1) -> Path:
+    # Need names like R0_X1_Y1_cell.tif R0_X1_Y1_nucleus.tif instead of the current names
+    label = get_tile_label(co_ords, region)
+    return Path(label) / f"{label}_{channel_name}.tif"
+
+
 def split_by_size(
     arr: np.ndarray,
     channel_name: str,
     tile_w: int,
     tile_h: int,
     overlap: int,
-) -> tuple[list[np.ndarray], list[Path]]:
-    """Splits image into tiles by size of tile.
+) -> Iterator[tuple[np.ndarray, Path]]:
+    """Splits image into tiles by size of tile, yields (tile, name) pairs one at a time.
+    Tiles are views into arr, a copy is made only when the tile needs edge padding.
     tile_w - tile width
     tile_h - tile height
     """
-    region = 1
     x_axis = -1
     y_axis = -2
     arr_width, arr_height = arr.shape[x_axis], arr.shape[y_axis]
 
-    x_ntiles = arr_width // tile_w if arr_width % tile_w == 0 else (arr_width // tile_w) + 1
-    y_ntiles = arr_height // tile_h if arr_height % tile_h == 0 else (arr_height // tile_h) + 1
+    grid, x_ntiles, y_ntiles = get_tile_grid(arr_width, arr_height, tile_w, tile_h)
+
+    for tile_num, (co_ords, window) in enumerate(grid):
+        print(co_ords, x_ntiles, y_ntiles, tile_num)
+        yield get_tile(arr, *window, overlap), get_tile_name(co_ords, channel_name)
+
+
+def get_tile_occupancy(tile: np.ndarray) -> dict[str, float]:
+    """Fraction of nonzero pixels, max and mean intensity of a tile"""
+    return {
+        "nonzero_fraction": float(np.count_nonzero(tile) / tile.size),
+        "max": float(tile.max()),
+        "mean": float(tile.mean()),
+    }
+
+
+def is_empty_tile(occupancy_per_channel: dict[str, dict], threshold: Optional[float]) -> bool:
+    """Tile is empty when the nonzero fraction of every channel is at or below threshold"""
+    if threshold is None:
+        return False
+    return all(o["nonzero_fraction"] <= threshold for o in occupancy_per_channel.values())
+
+
+def default_num_writers() -> int:
+    return min(8, os.cpu_count() or 1)
+
+
+def estimate_slicing_memory(
+    in_path: Path,
+    tile_size: Union[int, Sequence[int]],
+    overlap: int,
+    read_mode: str,
+    num_writers: int = None,
+) -> int:
+    """Rough peak memory in bytes that slice_img needs for one channel:
+    tiles pending in the writer plus the current one, and the whole image in full mode
+    """
+    if isinstance(in_path, (str, Path)):
+        with tif.TiffFile(in_path) as TF:
+            shape = TF.series[0].shape
+            itemsize = TF.series[0].dtype.itemsize
+    else:
+        shape = in_path.shape
+        itemsize = in_path.dtype.itemsize
+    if num_writers is None:
+        num_writers = default_num_writers()
+    tile_h, tile_w = get_tile_shape(tile_size)
+    tile_bytes = (tile_h + overlap * 2) * (tile_w + overlap * 2) * itemsize
+    memory = (num_writers * 2 + 1) * tile_bytes
+    if read_mode == "full":
+        memory += int(np.prod(shape)) * itemsize
+    return memory
+
 
-    tiles = []
-    img_names = []
+def write_tile(out_path: Path, tile: np.ndarray, **imwrite_kwargs):
+    tif.imwrite(out_path, tile, photometric="minisblack", **imwrite_kwargs)
 
-    # row
-    for i in range(0, y_ntiles):
-        # height of this tile
-        ver_f = tile_h * i
-        ver_t = ver_f + tile_h
 
-        # col
-        for j in range(0, x_ntiles):
-            # width of this tile
-            hor_f = tile_w * j
-            hor_t = hor_f + tile_w
+def write_tile_atomic(out_path: Path, tile: np.ndarray, **imwrite_kwargs):
+    """Writes to a temporary file next to out_path and renames it,
+    so a partially written tile never appears under its final name
+    """
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    write_tile(tmp_path, tile, **imwrite_kwargs)
+    os.replace(tmp_path, out_path)
+
+
+def make_journaled_writer(journal: TileJournal, out_dir: Path):
+    """TileWriter write function that records every tile in the journal
+    once it is in place, extra fields are passed as journal_fields
+    """
+
+    def write(out_path: Path, tile: np.ndarray, journal_fields=None, **imwrite_kwargs):
+        write_tile_atomic(out_path, tile, **imwrite_kwargs)
+        name = out_path.relative_to(out_dir).as_posix()
+        journal.record(name, out_path, **(journal_fields or {}))
 
-            tile = get_tile(arr, hor_f, hor_t, ver_f, ver_t, overlap)
+    return write
 
-            # Need names like R0_X1_Y1_cell.tif R0_X1_Y1_nucleus.tif instead of the current names
 
-            tiles.append(tile)
-            tiling = GridTiling()
-            tile_num = (i * x_ntiles) + j
-            co_ords = tiling.coordinates_from_index(tile_num, x_ntiles, y_ntiles)
-            print(co_ords, x_ntiles, y_ntiles, tile_num)
-            folder = Path(f"R{region:d}_X{co_ords[0] + 1:d}_Y{co_ords[1] + 1:d}")
-            name = (
-                folder / f"R{region:d}_X{co_ords[0] + 1:d}_Y{co_ords[1] + 1:d}_{channel_name}.tif"
-            )
+def get_tile_hashes(journal: TileJournal) -> dict[str, str]:
+    """Content hash of every written tile file by tile label"""
+    return {
+        Path(name).parent.name: entry["hash"]
+        for name, entry in journal.entries.items()
+        if "hash" in entry
+    }
 
-            # name = "{region:d}_{tile:05d}_Z{zplane:03d}_CH{channel:d}.tif".format(
-            #     region=region, tile=tile_num, zplane=zplane, channel=channel
-            # )
-            img_names.append(name)
 
-    return tiles, img_names
+def get_journal_params(in_paths, tile_shape, overlap: int) -> dict:
+    """Slicing parameters a journal is valid for, input files are identified
+    by name, size and modification time, opened images by their get_source_info
+    """
+    sources = dict()
+    for in_path in in_paths:
+        if not isinstance(in_path, (str, Path)):
+            sources.update(in_path.get_source_info())
+            continue
+        stat = os.stat(in_path)
+        sources[Path(in_path).name] = [stat.st_size, stat.st_mtime_ns]
+    return {"sources": sources, "tile_shape": list(tile_shape), "overlap": overlap}
+
+
+class TileWriter:
+    """Writes tiles from a thread pool while the caller keeps reading.
+    At most max_pending tiles are held at once: submit blocks until
+    one of the pending writes finishes, so memory stays at a few tiles.
+    The first error raised by a write is re-raised from submit or on exit.
+    write is called as write(destination, tile, **kwargs), TIFF files by default.
+    """
+
+    def __init__(self, num_workers: int = None, max_pending: int = None, write=write_tile):
+        if num_workers is None:
+            num_workers = default_num_writers()
+        if max_pending is None:
+            max_pending = num_workers * 2
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._write = write
+        self._error = None
+
+    def _on_done(self, future):
+        # futures cancelled on shutdown after an error have no exception to report
+        if not future.cancelled() and future.exception() is not None and self._error is None:
+            self._error = future.exception()
+        self._slots.release()
+
+    def submit(self, destination, tile: np.ndarray, **write_kwargs):
+        if self._error is not None:
+            raise self._error
+        self._slots.acquire()
+        future = self._executor.submit(self._write, destination, tile, **write_kwargs)
+        future.add_done_callback(self._on_done)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            return False
+        self.close()
 
 
 def slice_img(
     in_path: Path,
     out_dir: Path,
-    tile_size: int,
+    tile_size: Union[int, Sequence[int]],
     overlap: int,
     zplane: int,
     channel_name: str,
-):
+    read_mode: str = "windowed",
+    num_writers: int = None,
+    resume: bool = True,
+    tile_order: str = "grid",
+    empty_tile_threshold: Optional[float] = None,
+) -> dict:
+    """In windowed mode only the window of the tile that is being written is
+    read from disk, so memory use depends on tile size instead of image size.
+    Full mode loads the whole image first. Output is identical in both modes.
+    Finished tiles are recorded in a journal in out_dir (see tile_journal.py),
+    with resume tiles that are already written and verify against the journal
+    are skipped without reading their window.
+    Tiles are read in tile_order, "hilbert" keeps consecutive windows next to each other.
+    Tiles that are empty in this channel (see is_empty_tile) are not written,
+    they are recorded as empty in the journal; fill_empty_tiles writes the ones
+    that another channel needs for segmentation.
+    Returns number of written and resumed tiles, bytes of written tile data,
+    elapsed seconds, occupancy of every tile (see get_tile_occupancy),
+    labels of skipped empty tiles and content hash of every tile file.
+    """
     print("Made it to slicer, in_path:", in_path)
-    this_plane_tiles, this_plane_img_names = split_by_size(
-        tif.imread(in_path),
-        channel_name=channel_name,
-        tile_w=tile_size,
-        tile_h=tile_size,
-        overlap=overlap,
-    )
-
-    task = []
-    for i, img in enumerate(this_plane_tiles):
-        base = out_dir / this_plane_img_names[i]
-        print("Saving ", base)
-        base.parent.mkdir(exist_ok=True, parents=True)
-        task.append(
-            dask.delayed(tif.imwrite)(
-                osp.join(out_dir, this_plane_img_names[i]), img, photometric="minisblack"
-            )
-        )
-
-    dask.compute(*task, scheduler="threads")
+    start = time.perf_counter()
+    arr = open_image(in_path, read_mode)
+    tile_h, tile_w = get_tile_shape(tile_size)
+    arr_height, arr_width = arr.shape[-2:]
+    grid, x_ntiles, y_ntiles = get_tile_grid(arr_width, arr_height, tile_w, tile_h, tile_order)
+
+    journal_path = get_journal_path(out_dir, channel_name)
+    if not resume and journal_path.exists():
+        journal_path.unlink()
+    out_dir.mkdir(exist_ok=True, parents=True)
+    params = get_journal_params([in_path], (tile_h, tile_w), overlap)
+    params["empty_tile_threshold"] = empty_tile_threshold
+
+    num_tiles = 0
+    num_resumed = 0
+    num_bytes = 0
+    occupancy = dict()
+    empty_tiles = []
+    with TileJournal(journal_path, params) as journal:
+        write = make_journaled_writer(journal, out_dir)
+        with TileWriter(num_workers=num_writers, write=write) as writer:
+            for tile_num, (co_ords, window) in enumerate(grid):
+                print(co_ords, x_ntiles, y_ntiles, tile_num)
+                label = get_tile_label(co_ords)
+                name = get_tile_name(co_ords, channel_name)
+                if (entry := journal.get_finished(name.as_posix(), out_dir)) is not None:
+                    print("Already sliced ", name)
+                    occupancy[label] = entry["occupancy"]
+                    if entry.get("empty", False):
+                        empty_tiles.append(label)
+                    num_resumed += 1
+                    continue
+                tile = get_tile(arr, *window, overlap)
+                tile_occupancy = get_tile_occupancy(tile)
+                occupancy[label] = tile_occupancy
+                if is_empty_tile({channel_name: tile_occupancy}, empty_tile_threshold):
+                    print("Skipping empty tile", name)
+                    empty_tiles.append(label)
+                    journal.record(name.as_posix(), occupancy=tile_occupancy, empty=True)
+                    continue
+                base = out_dir / name
+                print("Saving ", base)
+                base.parent.mkdir(exist_ok=True, parents=True)
+                writer.submit(base, tile, journal_fields={"occupancy": tile_occupancy})
+                num_tiles += 1
+                num_bytes += tile.nbytes
+    return {
+        "num_tiles": num_tiles,
+        "num_resumed": num_resumed,
+        "num_bytes": num_bytes,
+        "seconds": time.perf_counter() - start,
+        "occupancy": occupancy,
+        "empty_tiles": empty_tiles,
+        "hashes": get_tile_hashes(journal),
+    }
+
+
+def fill_empty_tiles(
+    in_path: Path,
+    out_dir: Path,
+    labels: Sequence[str],
+    tile_size: Union[int, Sequence[int]],
+    overlap: int,
+    channel_name: str,
+    read_mode: str = "windowed",
+    num_writers: int = None,
+    empty_tile_threshold: Optional[float] = None,
+) -> dict:
+    """Writes tiles that slice_img skipped as empty in this channel,
+    for tiles that are not empty in another channel and go to segmentation.
+    Their empty journal entries are replaced, so a resumed slice_img keeps them.
+    Arguments other than labels must be the ones slice_img was called with.
+    Returns number of written tiles, bytes of written tile data
+    and content hash of every tile file.
+    """
+    arr = open_image(in_path, read_mode)
+    tile_h, tile_w = get_tile_shape(tile_size)
+    arr_height, arr_width = arr.shape[-2:]
+    grid, _, _ = get_tile_grid(arr_width, arr_height, tile_w, tile_h)
+    params = get_journal_params([in_path], (tile_h, tile_w), overlap)
+    params["empty_tile_threshold"] = empty_tile_threshold
+
+    labels = set(labels)
+    num_tiles = 0
+    num_bytes = 0
+    with TileJournal(get_journal_path(out_dir, channel_name), params) as journal:
+        write = make_journaled_writer(journal, out_dir)
+        with TileWriter(num_workers=num_writers, write=write) as writer:
+            for co_ords, window in grid:
+                if get_tile_label(co_ords) not in labels:
+                    continue
+                tile = get_tile(arr, *window, overlap)
+                base = out_dir / get_tile_name(co_ords, channel_name)
+                print("Saving ", base)
+                base.parent.mkdir(exist_ok=True, parents=True)
+                writer.submit(base, tile, journal_fields={"occupancy": get_tile_occupancy(tile)})
+                num_tiles += 1
+                num_bytes += tile.nbytes
+    return {"num_tiles": num_tiles, "num_bytes": num_bytes, "hashes": get_tile_hashes(journal)}
+
+
+def slice_img_multichannel(
+    in_paths: dict[str, Path],
+    out_dir: Path,
+    tile_size: Union[int, Sequence[int]],
+    overlap: int,
+    read_mode: str = "windowed",
+    num_writers: int = None,
+    empty_tile_threshold: Optional[float] = None,
+    resume: bool = True,
+    tile_order: str = "grid",
+) -> dict:
+    """Reads the same window from every channel image in one pass and writes
+    one multichannel tile per grid cell, e.g. R1_X1_Y1/R1_X1_Y1_channels.tif.
+    Channel order follows in_paths and is stored in the tile metadata.
+    Tiles that are empty in every channel (see is_empty_tile) are not written.
+    Resumes from the journal in out_dir and reads tiles in tile_order the same way as slice_img.
+    Returns number of written and resumed tiles, bytes of written tile data,
+    elapsed seconds, per-channel occupancy of every tile, names of skipped empty tiles
+    and content hash of every tile file.
+    """
+    start = time.perf_counter()
+    channel_names = list(in_paths.keys())
+    print("Made it to slicer, in_paths:", in_paths)
+    arrs = [open_image(in_path, read_mode) for in_path in in_paths.values()]
+    img_shapes = {arr.shape for arr in arrs}
+    if len(img_shapes) != 1:
+        raise ValueError(f"Segmentation channel images have different shapes: {img_shapes}")
+
+    arr_height, arr_width = arrs[0].shape[-2:]
+    tile_h, tile_w = get_tile_shape(tile_size)
+    grid, x_ntiles, y_ntiles = get_tile_grid(arr_width, arr_height, tile_w, tile_h, tile_order)
+    metadata = {"axes": "CYX", "Channel": {"Name": channel_names}}
+
+    journal_path = get_journal_path(out_dir, MULTICHANNEL_TILE_SUFFIX)
+    if not resume and journal_path.exists():
+        journal_path.unlink()
+    out_dir.mkdir(exist_ok=True, parents=True)
+    params = get_journal_params(in_paths.values(), (tile_h, tile_w), overlap)
+    params["empty_tile_threshold"] = empty_tile_threshold
+
+    num_tiles = 0
+    num_resumed = 0
+    num_bytes = 0
+    occupancy = dict()
+    empty_tiles = []
+    with TileJournal(journal_path, params) as journal:
+        write = make_journaled_writer(journal, out_dir)
+        with TileWriter(num_workers=num_writers, write=write) as writer:
+            for tile_num, (co_ords, window) in enumerate(grid):
+                print(co_ords, x_ntiles, y_ntiles, tile_num)
+                label = get_tile_label(co_ords)
+                name = get_tile_name(co_ords, MULTICHANNEL_TILE_SUFFIX)
+                if (entry := journal.get_finished(name.as_posix(), out_dir)) is not None:
+                    print("Already sliced ", name)
+                    occupancy[label] = entry["occupancy"]
+                    if entry.get("empty", False):
+                        empty_tiles.append(label)
+                    num_resumed += 1
+                    continue
+                tile = np.stack([get_tile(arr, *window, overlap) for arr in arrs])
+                occupancy[label] = {c: get_tile_occupancy(t) for c, t in zip(channel_names, tile)}
+                if is_empty_tile(occupancy[label], empty_tile_threshold):
+                    print("Skipping empty tile", label)
+                    empty_tiles.append(label)
+                    journal.record(name.as_posix(), occupancy=occupancy[label], empty=True)
+                    continue
+                base = out_dir / name
+                print("Saving ", base)
+                base.parent.mkdir(exist_ok=True, parents=True)
+                writer.submit(
+                    base,
+                    tile,
+                    journal_fields={"occupancy": occupancy[label]},
+                    metadata=metadata,
+                )
+                num_tiles += 1
+                num_bytes += tile.nbytes
+    return {
+        "num_tiles": num_tiles,
+        "num_resumed": num_resumed,
+        "num_bytes": num_bytes,
+        "seconds": time.perf_counter() - start,
+        "occupancy": occupancy,
+        "empty_tiles": empty_tiles,
+        "hashes": get_tile_hashes(journal),
+    }
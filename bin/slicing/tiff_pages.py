@@ -0,0 +1,53 @@
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import tifffile as tif
+import zarr
+
+# Page selection and saturating sums of segmentation channels, shared by
+# prepare_segmentation_channels.py and the slicing scripts. Scripts in bin import it
+# as slicing.tiff_pages, scripts in this directory as tiff_pages, so it imports no siblings.
+
+ACCUMULATION_DTYPES = ("input", "uint8", "uint16", "uint32", "float32")
+
+
+def get_channel_page_indices(series: tif.TiffPageSeries, channel_ids: List[int]) -> List[int]:
+    """Indices of the file pages that hold the given channels (first non-YX axis) of a series"""
+    page_shape = series.shape[:-2]
+    if not page_shape:
+        raise ValueError("Input image is not multichannel")
+    pages = series.pages
+    return [
+        pages[int(np.ravel_multi_index((ch_id,) + (0,) * (len(page_shape) - 1), page_shape))].index
+        for ch_id in channel_ids
+    ]
+
+
+def open_page_reader(path: Path, page_index: int):
+    """Opens one page of a TIFF file for windowed reading without loading it:
+    contiguous pages are memory-mapped, compressed or tiled pages are opened
+    as zarr arrays that decode only the chunks a slice touches
+    """
+    try:
+        return tif.memmap(path, page=page_index, mode="r")
+    except ValueError:
+        store = tif.imread(path, key=page_index, aszarr=True)
+        return zarr.open(store, mode="r")
+
+
+def get_wide_dtype(dtype: np.dtype) -> np.dtype:
+    """dtype that holds a sum of a few channels without overflow"""
+    if np.issubdtype(dtype, np.unsignedinteger):
+        return np.dtype(np.uint64)
+    if np.issubdtype(dtype, np.integer):
+        return np.dtype(np.int64)
+    return np.dtype(np.float64)
+
+
+def get_dtype_limits(dtype: np.dtype) -> tuple:
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+    else:
+        info = np.finfo(dtype)
+    return info.min, info.max
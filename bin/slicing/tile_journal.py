@@ -0,0 +1,107 @@
+import hashlib
+import json
+import threading
+from pathlib import Path
+from typing import Optional
+
+JOURNAL_NAME_TEMPLATE = "slicing_journal_{name}.jsonl"
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def get_journal_path(out_dir: Path, name: str) -> Path:
+    """Journals are kept next to the tile directories, outside of the R* glob
+    that collects tiles for segmentation
+    """
+    return out_dir / JOURNAL_NAME_TEMPLATE.format(name=name)
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TileJournal:
+    """Append-only record of finished tiles, one JSON line per tile with
+    file size, content hash and any extra fields (e.g. tile occupancy).
+    The first line stores the slicing parameters, a journal written
+    with different parameters is discarded and started over.
+    A line is appended only after the tile file is renamed into place,
+    so a tile is either recorded and complete or not recorded at all.
+    A truncated last line left by a killed process is ignored.
+    """
+
+    def __init__(self, path: Path, params: dict):
+        self.path = path
+        self.params = json.loads(json.dumps(params))
+        self.entries = self._load()
+        self._lock = threading.Lock()
+        if self.entries is None:
+            self.entries = dict()
+            self._file = open(path, "w")
+            self._append({"params": self.params})
+        else:
+            self._file = open(path, "a")
+
+    def _load(self) -> Optional[dict]:
+        if not self.path.exists():
+            return None
+        entries = dict()
+        with open(self.path, "r") as f:
+            lines = f.read().splitlines()
+        if not lines:
+            return None
+        try:
+            header = json.loads(lines[0])
+        except json.JSONDecodeError:
+            return None
+        if header.get("params") != self.params:
+            print("Slicing parameters changed, discarding journal", self.path)
+            return None
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entries[entry["name"]] = entry
+        return entries
+
+    def _append(self, entry: dict):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def get_finished(self, name: str, out_dir: Path) -> Optional[dict]:
+        """Journal entry of the tile if it was finished and its file
+        still has the recorded size and hash, None otherwise
+        """
+        entry = self.entries.get(name)
+        if entry is None or entry.get("empty", False):
+            return entry
+        path = out_dir / name
+        if not path.exists() or path.stat().st_size != entry["size"]:
+            return None
+        if hash_file(path) != entry["hash"]:
+            return None
+        return entry
+
+    def record(self, name: str, path: Optional[Path] = None, **fields):
+        """Records a finished tile, path is None for tiles that are not written"""
+        entry = {"name": name, **fields}
+        if path is not None:
+            entry["size"] = path.stat().st_size
+            entry["hash"] = hash_file(path)
+        with self._lock:
+            self.entries[name] = entry
+            self._append(entry)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
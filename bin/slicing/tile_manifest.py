@@ -0,0 +1,102 @@
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from slicer import get_tile_grid, get_tile_label
+
+TILE_MANIFEST_NAME = "tile_manifest.json"
+TILE_MANIFEST_VERSION = 1
+
+
+def get_stitch_range(
+    tile_id: int, ntiles: int, tile_size: int, overlap: int, img_size: int
+) -> Tuple[List[int], List[int]]:
+    """Range of a tile (with overlap) and of the stitched image along one axis
+    where the tile is placed when masks are stitched. Same placement as
+    mask_stitching.get_slices, but clipped to the image instead of padded.
+    """
+    if ntiles == 1:
+        tile_range = [overlap, tile_size + overlap]
+        img_range = [0, tile_size]
+    elif tile_id == 0:
+        tile_range = [overlap, tile_size + overlap * 2]
+        img_range = [0, tile_size + overlap]
+    elif tile_id == ntiles - 1:
+        tile_range = [overlap, tile_size + overlap]
+        img_range = [tile_id * tile_size, tile_id * tile_size + tile_size]
+    else:
+        tile_range = [overlap, tile_size + overlap * 2]
+        img_range = [tile_id * tile_size, tile_id * tile_size + tile_size + overlap]
+
+    outside = img_range[1] - img_size
+    if outside > 0:
+        img_range[1] -= outside
+        tile_range[1] -= outside
+    return tile_range, img_range
+
+
+def build_tile_manifest(
+    img_shape: Tuple[int, int],
+    tile_shape: Tuple[int, int],
+    overlap: int,
+    empty_tiles: Iterable[str] = (),
+    tile_keys: Optional[Dict[str, str]] = None,
+    cached_tiles: Optional[Dict[str, str]] = None,
+    region: int = 1,
+) -> dict:
+    """Describes every tile of the slicer grid: grid position, pixel window
+    without overlap, edge padding and the precomputed slices that place the tile
+    into the stitched image, so the stitcher doesn't need to rebuild the grid.
+    With the segmentation cache tiles also have their content key and
+    the path of the cached mask relative to the cache directory, if there is one.
+    """
+    img_height, img_width = img_shape
+    tile_h, tile_w = tile_shape
+    grid, x_ntiles, y_ntiles = get_tile_grid(img_width, img_height, tile_w, tile_h)
+    empty_tiles = set(empty_tiles)
+    tile_keys = tile_keys or dict()
+    cached_tiles = cached_tiles or dict()
+
+    tiles = []
+    for index, (co_ords, (hor_f, hor_t, ver_f, ver_t)) in enumerate(grid):
+        x, y = co_ords
+        tile_y_range, img_y_range = get_stitch_range(y, y_ntiles, tile_h, overlap, img_height)
+        tile_x_range, img_x_range = get_stitch_range(x, x_ntiles, tile_w, overlap, img_width)
+        label = get_tile_label(co_ords, region)
+        tiles.append(
+            {
+                "name": label,
+                "region": region,
+                "index": index,
+                "x": x,
+                "y": y,
+                "window": {"y": [ver_f, ver_t], "x": [hor_f, hor_t]},
+                "padding": {
+                    "left": max(0, overlap - hor_f),
+                    "right": max(0, hor_t + overlap - img_width),
+                    "top": max(0, overlap - ver_f),
+                    "bottom": max(0, ver_t + overlap - img_height),
+                },
+                "stitch": {
+                    "tile_slice": [tile_y_range, tile_x_range],
+                    "image_slice": [img_y_range, img_x_range],
+                },
+                "empty": label in empty_tiles,
+                "key": tile_keys.get(label),
+                "cached_mask": cached_tiles.get(label),
+            }
+        )
+
+    return {
+        "version": TILE_MANIFEST_VERSION,
+        "image_shape": [int(img_height), int(img_width)],
+        "tile_shape_no_overlap": [int(tile_h), int(tile_w)],
+        "overlap": overlap,
+        "num_tiles": {"x": x_ntiles, "y": y_ntiles},
+        "tiles": tiles,
+    }
+
+
+def save_tile_manifest(manifest: Dict, out_path: Path):
+    with open(out_path, "w") as f:
+        json.dump(manifest, f, indent=1)
@@ -0,0 +1,95 @@
+import heapq
+import json
+import shutil
+from pathlib import Path
+from typing import Dict, List
+
+SHARD_MANIFEST_NAME = "shard_manifest.json"
+SHARD_MANIFEST_VERSION = 1
+SHARD_DIR_PREFIX = "shard_"
+
+
+def get_shard_name(shard_id: int) -> str:
+    return f"{SHARD_DIR_PREFIX}{shard_id:03d}"
+
+
+def estimate_tile_work(occupancy_per_channel: Dict[str, dict], tile_pixels: int) -> int:
+    """Number of nonzero pixels in the fullest channel of a tile,
+    segmentation time grows with the amount of tissue in a tile
+    """
+    nonzero_fraction = max(o["nonzero_fraction"] for o in occupancy_per_channel.values())
+    return int(round(nonzero_fraction * tile_pixels))
+
+
+def assign_tiles_to_shards(work: Dict[str, int], num_shards: int) -> List[List[str]]:
+    """Greedy bin-packing: tiles in decreasing order of work go to the shard
+    with the least work so far, ties go to the shard with fewer tiles.
+    Tiles keep grid order inside a shard. Without work there are no shards.
+    """
+    if not work:
+        return []
+    num_shards = max(1, min(num_shards, len(work)))
+    heap = [(0, 0, shard_id) for shard_id in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    order = {name: i for i, name in enumerate(work)}
+    for name in sorted(work, key=lambda n: (-work[n], order[n])):
+        shard_work, shard_tiles, shard_id = heapq.heappop(heap)
+        shards[shard_id].append(name)
+        heapq.heappush(heap, (shard_work + work[name], shard_tiles + 1, shard_id))
+    return [sorted(tiles, key=order.get) for tiles in shards]
+
+
+def build_shard_manifest(shards: List[List[str]], work: Dict[str, int]) -> dict:
+    """Shards without tiles are left out, segmentation gets no empty directories"""
+    shards = [tiles for tiles in shards if tiles]
+    return {
+        "version": SHARD_MANIFEST_VERSION,
+        "num_shards": len(shards),
+        "shards": [
+            {
+                "name": get_shard_name(shard_id),
+                "work": sum(work[name] for name in tiles),
+                "tiles": tiles,
+            }
+            for shard_id, tiles in enumerate(shards)
+        ],
+    }
+
+
+def move_tiles_into_shards(tiles_dir: Path, manifest: dict):
+    """Moves tile directories R*_X*_Y* into tiles_dir/shard_NNN/ directories"""
+    for shard in manifest["shards"]:
+        if not shard["tiles"]:
+            continue
+        shard_dir = tiles_dir / shard["name"]
+        shard_dir.mkdir(exist_ok=True)
+        for name in shard["tiles"]:
+            shutil.move(tiles_dir / name, shard_dir / name)
+
+
+def unshard_tiles(tiles_dir: Path):
+    """Moves tile directories out of shard directories left by a previous run,
+    so that sliced tiles are found where the slicing journal expects them
+    """
+    for shard_dir in sorted(tiles_dir.glob(SHARD_DIR_PREFIX + "*")):
+        for tile_dir in shard_dir.iterdir():
+            if not (tiles_dir / tile_dir.name).exists():
+                shutil.move(tile_dir, tiles_dir / tile_dir.name)
+        shutil.rmtree(shard_dir)
+
+
+def print_shard_balance(manifest: dict):
+    for shard in manifest["shards"]:
+        print(shard["name"], "| tiles:", len(shard["tiles"]), "| nonzero pixels:", shard["work"])
+    if not manifest["shards"]:
+        print("No tiles to segment, no shards")
+        return
+    works = [shard["work"] for shard in manifest["shards"]]
+    mean_work = sum(works) / len(works)
+    if mean_work > 0:
+        print("Slowest shard vs mean, work ratio: {:.3f}".format(max(works) / mean_work))
+
+
+def save_shard_manifest(manifest: dict, out_path: Path):
+    with open(out_path, "w") as s:
+        json.dump(manifest, s, indent=1)
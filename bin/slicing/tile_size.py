@@ -0,0 +1,106 @@
+import math
+from typing import Tuple
+
+# Rough peak memory of segmentation per pixel of input tile,
+# covers both input channels, model activations and output masks
+SEGMENTATION_BYTES_PER_PIXEL = 128
+TILE_SIZE_STEP = 256
+MIN_TILE_SIZE = 1024
+
+
+def get_num_tiles(img_shape: Tuple[int, int], tile_shape: Tuple[int, int]) -> Tuple[int, int]:
+    img_height, img_width = img_shape
+    return math.ceil(img_height / tile_shape[0]), math.ceil(img_width / tile_shape[1])
+
+
+def estimate_tile_memory(
+    tile_shape: Tuple[int, int],
+    overlap: int,
+    bytes_per_pixel: int = SEGMENTATION_BYTES_PER_PIXEL,
+) -> int:
+    """Estimated peak memory in bytes to segment one tile including overlap"""
+    return (tile_shape[0] + overlap * 2) * (tile_shape[1] + overlap * 2) * bytes_per_pixel
+
+
+def get_segmented_pixels(
+    img_shape: Tuple[int, int], tile_shape: Tuple[int, int], overlap: int
+) -> int:
+    """Number of pixels in all tiles including overlap and padding"""
+    y_ntiles, x_ntiles = get_num_tiles(img_shape, tile_shape)
+    return y_ntiles * x_ntiles * (tile_shape[0] + overlap * 2) * (tile_shape[1] + overlap * 2)
+
+
+def get_redundant_pixel_fraction(
+    img_shape: Tuple[int, int], tile_shape: Tuple[int, int], overlap: int
+) -> float:
+    """Fraction of pixels sent to segmentation that are not image pixels,
+    i.e. overlap between tiles and padding of the last row and column
+    """
+    processed_pixels = get_segmented_pixels(img_shape, tile_shape, overlap)
+    return 1 - (img_shape[0] * img_shape[1]) / processed_pixels
+
+
+def choose_tile_size(
+    img_shape: Tuple[int, int],
+    overlap: int,
+    memory_budget_gb: float,
+    num_workers: int,
+    bytes_per_pixel: int = SEGMENTATION_BYTES_PER_PIXEL,
+) -> int:
+    """Picks square tile size that minimizes estimated segmentation wall time.
+    Tiles are segmented num_workers at a time, so the wall time is roughly
+    number of rounds times pixels per tile, which trades off underused workers
+    against redundant overlap pixels. Candidates are multiples of TILE_SIZE_STEP
+    that fit into the per-worker memory budget.
+    """
+    budget = memory_budget_gb * 1024**3
+    max_by_memory = int(math.sqrt(budget / bytes_per_pixel)) - overlap * 2
+    max_by_image = math.ceil(max(img_shape) / TILE_SIZE_STEP) * TILE_SIZE_STEP
+    max_tile_size = min(max_by_memory, max_by_image)
+    if max_tile_size < MIN_TILE_SIZE:
+        print(
+            "Memory budget of",
+            memory_budget_gb,
+            "GB fits tiles of at most",
+            max_tile_size,
+            "px, using minimal tile size",
+            MIN_TILE_SIZE,
+        )
+        return MIN_TILE_SIZE
+
+    best_tile_size = None
+    best_cost = None
+    for tile_size in range(MIN_TILE_SIZE, max_tile_size + 1, TILE_SIZE_STEP):
+        y_ntiles, x_ntiles = get_num_tiles(img_shape, (tile_size, tile_size))
+        num_tiles = y_ntiles * x_ntiles
+        tile_pixels = (tile_size + overlap * 2) ** 2
+        rounds = math.ceil(num_tiles / max(1, num_workers))
+        cost = (rounds * tile_pixels, num_tiles * tile_pixels)
+        if best_cost is None or cost < best_cost:
+            best_tile_size = tile_size
+            best_cost = cost
+    return best_tile_size
+
+
+def print_tiling_estimate(img_shape: Tuple[int, int], tile_shape: Tuple[int, int], overlap: int):
+    y_ntiles, x_ntiles = get_num_tiles(img_shape, tile_shape)
+    print(
+        "Image shape y,x:",
+        tuple(img_shape),
+        "| tile shape y,x:",
+        tuple(tile_shape),
+        "| overlap:",
+        overlap,
+        "| n tiles x,y:",
+        (x_ntiles, y_ntiles),
+    )
+    print(
+        "Pixels sent to segmentation:",
+        get_segmented_pixels(img_shape, tile_shape, overlap),
+        "| redundant pixel fraction: {:.3f}".format(
+            get_redundant_pixel_fraction(img_shape, tile_shape, overlap)
+        ),
+        "| estimated peak segmentation memory per tile, GB: {:.2f}".format(
+            estimate_tile_memory(tile_shape, overlap) / 1024**3
+        ),
+    )
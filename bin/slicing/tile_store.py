@@ -0,0 +1,165 @@
+import argparse
+import time
+from pathlib import Path
+from typing import Optional, Sequence, Union
+
+import numpy as np
+import zarr
+from slicer import (
+    MULTICHANNEL_TILE_SUFFIX,
+    TileWriter,
+    get_tile,
+    get_tile_grid,
+    get_tile_label,
+    get_tile_name,
+    get_tile_occupancy,
+    get_tile_shape,
+    is_empty_tile,
+    open_image,
+    write_tile,
+)
+
+TILE_STORE_NAME = "tiles.zarr"
+TILE_STORE_DIMS = ("c", "tile_y", "tile_x", "y", "x")
+
+
+def tile_store_compressor():
+    return zarr.codecs.BloscCodec(cname="zstd", clevel=3, shuffle="bitshuffle")
+
+
+def write_tile_store(
+    in_paths: dict[str, Path],
+    store_path: Path,
+    tile_size: Union[int, Sequence[int]],
+    overlap: int,
+    read_mode: str = "windowed",
+    num_writers: int = None,
+    empty_tile_threshold: Optional[float] = None,
+) -> dict:
+    """Writes the padded, overlapping tile grid of all channels into one chunked
+    zarr array with dimensions (channel, tile row, tile column, y, x).
+    Every chunk is one tile of one channel, chunks are compressed and written in parallel.
+    Array attributes hold the channel names, slicer geometry and a tile index
+    that maps tile names like R1_X1_Y1 to their position in the grid
+    and per-channel occupancy. Chunks of tiles that are empty in every channel
+    are not written, they read back as zeros and are marked as empty in the index.
+    Returns number of tiles, bytes of tile data, elapsed seconds,
+    per-channel occupancy of every tile and names of skipped empty tiles.
+    """
+    start = time.perf_counter()
+    channel_names = list(in_paths.keys())
+    print("Writing tile store", store_path, "from", in_paths)
+    arrs = [open_image(in_path, read_mode) for in_path in in_paths.values()]
+    img_shapes = {arr.shape for arr in arrs}
+    if len(img_shapes) != 1:
+        raise ValueError(f"Segmentation channel images have different shapes: {img_shapes}")
+
+    arr_height, arr_width = arrs[0].shape[-2:]
+    tile_h, tile_w = get_tile_shape(tile_size)
+    grid, x_ntiles, y_ntiles = get_tile_grid(arr_width, arr_height, tile_w, tile_h)
+    tile_shape = (tile_h + overlap * 2, tile_w + overlap * 2)
+
+    store = zarr.create_array(
+        store=str(store_path),
+        shape=(len(arrs), y_ntiles, x_ntiles, *tile_shape),
+        chunks=(1, 1, 1, *tile_shape),
+        dtype=arrs[0].dtype,
+        compressors=tile_store_compressor(),
+        fill_value=0,
+        dimension_names=TILE_STORE_DIMS,
+        attributes={
+            "channels": channel_names,
+            "image_shape": [int(arr_height), int(arr_width)],
+            "tile_shape_no_overlap": [tile_h, tile_w],
+            "overlap": overlap,
+        },
+        overwrite=True,
+    )
+
+    def write_chunk(key: tuple, tile: np.ndarray):
+        store[key] = tile
+
+    num_tiles = 0
+    num_bytes = 0
+    tile_index = []
+    empty_tiles = []
+    with TileWriter(num_workers=num_writers, write=write_chunk) as writer:
+        for tile_num, (co_ords, window) in enumerate(grid):
+            print(co_ords, x_ntiles, y_ntiles, tile_num)
+            tiles = [get_tile(arr, *window, overlap) for arr in arrs]
+            label = get_tile_label(co_ords)
+            occupancy = {c: get_tile_occupancy(t) for c, t in zip(channel_names, tiles)}
+            empty = is_empty_tile(occupancy, empty_tile_threshold)
+            tile_index.append(
+                {
+                    "name": label,
+                    "x": co_ords[0],
+                    "y": co_ords[1],
+                    "window": list(window),
+                    "occupancy": occupancy,
+                    "empty": empty,
+                }
+            )
+            if empty:
+                print("Skipping empty tile", label)
+                empty_tiles.append(label)
+                continue
+            for c, tile in enumerate(tiles):
+                writer.submit((c, co_ords[1], co_ords[0]), tile)
+                num_bytes += tile.nbytes
+            num_tiles += 1
+    store.attrs["tiles"] = tile_index
+    return {
+        "num_tiles": num_tiles,
+        "num_bytes": num_bytes,
+        "seconds": time.perf_counter() - start,
+        "occupancy": {tile_info["name"]: tile_info["occupancy"] for tile_info in tile_index},
+        "empty_tiles": empty_tiles,
+    }
+
+
+def export_tile_dirs(
+    store_path: Path,
+    out_dir: Path,
+    output_mode: str = "per_channel",
+    num_writers: int = None,
+):
+    """Recreates the R*_X*_Y*/ tile directories of the regular slicer output from
+    a tile store, so steps that expect individual tile files can still run.
+    Tiles marked as empty in the tile index are left out, as in the slicer output.
+    """
+    store = zarr.open_array(str(store_path), mode="r")
+    channel_names = store.attrs["channels"]
+    metadata = {"axes": "CYX", "Channel": {"Name": channel_names}}
+    with TileWriter(num_workers=num_writers, write=write_tile) as writer:
+        for tile_info in store.attrs["tiles"]:
+            if tile_info["empty"]:
+                continue
+            co_ords = (tile_info["x"], tile_info["y"])
+            tile = store[:, tile_info["y"], tile_info["x"]]
+            if output_mode == "multichannel":
+                names_and_tiles = [(MULTICHANNEL_TILE_SUFFIX, tile)]
+            else:
+                names_and_tiles = list(zip(channel_names, tile))
+            for channel_name, channel_tile in names_and_tiles:
+                base = out_dir / get_tile_name(co_ords, channel_name)
+                print("Saving ", base)
+                base.parent.mkdir(exist_ok=True, parents=True)
+                if output_mode == "multichannel":
+                    writer.submit(base, channel_tile, metadata=metadata)
+                else:
+                    writer.submit(base, channel_tile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write tile directories in the regular slicer layout from a tile store"
+    )
+    parser.add_argument("--tile_store", type=Path, help="path to tiles.zarr")
+    parser.add_argument("--out_dir", type=Path, default=Path("output/new_tiles"))
+    parser.add_argument(
+        "--output_mode", choices=("per_channel", "multichannel"), default="per_channel"
+    )
+    args = parser.parse_args()
+
+    export_tile_dirs(args.tile_store, args.out_dir, args.output_mode)
@@ -1,3 +1,33 @@
+import math
+from functools import lru_cache
+
+import numpy as np
+
+TILE_LAYOUTS = ("fixed", "balanced")
+
+
+def get_balanced_tile_shape(img_shape, max_tile_shape):
+    """Get tile shape that splits image into near-equal tiles
+
+    Keeps the number of tiles that tiles of max_tile_shape would give along each axis,
+    but shrinks tiles so that the remainder is spread over all of them
+    instead of padding the last row and column.
+
+    Args:
+        img_shape: image (height, width)
+        max_tile_shape: largest allowed tile (height, width)
+    Returns:
+        tile_height, tile_width - padding is less than the number of tiles along each axis
+    """
+    tile_shape = []
+    for img_size, max_tile_size in zip(img_shape, max_tile_shape):
+        if max_tile_size <= 0:
+            raise ValueError("Tile size must be > 0")
+        ntiles = math.ceil(img_size / max_tile_size)
+        tile_shape.append(math.ceil(img_size / ntiles))
+    return tuple(tile_shape)
+
+
 class Tiling(object):
     def coordinates_from_index(self, index, w, h):
         """Get tile coordinates from index
@@ -32,12 +62,59 @@ class Tiling(object):
             raise ValueError("Height must be >= 0")
         return self._index_from_coordinates(x, y, w, h)
 
+    def coordinates_from_indices(self, indices, w, h):
+        """Get tile coordinates of many indices at once
+
+        Args:
+            indices: array of 0-based tile indices
+            w: width of grid
+            h: height of grid
+        Returns:
+            xs, ys - arrays of 0-based grid coordinates
+        """
+        if w <= 0:
+            raise ValueError("Width must be >= 0")
+        if h <= 0:
+            raise ValueError("Height must be >= 0")
+        return self._coordinates_from_indices(np.asarray(indices, dtype=np.int64), w, h)
+
+    def indices_from_coordinates(self, xs, ys, w, h):
+        """Get tile indices of many coordinates at once
+
+        Args:
+            xs: array of 0-based X grid coordinates
+            ys: array of 0-based Y grid coordinates
+            w: width of grid
+            h: height of grid
+        Returns:
+            array of 0-based tile indices
+        """
+        if w <= 0:
+            raise ValueError("Width must be >= 0")
+        if h <= 0:
+            raise ValueError("Height must be >= 0")
+        xs = np.asarray(xs, dtype=np.int64)
+        ys = np.asarray(ys, dtype=np.int64)
+        return self._indices_from_coordinates(xs, ys, w, h)
+
     def _coordinates_from_index(self, index, w, h):
         raise NotImplementedError()
 
     def _index_from_coordinates(self, x, y, w, h):
         raise NotImplementedError()
 
+    def _coordinates_from_indices(self, indices, w, h):
+        coordinates = [self._coordinates_from_index(int(i), w, h) for i in indices.ravel()]
+        xs, ys = np.array(coordinates, dtype=np.int64).reshape(-1, 2).T
+        return xs.reshape(indices.shape), ys.reshape(indices.shape)
+
+    def _indices_from_coordinates(self, xs, ys, w, h):
+        indices = [
+            self._index_from_coordinates(int(x), int(y), w, h)
+            for x, y in zip(xs.ravel(), ys.ravel())
+        ]
+        return np.array(indices, dtype=np.int64).reshape(xs.shape)
+
     def get_projection_map(self, src_dims, tgt_dims, origin):
         """Get 0-based projection map from a larger tiling to a smaller one
 
@@ -49,23 +126,14 @@ class Tiling(object):
         Returns:
             Array where index in array corresponds to smaller grid index and value to index in larger grid (all 0-based)
         """
-        import numpy as np
-
         n = tgt_dims[0] * tgt_dims[1]
-        remap = []
-        for i in range(n):
-            # Get coordinates of index on target grid
-            tgt_p = self.coordinates_from_index(i, w=tgt_dims[0], h=tgt_dims[1])
+        # Get coordinates of every index on target grid
+        tgt_xs, tgt_ys = self.coordinates_from_indices(np.arange(n), w=tgt_dims[0], h=tgt_dims[1])
 
-            # Add target point to point on source (i.e. larger) grid
-            src_p = (origin[0] + tgt_p[0], origin[1] + tgt_p[1])
-
-            # Map target grid index to index on original grid
-            src_i = self.index_from_coordinates(
-                x=src_p[0], y=src_p[1], w=src_dims[0], h=src_dims[1]
-            )
-            remap.append(src_i)
-        return np.array(remap)
+        # Map target grid points to indices on source (i.e. larger) grid
+        return self.indices_from_coordinates(
+            origin[0] + tgt_xs, origin[1] + tgt_ys, w=src_dims[0], h=src_dims[1]
+        )
 
 
 class SnakeTiling(Tiling):
@@ -86,6 +154,16 @@ class SnakeTiling(Tiling):
             i += x
         return i
 
+    def _coordinates_from_indices(self, indices, w, h):
+        ys = indices // w
+        xs = indices % w
+        odd = ys % 2 == 1
+        xs[odd] = w - xs[odd] - 1
+        return xs, ys
+
+    def _indices_from_coordinates(self, xs, ys, w, h):
+        return ys * w + np.where(ys % 2 == 1, w - xs - 1, xs)
+
 
 class GridTiling(Tiling):
     """Grid tiling implies movements as left-to-right, reset, and then left-to-right, repeat (i.e. reading order)"""
@@ -96,8 +174,72 @@ class GridTiling(Tiling):
     def _index_from_coordinates(self, x, y, w, h):
         return y * w + x
 
+    def _coordinates_from_indices(self, indices, w, h):
+        return indices % w, indices // w
+
+    def _indices_from_coordinates(self, xs, ys, w, h):
+        return ys * w + xs
+
+
+def hilbert_distance(xs, ys, n):
+    """Distance along the Hilbert curve that fills an n x n grid, n is a power of 2"""
+    xs = np.array(xs, dtype=np.int64)
+    ys = np.array(ys, dtype=np.int64)
+    d = np.zeros_like(xs)
+    s = n // 2
+    while s > 0:
+        rx = (xs & s) > 0
+        ry = (ys & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # rotate quadrant so that the curve inside it has the base orientation
+        flip = ~ry & rx
+        xs[flip] = n - 1 - xs[flip]
+        ys[flip] = n - 1 - ys[flip]
+        swap = ~ry
+        xs[swap], ys[swap] = ys[swap], xs[swap].copy()
+        s //= 2
+    return d
+
+
+@lru_cache(maxsize=32)
+def get_hilbert_order(w, h):
+    """Row-major indices of a w x h grid in the order of the Hilbert curve
+    that fills the smallest enclosing power of 2 square, and rank of every cell
+    """
+    n = 1 << max(w - 1, h - 1, 0).bit_length()
+    row_major = np.arange(w * h, dtype=np.int64)
+    order = np.argsort(hilbert_distance(row_major % w, row_major // w, n), kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = row_major
+    order.setflags(write=False)
+    rank.setflags(write=False)
+    return order, rank
+
+
+class HilbertTiling(Tiling):
+    """Hilbert tiling follows a space-filling curve, consecutive tiles are grid neighbours,
+    so tiles that are close in the grid are also processed close in time.
+    Grids that are not a power of 2 square follow the curve of the enclosing square
+    """
+
+    def _coordinates_from_index(self, index, w, h):
+        xs, ys = self._coordinates_from_indices(np.array([index]), w, h)
+        return int(xs[0]), int(ys[0])
+
+    def _index_from_coordinates(self, x, y, w, h):
+        return int(self._indices_from_coordinates(np.array([x]), np.array([y]), w, h)[0])
+
+    def _coordinates_from_indices(self, indices, w, h):
+        order, _ = get_hilbert_order(w, h)
+        row_major = order[indices]
+        return row_major % w, row_major // w
+
+    def _indices_from_coordinates(self, xs, ys, w, h):
+        _, rank = get_hilbert_order(w, h)
+        return rank[ys * w + xs]
+
 
-TILINGS = {"snake": SnakeTiling(), "grid": GridTiling()}
+TILINGS = {"snake": SnakeTiling(), "grid": GridTiling(), "hilbert": HilbertTiling()}
 
 
 def get_tiling_by_name(name):
@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# Scripts in these directories import their siblings directly,
+# the same way they are run inside the container
+bin_dir = Path(__file__).resolve().parent.parent
+for script_dir in ("slicing", "secondary_stitcher"):
+    sys.path.insert(0, str(bin_dir / script_dir))
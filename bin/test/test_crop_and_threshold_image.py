@@ -0,0 +1,55 @@
+import json
+
+import numpy as np
+import tifffile as tif
+
+import crop_input_image
+import threshold_image
+from crop_and_threshold_image import main
+
+
+def test_fused_crop_and_threshold_matches_two_steps(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    stack = rng.integers(0, 1000, size=(3, 700, 600), dtype=np.uint16)
+    in_dir = tmp_path / "in"
+    in_dir.mkdir()
+    in_path = in_dir / "img.ome.tiff"
+    tif.imwrite(
+        in_path,
+        stack,
+        ome=True,
+        metadata={
+            "axes": "CYX",
+            "Channel": {"Name": ["DAPI", "CD45", "CD3"]},
+            "PhysicalSizeX": 0.5,
+            "PhysicalSizeXUnit": "µm",
+            "PhysicalSizeY": 0.5,
+            "PhysicalSizeYUnit": "µm",
+        },
+    )
+    dataset_dir = tmp_path / "dataset"
+    dataset_dir.mkdir()
+    (dataset_dir / "channels.csv").write_text(
+        "channel_id,threshold low,threshold\nDAPI,100,800\nCD45,,500\nCD3,250,\n"
+    )
+    polygon = [[240.5, 230.2], [400.7, 260.1], [350.3, 450.9], [245.1, 380.4], [240.5, 230.2]]
+    with open(dataset_dir / "tissue.geojson", "w") as f:
+        json.dump({"type": "Polygon", "coordinates": [polygon]}, f)
+
+    two_step_dir = tmp_path / "two_step"
+    monkeypatch.setattr(crop_input_image, "output_path_base", two_step_dir / "results")
+    monkeypatch.chdir(tmp_path)
+    crop_input_image.crop_image(in_path, dataset_dir, False, debug=False)
+    monkeypatch.chdir(two_step_dir)
+    threshold_image.main(two_step_dir / "results" / "aligned_tissue_0.ome.tiff", dataset_dir)
+
+    fused_dir = tmp_path / "fused"
+    monkeypatch.setattr(crop_input_image, "output_path_base", fused_dir / "results")
+    main(in_path, dataset_dir, False, num_workers=2)
+
+    two_step = tif.imread(two_step_dir / "aligned_tissue_0.ome.tiff").squeeze()
+    with tif.TiffFile(fused_dir / "results" / "aligned_tissue_0.ome.tiff") as TF:
+        fused = TF.series[0].asarray()
+        assert threshold_image.get_channel_names(TF.ome_metadata) == ["DAPI", "CD45", "CD3"]
+    assert fused.shape == two_step.shape == (3, 476, 416)
+    np.testing.assert_array_equal(fused, two_step)
@@ -0,0 +1,132 @@
+import math
+
+import bioio
+import numpy as np
+import pytest
+import shapely
+import tifffile as tif
+from skimage.measure import regionprops
+
+import crop_input_image
+from crop_input_image import (
+    get_crop_mask,
+    get_crop_window,
+    get_overview,
+    open_plane_readers,
+    read_cropped_channels,
+)
+from slicing.tiff_pages import open_page_reader
+
+
+@pytest.mark.parametrize("exclude_mask_content", [False, True])
+@pytest.mark.parametrize("seed", range(5))
+def test_crop_window_matches_full_image_mask(seed, exclude_mask_content):
+    rng = np.random.default_rng(seed)
+    image_shape = (300, 250)
+    padding = 16
+    # random polygons, some of them reaching over the image border
+    polygons = [
+        shapely.Point(rng.uniform(-20, 270), rng.uniform(-20, 320)).buffer(rng.uniform(5, 60))
+        for _ in range(rng.integers(1, 4))
+    ]
+    closed_geometry = shapely.GeometryCollection(polygons)
+
+    mask = get_crop_mask(closed_geometry, image_shape, exclude_mask_content)
+    (rp,) = regionprops(mask.astype(np.uint8))
+    min_y, min_x, max_y, max_x = rp.bbox
+    expected_slices = (
+        slice(max(0, min_y - padding), min(max_y + padding, image_shape[0])),
+        slice(max(0, min_x - padding), min(max_x + padding, image_shape[1])),
+    )
+
+    pixel_slices, mask_cropped = get_crop_window(
+        closed_geometry, image_shape, padding, exclude_mask_content
+    )
+    assert pixel_slices == expected_slices
+    np.testing.assert_array_equal(mask_cropped, mask[expected_slices])
+
+
+def test_overview_matches_block_mean_of_channel_sum(monkeypatch):
+    # several bands per channel, the last one cut by the image edge
+    monkeypatch.setattr(crop_input_image, "overview_band_rows", 20)
+    rng = np.random.default_rng(0)
+    channels = list(rng.integers(0, 1000, size=(3, 107, 83), dtype=np.uint16))
+
+    overview, factor = get_overview(channels, max_dim=30)
+
+    assert factor == 4
+    channel_sum = np.sum(channels, axis=0, dtype=np.float64)
+    padded = np.zeros((108, 84))
+    padded[:107, :83] = channel_sum
+    expected = np.log1p(padded.reshape(27, 4, 21, 4).mean(axis=(1, 3)))
+    np.testing.assert_allclose(overview, expected)
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_read_cropped_channels_matches_full_image_crop(tmp_path, compression):
+    rng = np.random.default_rng(0)
+    data = rng.integers(1, 2**16, size=(3, 2, 60, 70), dtype=np.uint16)
+    image_path = tmp_path / "image.ome.tif"
+    tif.imwrite(
+        image_path,
+        data,
+        ome=True,
+        metadata={"axes": "CZYX"},
+        compression=compression,
+        rowsperstrip=8,
+    )
+    pixel_slices = (slice(11, 37), slice(5, 48))
+    outside = rng.random((26, 43)) < 0.3
+
+    readers = open_plane_readers(image_path)
+    assert readers.shape == (1, 3, 2)
+    cropped = read_cropped_channels(readers, pixel_slices, outside)
+
+    expected = bioio.BioImage(image_path).data[:, :, :, *pixel_slices]
+    expected[..., outside] = 0
+    assert cropped.dtype == expected.dtype
+    np.testing.assert_array_equal(cropped, expected)
+
+
+class CountingReader:
+    def __init__(self, reader, reads: list):
+        self.reader = reader
+        self.shape = reader.shape
+        self.dtype = reader.dtype
+        self.reads = reads
+
+    def __getitem__(self, key):
+        self.reads.append(key)
+        return self.reader[key]
+
+
+@pytest.mark.parametrize("window", [None, (slice(13, 101), slice(7, 60))])
+def test_overview_reads_each_band_of_each_page_once(tmp_path, monkeypatch, window):
+    monkeypatch.setattr(crop_input_image, "overview_band_rows", 16)
+    page_reads = {}
+
+    def open_counting_reader(path, page_index):
+        reads = page_reads.setdefault(page_index, [])
+        return CountingReader(open_page_reader(path, page_index), reads)
+
+    monkeypatch.setattr(crop_input_image, "open_page_reader", open_counting_reader)
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 1000, size=(2, 120, 90), dtype=np.uint16)
+    image_path = tmp_path / "image.ome.tif"
+    tif.imwrite(image_path, data, ome=True, metadata={"axes": "CYX"}, compression="zlib")
+
+    channels = list(open_plane_readers(image_path)[0, :, 0])
+    overview, factor = get_overview(channels, max_dim=30, window=window)
+
+    window = window or (slice(0, 120), slice(0, 90))
+    expected, expected_factor = get_overview(list(data[:, window[0], window[1]]), max_dim=30)
+    assert factor == expected_factor
+    np.testing.assert_allclose(overview, expected)
+    # every page is read once per band, each band only inside the window
+    num_bands = math.ceil((window[0].stop - window[0].start) / 16)
+    assert sorted(page_reads) == [0, 1]
+    for reads in page_reads.values():
+        assert len(reads) == num_bands
+        assert all(cols == window[1] for _, cols in reads)
+        rows_read = [rows.stop - rows.start for rows, _ in reads]
+        assert sum(rows_read) == window[0].stop - window[0].start
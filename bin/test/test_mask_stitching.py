@@ -0,0 +1,211 @@
+import os
+
+import numpy as np
+import pytest
+import tifffile as tif
+from mask_cache import evict_to_size, store_mask
+from mask_stitching import process_all_masks, stitch_mask
+
+from secondary_stitcher import (
+    get_dataset_info_from_manifest,
+    get_slice_table,
+    main,
+    write_upsampled_mask,
+)
+from slicing.modify_pipeline_config import generate_slicer_info
+from slicing.run_slicing import take_cached_tiles
+from slicing.segmentation_cache import get_tile_key, lookup_mask
+from slicing.slicer import get_tile_grid, split_by_size
+from slicing.tile_manifest import build_tile_manifest
+from slicing.tiling import get_balanced_tile_shape
+
+
+@pytest.mark.parametrize("tile_layout", ["fixed", "balanced"])
+def test_stitch_mask_restores_sliced_image(tile_layout):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 1000, size=(410, 530), dtype=np.uint32)
+    overlap = 12
+    tile_shape = (128, 128)
+    if tile_layout == "balanced":
+        tile_shape = get_balanced_tile_shape(img.shape, tile_shape)
+    slicer_info = generate_slicer_info(tile_shape, overlap, img.shape, tile_layout)["slicer"]
+
+    tiles = [tile for tile, _ in split_by_size(img, "cell", tile_shape[1], tile_shape[0], overlap)]
+    stitched = stitch_mask(
+        tiles,
+        slicer_info["num_tiles"]["y"],
+        slicer_info["num_tiles"]["x"],
+        list(tiles[0].shape),
+        np.uint32,
+        overlap,
+        slicer_info["padding"],
+    )
+    np.testing.assert_array_equal(stitched, img)
+
+
+def test_balanced_tiling_reduces_padding():
+    img_shape = (41_000, 30_500)
+    tile_shape = get_balanced_tile_shape(img_shape, (10_000, 10_000))
+    assert tile_shape == (8200, 7625)
+    fixed = generate_slicer_info((10_000, 10_000), 100, img_shape)["slicer"]
+    balanced = generate_slicer_info(tile_shape, 100, img_shape, "balanced")["slicer"]
+    assert balanced["num_tiles"] == fixed["num_tiles"]
+    assert balanced["padding"]["bottom"] == 0 and balanced["padding"]["right"] == 0
+    assert fixed["padding"]["bottom"] == 9000 and fixed["padding"]["right"] == 9500
+
+    _, x_ntiles, y_ntiles = get_tile_grid(img_shape[1], img_shape[0], *tile_shape[::-1])
+    assert (x_ntiles, y_ntiles) == (4, 5)
+
+
+def _make_mask_tiles(overlap: int, tile_shape=(64, 64)):
+    img = np.zeros((192, 192), dtype=np.uint32)
+    label = 1
+    for y in range(8, 120, 24):
+        for x in range(8, 184, 24):
+            img[y : y + 10, x : x + 10] = label
+            label += 1
+    tiles = [tile for tile, _ in split_by_size(img, "mask", tile_shape[1], tile_shape[0], overlap)]
+    # cells, nuclei, cell boundaries, nucleus boundaries
+    return [np.stack([t, t, t, t]) for t in tiles]
+
+
+def test_process_all_masks_treats_missing_tiles_as_empty():
+    overlap = 8
+    tiles = _make_mask_tiles(overlap)
+    # bottom row of 3x3 grid has no labels
+    assert all(t.max() == 0 for t in tiles[6:])
+    tiles_without_empty = tiles[:6] + [None, None, None]
+    padding = dict(left=0, right=0, top=0, bottom=0)
+
+    masks, _ = process_all_masks(tiles, [4, 80, 80], 3, 3, overlap, padding, np.uint32)
+    masks_without_empty, _ = process_all_masks(
+        tiles_without_empty, [4, 80, 80], 3, 3, overlap, padding, np.uint32
+    )
+    assert masks[0].max() > 0
+    for mask, mask_without_empty in zip(masks, masks_without_empty):
+        np.testing.assert_array_equal(mask, mask_without_empty)
+
+
+def test_process_all_masks_with_manifest_slice_table():
+    overlap = 8
+    img_shape = (180, 170)
+    tile_shape = (64, 64)
+    tiles = _make_mask_tiles(overlap, tile_shape)
+    manifest = build_tile_manifest(img_shape, tile_shape, overlap, empty_tiles=["R1_X3_Y3"])
+    assert [t["name"] for t in manifest["tiles"][:2]] == ["R1_X1_Y1", "R1_X2_Y1"]
+    assert manifest["tiles"][8]["padding"] == {"left": 0, "right": 30, "top": 0, "bottom": 20}
+    padding = generate_slicer_info(tile_shape, overlap, img_shape)["slicer"]["padding"]
+
+    masks, _ = process_all_masks(tiles, [4, 80, 80], 3, 3, overlap, padding, np.uint32)
+    masks_from_manifest, _ = process_all_masks(
+        tiles[:8] + [None],
+        [4, 80, 80],
+        3,
+        3,
+        overlap,
+        padding,
+        np.uint32,
+        get_slice_table(manifest),
+        tuple(manifest["image_shape"]),
+    )
+    for mask, mask_from_manifest in zip(masks, masks_from_manifest):
+        assert mask.shape == img_shape
+        np.testing.assert_array_equal(mask, mask_from_manifest)
+
+
+def test_segmentation_cache_roundtrip_and_eviction(tmp_path):
+    cache_dir = tmp_path / "cache"
+    keys = [get_tile_key({"nucleus": h, "cell": h}, "deepcell") for h in ("a", "b", "c")]
+    assert len(set(keys)) == 3
+    assert get_tile_key({"nucleus": "a", "cell": "a"}, "cellpose") != keys[0]
+    assert lookup_mask(cache_dir, "deepcell", keys[0]) is None
+
+    for i, key in enumerate(keys):
+        mask_path = tmp_path / f"R1_X{i + 1}_Y1_mask.ome.tiff"
+        mask_path.write_bytes(bytes(1000))
+        store_mask(cache_dir, "deepcell", key, mask_path)
+        os.utime(cache_dir / "deepcell" / key[:2] / key, (i, i))
+    hit = lookup_mask(cache_dir, "deepcell", keys[0])
+    assert hit.name == "R1_X1_Y1_mask.ome.tiff"
+
+    assert evict_to_size(cache_dir, 2500) == 1
+    assert lookup_mask(cache_dir, "deepcell", keys[1]) is None
+    assert lookup_mask(cache_dir, "deepcell", keys[0]) is not None
+    assert lookup_mask(cache_dir, "deepcell", keys[2]) is not None
+
+
+def test_cached_masks_are_found_in_staged_cache_dir(tmp_path):
+    cache_dir = tmp_path / "cache"
+    mask_path = tmp_path / "R1_X1_Y1.ome.tiff"
+    tif.imwrite(mask_path, np.ones((4, 16, 16), dtype=np.uint32))
+    hashes = {"R1_X1_Y1": {"nucleus": "a"}}
+    store_mask(cache_dir, "deepcell", get_tile_key(hashes["R1_X1_Y1"], "deepcell"), mask_path)
+    tiles_dir = tmp_path / "tiles"
+    (tiles_dir / "R1_X1_Y1").mkdir(parents=True)
+
+    keys, cached_tiles = take_cached_tiles(tiles_dir, hashes, [], cache_dir, "deepcell")
+    assert not os.path.isabs(cached_tiles["R1_X1_Y1"])
+    manifest = build_tile_manifest((16, 16), (16, 16), 0, [], keys, cached_tiles)
+
+    # the stitcher sees the cache at another path, like a directory staged by a CWL runner
+    staged_cache_dir = tmp_path / "staged" / "cache"
+    staged_cache_dir.parent.mkdir()
+    cache_dir.rename(staged_cache_dir)
+    (path_list,), _, _ = get_dataset_info_from_manifest([], manifest, None, staged_cache_dir)
+    np.testing.assert_array_equal(tif.imread(path_list[0]), tif.imread(mask_path))
+    with pytest.raises(ValueError, match="segmentation cache"):
+        get_dataset_info_from_manifest([], manifest)
+
+
+def test_write_upsampled_mask_matches_nearest_neighbour(tmp_path):
+    rng = np.random.default_rng(4)
+    mask = rng.integers(0, 50, size=(34, 27), dtype=np.uint32)
+    downsampling = {"factor": [3, 2], "source_shape": [100, 53]}
+    with tif.TiffWriter(tmp_path / "mask.tif", bigtiff=True, shaped=False) as TW:
+        write_upsampled_mask(TW, mask, downsampling, "", tile_size=16)
+
+    upsampled = tif.imread(tmp_path / "mask.tif")
+    expected = np.repeat(np.repeat(mask, 3, axis=0), 2, axis=1)[:100, :53]
+    np.testing.assert_array_equal(upsampled, expected)
+
+
+def test_stitching_all_empty_tiles_writes_empty_masks(tmp_path):
+    img_shape = (180, 170)
+    manifest = build_tile_manifest(img_shape, (64, 64), 8, empty_tiles=[])
+    for tile in manifest["tiles"]:
+        tile["empty"] = True
+
+    report = main(
+        [],
+        tmp_path,
+        "reg{r:03d}_mask.ome.tiff",
+        8,
+        "0,0,0,0",
+        True,
+        "DAPI",
+        "CD45",
+        tile_manifest=manifest,
+    )
+
+    assert report["reg1"]["num_cells"] == 0
+    with tif.TiffFile(tmp_path / "reg001_mask.ome.tiff") as TF:
+        assert len(TF.pages) == 4
+        masks = TF.series[0].asarray()
+    assert masks.shape[-2:] == img_shape
+    assert masks.max() == 0
+
+
+def test_stitching_all_empty_tiles_without_manifest_raises(tmp_path):
+    with pytest.raises(ValueError, match="All tiles are empty"):
+        main(
+            [],
+            tmp_path,
+            "reg{r:03d}_mask.ome.tiff",
+            8,
+            "0,0,0,0",
+            True,
+            "DAPI",
+            "CD45",
+            num_tiles={"x": 3, "y": 3},
+            empty_tiles=[f"R1_X{x}_Y{y}" for y in range(1, 4) for x in range(1, 4)],
+        )
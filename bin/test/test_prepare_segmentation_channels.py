@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+import tifffile as tif
+
+from prepare_segmentation_channels import extract_segm_channels
+
+
+@pytest.mark.parametrize("write_kwargs", [{}, {"tile": (64, 64), "compression": "zlib"}])
+def test_extract_segm_channels_reads_selected_pages(tmp_path, write_kwargs):
+    rng = np.random.default_rng(0)
+    stack = rng.integers(0, 2**16, size=(5, 300, 200), dtype=np.uint16)
+    in_path = tmp_path / "img.ome.tiff"
+    tif.imwrite(in_path, stack, metadata={"axes": "CYX"}, **write_kwargs)
+    segm_ch_ids = {"nucleus": [1], "cell": [0, 3, 4]}
+    out_paths = {ch_name: tmp_path / f"img_{ch_name}.tif" for ch_name in segm_ch_ids}
+
+    extract_segm_channels(in_path, segm_ch_ids, out_paths, num_workers=2, chunk_rows=64)
+
+    for ch_name, ids in segm_ch_ids.items():
+        expected = np.clip(stack[ids].sum(axis=0), 0, 2**16 - 1)
+        out = tif.imread(out_paths[ch_name])
+        assert out.dtype == np.uint16
+        np.testing.assert_array_equal(out, expected)
+
+    extract_segm_channels(in_path, {"cell": [0, 3, 4]}, out_paths, dtype="uint32")
+    out = tif.imread(out_paths["cell"])
+    assert out.dtype == np.uint32
+    np.testing.assert_array_equal(out, stack[[0, 3, 4]].sum(axis=0))
+
+
+def test_fused_slicing_matches_prepared_channels(tmp_path):
+    from slicing.channel_pages import open_segmentation_channels
+    from slicing.run_slicing import split_channels_into_tiles
+
+    rng = np.random.default_rng(1)
+    stack = rng.integers(0, 2**15, size=(4, 260, 190), dtype=np.uint16)
+    in_path = tmp_path / "img.ome.tiff"
+    tif.imwrite(in_path, stack, metadata={"axes": "CYX"}, tile=(64, 64), compression="zlib")
+    segm_ch_ids = {"nucleus": [2], "cell": [0, 1, 3]}
+    channels_dir = tmp_path / "segmentation_channels"
+    channels_dir.mkdir()
+    out_paths = {ch_name: channels_dir / f"img_{ch_name}.tif" for ch_name in segm_ch_ids}
+    extract_segm_channels(in_path, segm_ch_ids, out_paths)
+
+    two_step_dir = tmp_path / "two_step"
+    fused_dir = tmp_path / "fused"
+    split_channels_into_tiles(channels_dir, two_step_dir, 100, 10, num_workers=1, resume=False)
+    split_channels_into_tiles(
+        open_segmentation_channels(in_path, segm_ch_ids),
+        fused_dir,
+        100,
+        10,
+        num_workers=2,
+        pool="process",
+        resume=False,
+    )
+
+    two_step_tiles = sorted(p.relative_to(two_step_dir) for p in two_step_dir.rglob("*.tif"))
+    fused_tiles = sorted(p.relative_to(fused_dir) for p in fused_dir.rglob("*.tif"))
+    assert fused_tiles == two_step_tiles and len(fused_tiles) == 3 * 2 * 2
+    for tile in fused_tiles:
+        np.testing.assert_array_equal(
+            tif.imread(fused_dir / tile), tif.imread(two_step_dir / tile)
+        )
+
+
+def test_extract_segm_channels_normalizes_between_percentiles(tmp_path):
+    rng = np.random.default_rng(2)
+    stack = rng.integers(0, 4000, size=(3, 300, 200), dtype=np.uint16)
+    stack[:, :50] = 0
+    in_path = tmp_path / "img.ome.tiff"
+    tif.imwrite(in_path, stack, metadata={"axes": "CYX"})
+    segm_ch_ids = {"nucleus": [0], "cell": [1, 2]}
+    out_paths = {ch_name: tmp_path / f"img_{ch_name}.tif" for ch_name in segm_ch_ids}
+
+    segm_channels = extract_segm_channels(
+        in_path, segm_ch_ids, out_paths, chunk_rows=64, normalize="uint8", percentiles=(1, 99)
+    )
+
+    for ch_name, ids in segm_ch_ids.items():
+        _, dtype, normalization = segm_channels[ch_name]
+        assert dtype == np.uint8
+        summed = stack[ids].sum(axis=0, dtype=np.uint64)
+        nonzero = summed[summed > 0]
+        # histogram bins are 1 or 2 values wide
+        bin_width = normalization["histogram_bin_width"]
+        assert abs(normalization["low"] - np.percentile(nonzero, 1)) <= bin_width
+        assert abs(normalization["high"] - np.percentile(nonzero, 99)) <= bin_width
+        low, high = normalization["low"], normalization["high"]
+        expected = np.rint(
+            np.clip((summed.astype(np.float32) - low) * (255 / (high - low)), 0, 255)
+        )
+        out = tif.imread(out_paths[ch_name])
+        assert out.dtype == np.uint8
+        np.testing.assert_array_equal(out, expected)
+        assert not out[:50].any()
+
+
+def test_extract_segm_channels_downsamples_by_block_mean(tmp_path):
+    rng = np.random.default_rng(3)
+    stack = rng.integers(0, 1000, size=(2, 301, 203), dtype=np.uint16)
+    in_path = tmp_path / "img.ome.tiff"
+    tif.imwrite(in_path, stack, metadata={"axes": "CYX"})
+    out_paths = {"cell": tmp_path / "img_cell.tif"}
+
+    segm_channels = extract_segm_channels(
+        in_path, {"cell": [0, 1]}, out_paths, chunk_rows=50, downsampling=(4, 3)
+    )
+
+    assert segm_channels["cell"][0] == (76, 68)
+    summed = stack.sum(axis=0, dtype=np.float64)
+    out = tif.imread(out_paths["cell"])
+    for y, x in [(0, 0), (10, 20), (75, 0), (0, 67), (75, 67)]:
+        block = summed[y * 4 : y * 4 + 4, x * 3 : x * 3 + 3]
+        assert out[y, x] == np.rint(block.mean())
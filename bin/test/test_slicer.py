@@ -1,7 +1,38 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from slicing.run_slicing import main
+import numpy as np
+import pytest
+import tifffile as tif
+
+from slicing import run_slicing
+from slicing.overlap_estimate import estimate_overlap
+from slicing.run_slicing import (
+    get_num_concurrent_channels,
+    main,
+    select_tile_overlap,
+    shard_tiles,
+    split_channels_into_tiles,
+)
+from slicing.slicer import (
+    TileWriter,
+    estimate_slicing_memory,
+    get_tile,
+    slice_img,
+    slice_img_multichannel,
+    split_by_size,
+)
+from slicing.tile_shards import assign_tiles_to_shards, build_shard_manifest
+from slicing.tile_size import (
+    MIN_TILE_SIZE,
+    SEGMENTATION_BYTES_PER_PIXEL,
+    choose_tile_size,
+    get_redundant_pixel_fraction,
+)
+from slicing.tile_store import export_tile_dirs, write_tile_store
+from slicing.tiling import TILINGS
 
 base_stitched_dir = Path(
     os.path.normpath(
@@ -13,3 +44,331 @@ pipeline_config_path = Path("test_files/slicing/slicing_config.json")
 
 def test_slicing_main():
     main(base_stitched_dir, pipeline_config_path)
+
+
+def _make_segm_channel(path: Path, shape=(530, 470), **kwargs):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 2**16, size=shape, dtype=np.uint16)
+    tif.imwrite(path, img, **kwargs)
+    return img
+
+
+@pytest.mark.parametrize(
+    "write_kwargs",
+    [{}, {"tile": (64, 64), "compression": "zlib"}, {"rowsperstrip": 32, "compression": "zlib"}],
+)
+def test_windowed_slicing_matches_full(tmp_path, write_kwargs):
+    in_path = tmp_path / "img_nucleus.tif"
+    _make_segm_channel(in_path, **write_kwargs)
+    for read_mode in ("full", "windowed"):
+        slice_img(in_path, tmp_path / read_mode, 200, 16, 1, "nucleus", read_mode=read_mode)
+
+    full_tiles = sorted(
+        p.relative_to(tmp_path / "full") for p in (tmp_path / "full").rglob("*.tif")
+    )
+    windowed_tiles = sorted(
+        p.relative_to(tmp_path / "windowed") for p in (tmp_path / "windowed").rglob("*.tif")
+    )
+    assert len(full_tiles) == 9
+    assert full_tiles == windowed_tiles
+    for tile in full_tiles:
+        assert (tmp_path / "full" / tile).read_bytes() == (
+            tmp_path / "windowed" / tile
+        ).read_bytes()
+
+
+def test_split_by_size_copies_only_padded_tiles():
+    arr = np.arange(100 * 90, dtype=np.uint16).reshape((100, 90))
+    tiles = list(split_by_size(arr, "cell", tile_w=30, tile_h=50, overlap=0))
+    assert [str(name) for _, name in tiles[:2]] == [
+        "R1_X1_Y1/R1_X1_Y1_cell.tif",
+        "R1_X2_Y1/R1_X2_Y1_cell.tif",
+    ]
+    assert all(np.shares_memory(tile, arr) for tile, _ in tiles)
+
+    padded_tiles = list(split_by_size(arr, "cell", tile_w=30, tile_h=50, overlap=5))
+    assert all(tile.shape == (60, 40) for tile, _ in padded_tiles)
+    assert not any(np.shares_memory(tile, arr) for tile, _ in padded_tiles)
+
+
+def test_multichannel_tiles_match_per_channel_tiles(tmp_path):
+    in_paths = {"nucleus": tmp_path / "img_nucleus.tif", "cell": tmp_path / "img_cell.tif"}
+    for path in in_paths.values():
+        _make_segm_channel(path, shape=(300, 250))
+        slice_img(path, tmp_path / "single", 128, 8, 1, path.stem.split("_")[-1])
+    slice_img_multichannel(in_paths, tmp_path / "multi", 128, 8)
+
+    with tif.TiffFile(tmp_path / "multi/R1_X2_Y3/R1_X2_Y3_channels.tif") as TF:
+        tile = TF.asarray()
+        assert TF.shaped_metadata[0]["Channel"]["Name"] == ["nucleus", "cell"]
+    assert tile.shape == (2, 144, 144)
+    for i, channel_name in enumerate(in_paths):
+        single = tif.imread(tmp_path / f"single/R1_X2_Y3/R1_X2_Y3_{channel_name}.tif")
+        np.testing.assert_array_equal(tile[i], single)
+
+
+def test_tile_store_export_matches_slicer_output(tmp_path):
+    in_paths = {"nucleus": tmp_path / "img_nucleus.tif", "cell": tmp_path / "img_cell.tif"}
+    for channel_name, path in in_paths.items():
+        _make_segm_channel(path, shape=(300, 250))
+        slice_img(path, tmp_path / "single", 128, 8, 1, channel_name)
+    write_tile_store(in_paths, tmp_path / "tiles.zarr", 128, 8)
+    export_tile_dirs(tmp_path / "tiles.zarr", tmp_path / "exported")
+
+    single_tiles = sorted(
+        p.relative_to(tmp_path / "single") for p in (tmp_path / "single").rglob("*.tif")
+    )
+    exported_tiles = sorted(
+        p.relative_to(tmp_path / "exported") for p in (tmp_path / "exported").rglob("*.tif")
+    )
+    assert len(single_tiles) == 2 * 6
+    assert single_tiles == exported_tiles
+    for tile in single_tiles:
+        assert (tmp_path / "single" / tile).read_bytes() == (
+            tmp_path / "exported" / tile
+        ).read_bytes()
+
+
+def test_slicing_resumes_from_journal(tmp_path):
+    in_path = tmp_path / "img_nucleus.tif"
+    _make_segm_channel(in_path, shape=(300, 250))
+    first = slice_img(in_path, tmp_path / "tiles", 128, 8, 1, "nucleus")
+    assert (first["num_tiles"], first["num_resumed"]) == (6, 0)
+
+    damaged = tmp_path / "tiles/R1_X2_Y2/R1_X2_Y2_nucleus.tif"
+    expected = damaged.read_bytes()
+    damaged.write_bytes(expected[:100])
+    (tmp_path / "tiles/R1_X1_Y3/R1_X1_Y3_nucleus.tif").unlink()
+
+    resumed = slice_img(in_path, tmp_path / "tiles", 128, 8, 1, "nucleus")
+    assert (resumed["num_tiles"], resumed["num_resumed"]) == (2, 4)
+    assert resumed["occupancy"] == first["occupancy"]
+    assert damaged.read_bytes() == expected
+    assert not list((tmp_path / "tiles").rglob("*.tmp"))
+
+    restarted = slice_img(in_path, tmp_path / "tiles", 128, 16, 1, "nucleus")
+    assert (restarted["num_tiles"], restarted["num_resumed"]) == (6, 0)
+
+
+def test_tile_writer_handles_writes_cancelled_on_error(caplog):
+    release = threading.Event()
+    writer = TileWriter(
+        num_workers=1, max_pending=4, write=lambda destination, tile: release.wait()
+    )
+    tile = np.zeros((4, 4), dtype=np.uint16)
+    with pytest.raises(RuntimeError, match="reading failed"):
+        with writer:
+            # the first write blocks the only worker, the others wait in the queue
+            for destination in range(3):
+                writer.submit(destination, tile)
+            threading.Timer(0.1, release.set).start()
+            raise RuntimeError("reading failed")
+    assert not [r for r in caplog.records if r.name == "concurrent.futures"]
+    # slots of the cancelled writes are released too
+    assert all(writer._slots.acquire(blocking=False) for _ in range(4))
+
+
+def _make_channels_dir(channels_dir: Path, channel_names):
+    channels_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for channel_name in channel_names:
+        img = rng.integers(0, 2**16, size=(300, 250), dtype=np.uint16)
+        tif.imwrite(channels_dir / f"img_{channel_name}.tif", img)
+
+
+def test_memory_budget_limits_concurrent_channels(tmp_path, monkeypatch):
+    channel_names = ["nucleus", "cell", "membrane", "other"]
+    _make_channels_dir(tmp_path / "channels", channel_names)
+    paths = [tmp_path / "channels" / f"img_{c}.tif" for c in channel_names]
+    per_channel = estimate_slicing_memory(paths[0], 128, 8, "windowed")
+
+    assert get_num_concurrent_channels(paths, 128, 8, "windowed", 8, None) == 4
+    assert get_num_concurrent_channels(paths, 128, 8, "windowed", 3, None) == 3
+    budget_gb = 2.5 * per_channel / 1024**3
+    assert get_num_concurrent_channels(paths, 128, 8, "windowed", 8, budget_gb) == 2
+    # at least one channel even if it does not fit
+    assert get_num_concurrent_channels(paths, 128, 8, "windowed", 8, 1e-9) == 1
+
+    pool_sizes = []
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def __init__(self, max_workers):
+            pool_sizes.append(max_workers)
+            super().__init__(max_workers=max_workers)
+
+    monkeypatch.setattr(run_slicing, "ThreadPoolExecutor", RecordingExecutor)
+    split_channels_into_tiles(
+        tmp_path / "channels",
+        tmp_path / "tiles",
+        128,
+        8,
+        num_workers=8,
+        memory_budget_gb=budget_gb,
+    )
+    assert pool_sizes == [2]
+
+
+@pytest.mark.parametrize("pool", ["thread", "process"])
+def test_concurrent_channels_match_sequential(tmp_path, pool):
+    channel_names = ["nucleus", "cell", "membrane"]
+    _make_channels_dir(tmp_path / "channels", channel_names)
+
+    sequential = split_channels_into_tiles(
+        tmp_path / "channels", tmp_path / "sequential", 128, 8, num_workers=1
+    )
+    concurrent = split_channels_into_tiles(
+        tmp_path / "channels", tmp_path / "concurrent", 128, 8, num_workers=3, pool=pool
+    )
+    assert concurrent == sequential
+    sequential_tiles = sorted(
+        p.relative_to(tmp_path / "sequential") for p in (tmp_path / "sequential").rglob("*.tif")
+    )
+    concurrent_tiles = sorted(
+        p.relative_to(tmp_path / "concurrent") for p in (tmp_path / "concurrent").rglob("*.tif")
+    )
+    assert len(sequential_tiles) == 3 * 6
+    assert concurrent_tiles == sequential_tiles
+    for tile in sequential_tiles:
+        assert (tmp_path / "concurrent" / tile).read_bytes() == (
+            tmp_path / "sequential" / tile
+        ).read_bytes()
+
+
+def test_empty_tiles_are_skipped_while_slicing(tmp_path):
+    channels_dir = tmp_path / "channels"
+    channels_dir.mkdir()
+    nucleus = np.zeros((256, 256), dtype=np.uint16)
+    nucleus[20:100, 20:100] = 7
+    cell = nucleus.copy()
+    cell[20:100, 150:230] = 9
+    tif.imwrite(channels_dir / "img_nucleus.tif", nucleus)
+    tif.imwrite(channels_dir / "img_cell.tif", cell)
+    out_dir = tmp_path / "tiles"
+
+    occupancy, empty_tiles, hashes = split_channels_into_tiles(
+        channels_dir, out_dir, 128, 8, empty_tile_threshold=0.0
+    )
+    assert sorted(empty_tiles) == ["R1_X1_Y2", "R1_X2_Y2"]
+    assert sorted(p.name for p in out_dir.glob("R*")) == ["R1_X1_Y1", "R1_X2_Y1"]
+    # empty in the nucleus channel only, filled in for segmentation
+    filled = tif.imread(out_dir / "R1_X2_Y1/R1_X2_Y1_nucleus.tif")
+    np.testing.assert_array_equal(filled, get_tile(nucleus, 128, 256, 0, 128, 8))
+    assert sorted(hashes) == ["R1_X1_Y1", "R1_X2_Y1"]
+    assert all(sorted(h) == ["cell", "nucleus"] for h in hashes.values())
+
+    journals = {p: p.read_bytes() for p in out_dir.glob("slicing_journal_*")}
+    resumed = split_channels_into_tiles(channels_dir, out_dir, 128, 8, empty_tile_threshold=0.0)
+    assert resumed == (occupancy, empty_tiles, hashes)
+    # nothing is sliced, removed or written again
+    assert {p: p.read_bytes() for p in out_dir.glob("slicing_journal_*")} == journals
+
+
+def test_tile_size_fits_memory_budget():
+    # 2112 px tiles with 32 px overlap on each side fill exactly this budget
+    budget_gb = 2112**2 * SEGMENTATION_BYTES_PER_PIXEL / 1024**3
+    assert choose_tile_size((2048, 2048), 32, budget_gb, num_workers=1) == 2048
+    assert choose_tile_size((2048, 2048), 32, budget_gb * 0.999, num_workers=1) == 1024
+    # budget below the smallest candidate is clamped up to it
+    assert choose_tile_size((20000, 20000), 32, 0.01, num_workers=1) == MIN_TILE_SIZE
+    # no tiles larger than the image rounded up to a tile size step
+    assert choose_tile_size((1100, 900), 0, 100, num_workers=1) == 1280
+
+
+@pytest.mark.parametrize("num_workers,tile_size", [(1, 4096), (4, 2048), (16, 1024)])
+def test_tile_size_fills_segmentation_workers(num_workers, tile_size):
+    assert choose_tile_size((4096, 4096), 32, 100, num_workers) == tile_size
+
+
+def test_redundant_pixel_fraction():
+    assert get_redundant_pixel_fraction((1000, 1000), (500, 500), 0) == 0
+    # padding of the last row and column
+    padded = get_redundant_pixel_fraction((1000, 1000), (512, 512), 0)
+    assert padded == pytest.approx(1 - 1000**2 / (4 * 512**2))
+    # plus overlap on every side of every tile
+    overlapping = get_redundant_pixel_fraction((1000, 1000), (512, 512), 10)
+    assert overlapping == pytest.approx(1 - 1000**2 / (4 * 532**2))
+
+
+def test_tile_shards_balance_work():
+    work = {f"R1_X{x}_Y1": w for x, w in enumerate([900, 100, 500, 500, 400, 0, 0, 600], 1)}
+    shards = assign_tiles_to_shards(work, 3)
+    assert sorted(name for shard in shards for name in shard) == sorted(work)
+    assert [sum(work[name] for name in shard) for shard in shards] == [1000, 1000, 1000]
+    assert shards[0] == ["R1_X1_Y1", "R1_X2_Y1", "R1_X6_Y1"]
+    assert [len(shard) for shard in shards] == [3, 3, 2]
+
+
+def test_tile_shards_without_work_makes_no_shards(tmp_path):
+    assert assign_tiles_to_shards({}, 3) == []
+    manifest = build_shard_manifest([["R1_X1_Y1"], []], {"R1_X1_Y1": 10})
+    assert [shard["tiles"] for shard in manifest["shards"]] == [["R1_X1_Y1"]]
+
+    # every tile is empty or cached
+    occupancy = {"R1_X1_Y1": {"nucleus": {"nonzero_fraction": 0.0}}}
+    manifest = shard_tiles(tmp_path, occupancy, ["R1_X1_Y1"], (128, 128), 16, 3)
+    assert manifest["num_shards"] == 0
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize("tiling_name", list(TILINGS))
+def test_tiling_batch_matches_scalar(tiling_name):
+    tiling = TILINGS[tiling_name]
+    w, h = 5, 3
+    xs, ys = tiling.coordinates_from_indices(np.arange(w * h), w, h)
+    scalar = [tiling.coordinates_from_index(i, w, h) for i in range(w * h)]
+    assert list(zip(xs.tolist(), ys.tolist())) == scalar
+    assert sorted(scalar) == sorted((x, y) for x in range(w) for y in range(h))
+    np.testing.assert_array_equal(tiling.indices_from_coordinates(xs, ys, w, h), np.arange(w * h))
+    projection = tiling.get_projection_map((w, h), (2, 2), (3, 1))
+    expected = [
+        tiling.index_from_coordinates(3 + x, 1 + y, w, h)
+        for x, y in (tiling.coordinates_from_index(i, 2, 2) for i in range(4))
+    ]
+    assert projection.tolist() == expected
+
+
+def test_hilbert_tiles_are_visited_as_neighbours(tmp_path):
+    xs, ys = TILINGS["hilbert"].coordinates_from_indices(np.arange(64), 8, 8)
+    assert np.all(np.abs(np.diff(xs)) + np.abs(np.diff(ys)) == 1)
+
+    in_path = tmp_path / "img_nucleus.tif"
+    _make_segm_channel(in_path, shape=(300, 250))
+    for tile_order in ("grid", "hilbert"):
+        slice_img(in_path, tmp_path / tile_order, 64, 8, 1, "nucleus", tile_order=tile_order)
+    grid_tiles = sorted(
+        p.relative_to(tmp_path / "grid") for p in (tmp_path / "grid").rglob("*.tif")
+    )
+    assert len(grid_tiles) == 20
+    for tile in grid_tiles:
+        assert (tmp_path / "grid" / tile).read_bytes() == (
+            tmp_path / "hilbert" / tile
+        ).read_bytes()
+
+
+def test_overlap_estimate_fits_cells(tmp_path):
+    img = np.zeros((600, 600), dtype=np.uint16)
+    yy, xx = np.mgrid[:15, :15]
+    disk = (yy - 7) ** 2 + (xx - 7) ** 2 <= 49
+    for y in range(20, 580, 40):
+        for x in range(20, 580, 40):
+            img[y : y + 15, x : x + 15][disk] = 1000
+    in_path = tmp_path / "img_nucleus.tif"
+    tif.imwrite(in_path, img)
+
+    overlap, justification = estimate_overlap(in_path, 0.5, "µm", 100, window_size=256)
+    assert justification["nucleus_size_px"] == 15
+    assert overlap == 38
+    capped, justification = estimate_overlap(in_path, 5000, "nm", 100, window_size=256)
+    assert capped == 16
+    assert justification["capped_at_max_cell_diameter_um"] == 80
+
+    tif.imwrite(in_path, np.zeros_like(img))
+    assert estimate_overlap(in_path, 0.5, "µm", 100)[0] == 100
+
+
+def test_auto_overlap_without_nucleus_channel_keeps_tile_overlap(tmp_path):
+    channels = {"cell": tmp_path / "img_cell.tif"}
+    overlap, justification = select_tile_overlap(channels, {}, {"pixel_size_x": 0.5}, 100)
+    assert overlap == 100
+    assert justification["overlap"] == 100
+    assert "no nucleus" in justification["reason"]
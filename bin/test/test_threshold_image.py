@@ -0,0 +1,101 @@
+import json
+
+import numpy as np
+import pytest
+import tifffile as tif
+
+from threshold_image import CHANNEL_STATS_NAME, main
+from utils_ome import set_contiguous_tiffdata, strip_namespace
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+def test_threshold_image_matches_per_channel_clipping(tmp_path, monkeypatch, dtype):
+    rng = np.random.default_rng(0)
+    stack = rng.integers(0, 1000, size=(3, 90, 70)).astype(dtype)
+    channel_names = ["DAPI", "CD45", "CD3"]
+    in_dir = tmp_path / "in"
+    in_dir.mkdir()
+    in_path = in_dir / "img.ome.tiff"
+    tif.imwrite(
+        in_path,
+        stack,
+        ome=True,
+        metadata={"axes": "CYX", "Channel": {"Name": channel_names}},
+        tile=(32, 32),
+    )
+    dataset_dir = tmp_path / "dataset"
+    dataset_dir.mkdir()
+    (dataset_dir / "channels.csv").write_text(
+        "channel_id,threshold low,threshold\nDAPI,100,800.5\nCD45,,500\nCD3,250,\n"
+    )
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    monkeypatch.chdir(out_dir)
+
+    main(in_path, dataset_dir, num_workers=2)
+
+    with tif.TiffFile(in_path) as TF:
+        in_ome_metadata = TF.ome_metadata
+    expected = stack.copy()
+    for i, (low, high) in enumerate([(100, 800.5), (None, 500), (250, None)]):
+        if low is not None:
+            expected[i][expected[i] < low] = 0
+        if high is not None:
+            expected[i][expected[i] > high] = high
+    with tif.TiffFile(out_dir / "img.ome.tiff") as TF:
+        assert TF.is_ome
+        np.testing.assert_array_equal(TF.series[0].asarray(), expected)
+        out_ome_metadata = TF.ome_metadata
+    in_pixels = strip_namespace(in_ome_metadata).find("Image").find("Pixels")
+    out_pixels = strip_namespace(out_ome_metadata).find("Image").find("Pixels")
+    assert out_pixels.attrib == in_pixels.attrib
+    assert [c.attrib for c in out_pixels.findall("Channel")] == [
+        c.attrib for c in in_pixels.findall("Channel")
+    ]
+    assert [td.attrib for td in out_pixels.findall("TiffData")] == [
+        {"IFD": "0", "PlaneCount": "3"}
+    ]
+
+    with open(out_dir / CHANNEL_STATS_NAME) as f:
+        stats = json.load(f)
+    assert list(stats) == channel_names
+    for i, (low, high) in enumerate([(100, 800.5), (None, 500), (250, None)]):
+        channel_stats = stats[channel_names[i]]
+        assert channel_stats["threshold_low"] == low
+        assert channel_stats["threshold_high"] == high
+        assert channel_stats["num_pixels"] == stack[i].size
+        assert channel_stats["min"] == stack[i].min()
+        assert channel_stats["max"] == stack[i].max()
+        assert channel_stats["mean"] == pytest.approx(stack[i].mean(dtype=np.float64))
+        assert channel_stats["std"] == pytest.approx(stack[i].std(dtype=np.float64))
+        num_zeroed = np.count_nonzero(stack[i] < low) if low is not None else 0
+        num_clipped = np.count_nonzero(stack[i] > high) if high is not None else 0
+        assert channel_stats["num_zeroed_by_low_threshold"] == num_zeroed
+        assert channel_stats["num_clipped_by_high_threshold"] == num_clipped
+        histogram = channel_stats["histogram"]
+        assert sum(histogram["counts"]) + histogram.get("nonpositive", 0) == stack[i].size
+        assert len(histogram["bin_edges"]) == len(histogram["counts"]) + 1
+
+
+def test_set_contiguous_tiffdata_replaces_source_layout():
+    ome_xml = (
+        '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06" UUID="urn:uuid:1">'
+        '<Image ID="Image:0"><Pixels ID="Pixels:0" DimensionOrder="XYCZT" Type="uint16" '
+        'SizeX="4" SizeY="4" SizeC="2" SizeZ="1" SizeT="1">'
+        '<Channel ID="Channel:0:0" Name="DAPI"/><Channel ID="Channel:0:1" Name="CD45"/>'
+        '<TiffData IFD="4" FirstC="0" PlaneCount="1">'
+        '<UUID FileName="other.ome.tiff">urn:uuid:2</UUID></TiffData>'
+        '<TiffData IFD="9" FirstC="1" PlaneCount="1"/>'
+        '<Plane TheC="0" TheZ="0" TheT="0"/><Plane TheC="1" TheZ="0" TheT="0"/>'
+        "</Pixels></Image></OME>"
+    )
+
+    new_xml = set_contiguous_tiffdata(ome_xml, 2)
+
+    assert new_xml.startswith('<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06"')
+    root = strip_namespace(new_xml)
+    assert "UUID" not in root.attrib
+    assert root.find(".//UUID") is None
+    pixels = root.find("Image").find("Pixels")
+    assert [child.tag for child in pixels] == ["Channel", "Channel", "TiffData", "Plane", "Plane"]
+    assert pixels.find("TiffData").attrib == {"IFD": "0", "PlaneCount": "2"}
@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 import csv
+import json
+import os
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from math import isnan
 from pathlib import Path
 from pprint import pprint
 from typing import NamedTuple, Optional
 
-import bioio
+import numpy as np
+import tifffile as tif
 
+from slicing.tiff_pages import open_page_reader
 from utils import find_channels_csv
+from utils_ome import set_contiguous_tiffdata, strip_namespace
 
 threshold_low_col_names = [
     "threshold low",
@@ -16,6 +22,10 @@ threshold_low_col_names = [
 ]
 threshold_high_col_name = "threshold"
 channel_id_columns = ["channel_id", "channel id"]
+BAND_ROWS = 2048
+# written next to the thresholded image, collect_output.py copies it next to the expressions
+CHANNEL_STATS_NAME = "channel_stats.json"
+HISTOGRAM_BINS = 256
 
 
 class ClipData(NamedTuple):
@@ -81,35 +91,300 @@ def parse_channel_thresholds(channels_csv: Path) -> ClipData:
     return ClipData(low=thresholds_low, high=thresholds_high)
 
 
-def main(ome_tiff_file: Path, dataset_dir: Path):
-    image = bioio.BioImage(ome_tiff_file)
+def get_channel_names(ome_xml_str: str) -> list[str]:
+    """Channel names like bioio reports them: Name attribute, ID if there is no name"""
+    pixels = strip_namespace(ome_xml_str).find("Image").find("Pixels")
+    return [ch.get("Name") or ch.get("ID") for ch in pixels.findall("Channel")]
+
+
+def get_page_channels(series: tif.TiffPageSeries) -> list[int]:
+    """Channel index of every page (plane) of a series"""
+    page_shape = series.shape[:-2]
+    num_pages = int(np.prod(page_shape, dtype=int))
+    if "C" not in series.axes[:-2]:
+        return [0] * num_pages
+    channel_axis = series.axes.index("C")
+    return [int(np.unravel_index(i, page_shape)[channel_axis]) for i in range(num_pages)]
+
+
+def apply_thresholds(data: np.ndarray, min_value: Optional[float], max_value: Optional[float]):
+    """Thresholds data in place"""
+    # Different semantics for lower and upper thresholds, so no usage
+    # of something like `np.clip` with both values
+    if min_value is not None:
+        data[data < min_value] = 0
+    if max_value is not None:
+        data[data > max_value] = max_value
+
+
+def make_threshold_lut(
+    dtype: np.dtype, min_value: Optional[float], max_value: Optional[float]
+) -> Optional[np.ndarray]:
+    """Thresholded value of every possible value of 8 and 16 bit unsigned dtypes,
+    None for other dtypes
+    """
+    if not (np.issubdtype(dtype, np.unsignedinteger) and dtype.itemsize <= 2):
+        return None
+    lut = np.arange(np.iinfo(dtype).max + 1, dtype=dtype)
+    apply_thresholds(lut, min_value, max_value)
+    return lut
+
+
+class ChannelStats:
+    """Intensity statistics of a channel before thresholding, accumulated band by band.
+    8 and 16 bit unsigned images keep a count of every value, everything else
+    is derived from it; other dtypes accumulate moments, and their histogram
+    has power of two bins: bin e counts values in [2 ** (e - 1), 2 ** e).
+    """
+
+    def __init__(self, dtype: np.dtype, min_value: Optional[float], max_value: Optional[float]):
+        self.dtype = np.dtype(dtype)
+        self.min_value = min_value
+        self.max_value = max_value
+        self.value_counts = None
+        if make_threshold_lut(self.dtype, None, None) is not None:
+            self.value_counts = np.zeros(np.iinfo(self.dtype).max + 1, dtype=np.int64)
+        self.num_pixels = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.num_zeroed = 0
+        self.num_clipped = 0
+        self.num_nonpositive = 0
+        self.exponent_counts = dict()
+
+    def update(self, band: np.ndarray):
+        if band.size == 0:
+            return
+        if self.value_counts is not None:
+            self.value_counts += np.bincount(band.ravel(), minlength=self.value_counts.size)
+            return
+        self.num_pixels += band.size
+        band_min, band_max = band.min(), band.max()
+        self.min = band_min if self.min is None else min(self.min, band_min)
+        self.max = band_max if self.max is None else max(self.max, band_max)
+        self.sum += float(band.sum(dtype=np.float64))
+        self.sum_squares += float(np.square(band, dtype=np.float64).sum())
+        if self.min_value is not None:
+            self.num_zeroed += int(np.count_nonzero(band < self.min_value))
+        if self.max_value is not None:
+            self.num_clipped += int(np.count_nonzero(band > self.max_value))
+        positive = band[band > 0]
+        self.num_nonpositive += band.size - positive.size
+        exponents, counts = np.unique(np.frexp(positive)[1], return_counts=True)
+        for exponent, count in zip(exponents.tolist(), counts.tolist()):
+            self.exponent_counts[exponent] = self.exponent_counts.get(exponent, 0) + count
+
+    def merge(self, other: "ChannelStats"):
+        if self.value_counts is not None:
+            self.value_counts += other.value_counts
+            return
+        self.num_pixels += other.num_pixels
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        self.sum += other.sum
+        self.sum_squares += other.sum_squares
+        self.num_zeroed += other.num_zeroed
+        self.num_clipped += other.num_clipped
+        self.num_nonpositive += other.num_nonpositive
+        for exponent, count in other.exponent_counts.items():
+            self.exponent_counts[exponent] = self.exponent_counts.get(exponent, 0) + count
+
+    def _histogram_from_value_counts(self) -> dict:
+        bin_width = max(1, self.value_counts.size // HISTOGRAM_BINS)
+        counts = self.value_counts.reshape(-1, bin_width).sum(axis=1)
+        bin_edges = np.arange(counts.size + 1) * bin_width
+        return {"bin_edges": bin_edges.tolist(), "counts": counts.tolist()}
+
+    def _histogram_from_exponents(self) -> dict:
+        if not self.exponent_counts:
+            return {"bin_edges": [], "counts": [], "nonpositive": self.num_nonpositive}
+        exponents = range(min(self.exponent_counts), max(self.exponent_counts) + 1)
+        return {
+            "bin_edges": [2.0 ** (e - 1) for e in exponents] + [2.0 ** exponents[-1]],
+            "counts": [self.exponent_counts.get(e, 0) for e in exponents],
+            "nonpositive": self.num_nonpositive,
+        }
+
+    def to_dict(self) -> dict:
+        if self.value_counts is not None:
+            values = np.arange(self.value_counts.size, dtype=np.int64)
+            num_pixels = int(self.value_counts.sum())
+            present = np.flatnonzero(self.value_counts)
+            value_sum = float((values * self.value_counts).sum())
+            value_square_sum = float((values.astype(np.float64) ** 2 * self.value_counts).sum())
+            value_min = int(present[0]) if present.size else None
+            value_max = int(present[-1]) if present.size else None
+            num_zeroed = 0
+            if self.min_value is not None:
+                num_zeroed = int(self.value_counts[values < self.min_value].sum())
+            num_clipped = 0
+            if self.max_value is not None:
+                num_clipped = int(self.value_counts[values > self.max_value].sum())
+            histogram = self._histogram_from_value_counts()
+        else:
+            num_pixels = self.num_pixels
+            value_sum = self.sum
+            value_square_sum = self.sum_squares
+            value_min = None if self.min is None else self.min.item()
+            value_max = None if self.max is None else self.max.item()
+            num_zeroed = self.num_zeroed
+            num_clipped = self.num_clipped
+            histogram = self._histogram_from_exponents()
+        mean = value_sum / num_pixels if num_pixels else None
+        std = None
+        if num_pixels:
+            std = max(0.0, value_square_sum / num_pixels - mean**2) ** 0.5
+        return {
+            "threshold_low": self.min_value,
+            "threshold_high": self.max_value,
+            "num_pixels": num_pixels,
+            "min": value_min,
+            "max": value_max,
+            "mean": mean,
+            "std": std,
+            "num_zeroed_by_low_threshold": num_zeroed,
+            "num_clipped_by_high_threshold": num_clipped,
+            "histogram": histogram,
+        }
+
+
+def threshold_plane(
+    reader,
+    out: np.ndarray,
+    min_value: Optional[float],
+    max_value: Optional[float],
+    band_rows: int = BAND_ROWS,
+    window: Optional[tuple[slice, slice]] = None,
+    outside: Optional[np.ndarray] = None,
+) -> ChannelStats:
+    """Copies a plane, or only its (y, x) window, into out band by band,
+    thresholding every band in place: through a lookup table for 8 and 16 bit images,
+    with comparisons otherwise. Pixels where outside is True are zeroed.
+    Returns statistics of the pixels that are not outside, before thresholding.
+    """
+    stats = ChannelStats(out.dtype, min_value, max_value)
+    if window is None:
+        window = (slice(0, out.shape[0]), slice(0, out.shape[1]))
+    rows, cols = window
+    lut = None
+    if min_value is not None or max_value is not None:
+        lut = make_threshold_lut(out.dtype, min_value, max_value)
+    for row_f in range(0, out.shape[0], band_rows):
+        row_t = min(row_f + band_rows, out.shape[0])
+        out_band = out[row_f:row_t]
+        band = np.asarray(reader[rows.start + row_f : rows.start + row_t, cols])
+        if outside is None:
+            stats.update(band)
+        else:
+            stats.update(band[~outside[row_f:row_t]])
+        if lut is not None:
+            np.take(lut, band, out=out_band)
+        else:
+            out_band[:] = band
+            apply_thresholds(out_band, min_value, max_value)
+        if outside is not None:
+            out_band[outside[row_f:row_t]] = 0
+    return stats
+
+
+def threshold_planes(
+    tasks: list[tuple[str, tuple]], num_workers: Optional[int], **plane_kwargs
+) -> dict[str, ChannelStats]:
+    """Runs (channel name, threshold_plane arguments) tasks in a thread pool,
+    returns statistics merged over all planes of every channel
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    stats = dict()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            (channel_id, executor.submit(threshold_plane, *args, **plane_kwargs))
+            for channel_id, args in tasks
+        ]
+        for channel_id, future in futures:
+            plane_stats = future.result()
+            if channel_id in stats:
+                stats[channel_id].merge(plane_stats)
+            else:
+                stats[channel_id] = plane_stats
+    return stats
+
+
+def save_channel_stats(stats: dict[str, ChannelStats], out_path: Path):
+    with open(out_path, "w") as f:
+        print("Saving channel statistics to", out_path)
+        json.dump({channel_id: s.to_dict() for channel_id, s in stats.items()}, f, indent=4)
+
+
+def main(
+    ome_tiff_file: Path,
+    dataset_dir: Path,
+    num_workers: Optional[int] = None,
+    out_path: Optional[Path] = None,
+):
+    """Reads one plane at a time and writes the thresholded planes straight
+    into a memory-mapped output OME-TIFF with the metadata of the input,
+    except for TiffData, which describes the layout of the written file;
+    planes of independent channels are processed in parallel threads.
+    Output goes to the working directory under the input file name by default,
+    per-channel statistics go next to it.
+    """
     channels_csv = find_channels_csv(dataset_dir)
     clip_data = parse_channel_thresholds(channels_csv)
-    for i, channel_id in enumerate(image.channel_names):
+    if out_path is None:
+        out_path = Path(ome_tiff_file.name)
+    if out_path.resolve() == ome_tiff_file.resolve():
+        raise ValueError(f"Output would overwrite the input image {ome_tiff_file}")
+
+    with tif.TiffFile(ome_tiff_file) as TF:
+        if not TF.is_ome:
+            raise ValueError(f"{ome_tiff_file} is not an OME-TIFF")
+        ome_xml = TF.ome_metadata
+        series = TF.series[0]
+        page_indices = [page.index for page in series.pages]
+        page_channels = get_page_channels(series)
+        plane_shape = series.shape[-2:]
+        dtype = series.dtype
+    channel_names = get_channel_names(ome_xml)
+
+    out = tif.memmap(
+        out_path,
+        shape=(len(page_indices),) + tuple(plane_shape),
+        dtype=dtype,
+        photometric="minisblack",
+        description=set_contiguous_tiffdata(ome_xml, len(page_indices)),
+        metadata=None,
+    )
+    tasks = []
+    for i, channel_id in enumerate(channel_names):
         min_value = clip_data.low.get(channel_id)
         max_value = clip_data.high.get(channel_id)
         print("Thresholding channel", channel_id, "with min", min_value, "and max", max_value)
-        channel_data = image.data[:, i, :, :, :].copy()
-        # Different semantics for lower and upper thresholds, so no usage
-        # of something like `np.clip` with both values
-        if min_value is not None:
-            channel_data[channel_data < min_value] = 0
-        if max_value is not None:
-            channel_data[channel_data > max_value] = max_value
-        image.data[:, i, :, :, :] = channel_data
-    image_new = bioio.BioImage(
-        image.data.squeeze(),
-        channel_names=image.channel_names,
-        dim_order="CYX",
-        physical_pixel_sizes=image.physical_pixel_sizes,
-    )
-    image_new.save(ome_tiff_file.name)
+        for out_index, page_index in enumerate(page_indices):
+            if page_channels[out_index] == i:
+                reader = open_page_reader(ome_tiff_file, page_index)
+                tasks.append((channel_id, (reader, out[out_index], min_value, max_value)))
+
+    stats = threshold_planes(tasks, num_workers)
+    out.flush()
+    del out
+    save_channel_stats(stats, out_path.parent / CHANNEL_STATS_NAME)
 
 
 if __name__ == "__main__":
     p = ArgumentParser()
     p.add_argument("ome_tiff_file", type=Path)
     p.add_argument("dataset_dir", type=Path)
+    p.add_argument(
+        "--num_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of channel planes thresholded in parallel",
+    )
     args = p.parse_args()
 
-    main(args.ome_tiff_file, args.dataset_dir)
+    main(args.ome_tiff_file, args.dataset_dir, args.num_workers)
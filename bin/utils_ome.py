@@ -113,6 +113,25 @@ def generate_and_add_new_tiffdata(px_node: ET.Element, tiffdata_list):
             ifd += 1
 
 
+def set_contiguous_tiffdata(xml_str: str, num_pages: int) -> str:
+    """OME-XML of a file that stores the first image as num_pages consecutive pages
+    from IFD 0. TiffData of the source may point at other IFDs or files, it is
+    replaced by one block, the source file UUID is dropped. Namespaces are kept.
+    """
+    ome_xml = ET.fromstring(xml_str.encode("utf-8"))
+    ns = ome_xml.tag[: ome_xml.tag.index("}") + 1] if ome_xml.tag.startswith("{") else ""
+    ome_xml.attrib.pop("UUID", None)
+    px_node = ome_xml.find(f"{ns}Image").find(f"{ns}Pixels")
+    for td in px_node.findall(f"{ns}TiffData"):
+        px_node.remove(td)
+    # schema order in Pixels: Channel elements, then TiffData, then Plane elements
+    channels = px_node.findall(f"{ns}Channel")
+    position = px_node.index(channels[-1]) + 1 if channels else 0
+    td = ET.Element(f"{ns}TiffData", IFD="0", PlaneCount=str(num_pages))
+    px_node.insert(position, td)
+    return ET.tostring(ome_xml, encoding="unicode")
+
+
 def modify_initial_ome_meta(
     xml_str: str,
     segmentation_channel_ids: dict[str, list[int]],